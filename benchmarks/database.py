@@ -0,0 +1,214 @@
+"""
+Benchmarks of the database layer. Run from the repository root:
+
+    python benchmarks/database.py load        # concurrent reads and writes through AsyncDatabase
+    python benchmarks/database.py hydrate     # materializing infractions with find_all_for_user
+
+The benchmark databases are built once in --dir (in the temp directory by default) and reused.
+They're filled with plain SQL in the current schema, so rebuild them after a migration changes it.
+The load benchmark compares SQLite's old defaults with the shipped [database] settings.
+"""
+import argparse
+import asyncio
+import configparser
+import gc
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fuzzy.databases import AsyncDatabase, Database
+from fuzzy.models import DBUser, Infraction, InfractionType
+
+MIGRATIONS = str(ROOT / "fuzzy" / "migrations")
+
+# SQLite's own defaults, which Fuzzy used before the [database] tuning options existed
+BEFORE = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "cache_size": "-2000",
+    "mmap_size": "0",
+    "read_connections": "0",
+}
+
+
+def shipped_profile() -> dict:
+    """The [database] tuning of fuzzy.cfg.example."""
+    config = configparser.ConfigParser()
+    config.read(ROOT / "fuzzy.cfg.example")
+    return {
+        key: value
+        for key, value in config["database"].items()
+        if key not in ("path", "migrations")
+    }
+
+
+def build(path: Path, rows: int, users: int, same_user: bool = False) -> None:
+    """Creates the database at path with rows infractions of one guild, unless it exists."""
+    if path.exists():
+        return
+    Database({"database": {"path": str(path), "migrations": MIGRATIONS}}).conn.close()
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "INSERT INTO guilds (id, mod_log, public_log, duration_type, duration, mute_role) "
+        "VALUES (1, NULL, NULL, 3, 30, NULL)"
+    )
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO infractions (user_id, user_name, moderator_id, moderator_name, "
+        "guild_id, reason, infraction_on, infraction_type) VALUES (?,?,?,?,?,?,?,?)",
+        (
+            (
+                7 if same_user else random.randrange(users),
+                "user#0001",
+                random.randrange(50),
+                "mod#0001",
+                1,
+                "spam",
+                now - random.randrange(86400 * 300),
+                random.choice(["Warn", "Mute", "Ban"]),
+            )
+            for _ in range(rows)
+        ),
+    )
+    conn.execute(
+        "INSERT INTO pardons (infraction_id, moderator_id, moderator_name, pardon_on, reason) "
+        "SELECT oid, 3, 'mod#0002', infraction_on, 'ok' FROM infractions WHERE oid % 10 = 0"
+    )
+    conn.commit()
+    conn.close()
+
+
+async def load(path: Path, profile: dict, args) -> dict:
+    db = AsyncDatabase(
+        {"database": {"path": str(path), "migrations": MIGRATIONS, **profile}}
+    )
+    guild = await db.guilds.find_by_id(1)
+    stop = time.perf_counter() + args.seconds
+    latencies = []
+    write_latencies = []
+
+    async def reader():
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            await db.infractions.find_all_for_user(random.randrange(args.users), 1)
+            latencies.append(time.perf_counter() - started)
+
+    async def writer():
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            await db.infractions.save(
+                Infraction(
+                    None,
+                    DBUser(1, "user#0001"),
+                    DBUser(2, "mod#0001"),
+                    guild,
+                    "reason",
+                    datetime.utcnow(),
+                    InfractionType.WARN,
+                    None,
+                    None,
+                    None,
+                )
+            )
+            write_latencies.append(time.perf_counter() - started)
+            if args.write_rate:
+                await asyncio.sleep(1 / args.write_rate)
+
+    await asyncio.gather(
+        *(reader() for _ in range(args.readers)),
+        *(writer() for _ in range(args.writers)),
+    )
+    db.close()
+    return {
+        "reads/s": round(len(latencies) / args.seconds),
+        "writes/s": round(len(write_latencies) / args.seconds),
+        "median read ms": median_ms(latencies),
+        "median write ms": median_ms(write_latencies),
+    }
+
+
+def median_ms(latencies: list):
+    return round(statistics.median(latencies) * 1000, 1) if latencies else None
+
+
+def hydrate(path: Path, runs: int) -> dict:
+    db = Database({"database": {"path": str(path), "migrations": MIGRATIONS}})
+    best = float("inf")
+    for _ in range(runs):
+        gc.collect()
+        started = time.perf_counter()
+        result = db.infractions.find_all_for_user(7, 1)
+        best = min(best, time.perf_counter() - started)
+        del result
+    gc.collect()
+    tracemalloc.start()
+    result = db.infractions.find_all_for_user(7, 1)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "infractions": len(result),
+        f"best of {runs} ms": round(best * 1000),
+        "retained MB": round(retained / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("benchmark", choices=("load", "hydrate"))
+    parser.add_argument(
+        "--dir", type=Path, default=Path(tempfile.gettempdir()) / "fuzzy-benchmarks"
+    )
+    parser.add_argument("--rows", type=int, help="infractions in the database")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument(
+        "--write-rate",
+        type=float,
+        default=0,
+        help="writes per second of each writer, by default as many as possible",
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="[database] option for an extra load profile on top of the shipped one, "
+        "e.g. --set read_connections=4",
+    )
+    args = parser.parse_args()
+    args.dir.mkdir(exist_ok=True)
+
+    if args.benchmark == "hydrate":
+        rows = args.rows or 100_000
+        path = args.dir / f"hydrate-{rows}.db"
+        build(path, rows, 1, same_user=True)
+        print(hydrate(path, args.runs))
+        return
+
+    rows = args.rows or 2_000_000
+    path = args.dir / f"load-{rows}.db"
+    build(path, rows, args.users)
+    profiles = {"before": BEFORE, "shipped": shipped_profile()}
+    if args.set:
+        profiles["custom"] = {
+            **profiles["shipped"],
+            **dict(option.split("=", 1) for option in args.set),
+        }
+    for name, profile in profiles.items():
+        print(name, profile, asyncio.run(load(path, profile, args)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
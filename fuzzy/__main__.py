@@ -3,6 +3,7 @@ import logging
 import re
 import traceback
 from configparser import ConfigParser
+from datetime import datetime
 from importlib import metadata
 from string import Template
 from typing import Optional
@@ -12,9 +13,10 @@ from discord.ext import commands
 
 from fuzzy import cogs
 from fuzzy.customizations import Fuzzy
-from fuzzy.databases import Database
+from fuzzy.databases import AsyncDatabase
 from fuzzy.errors import AnticipatedError, PleaseRestate, Unauthorized
-from fuzzy.models import DurationType, GuildSettings
+from fuzzy.models import DurationType, GuildSettings, LogSinks
+from fuzzy.scheduling import ActionPriority
 
 config = ConfigParser()
 config.read("./fuzzy.cfg")
@@ -32,7 +34,7 @@ intents = discord.Intents.default()
 intents.members = True
 
 # noinspection PyTypeChecker
-database: Database = Database(config)
+database: AsyncDatabase = AsyncDatabase(config)
 
 bot = Fuzzy(
     config,
@@ -85,11 +87,12 @@ async def on_ready():
             command.help = process_docstrings(command.help)
 
         ONCE_LOCK = True
+        await bot.db.closed_dms.delete_before(datetime.utcnow() - bot.closed_dm_ttl)
         for guild in bot.guilds:
-            guild_settings = bot.db.guilds.find_by_id(guild.id)
+            guild_settings = await bot.db.guilds.find_by_id(guild.id)
             if not guild_settings:
                 # noinspection PyTypeChecker
-                bot.db.guilds.save(
+                await bot.db.guilds.save(
                     GuildSettings(
                         guild.id,
                         None,
@@ -97,6 +100,7 @@ async def on_ready():
                         DurationType.YEARS,
                         30,
                         None,
+                        LogSinks.CHANNEL,
                     )
                 )
 
@@ -111,12 +115,118 @@ async def ping(ctx):
     await ctx.send(embed=embed)
 
 
+@bot.command()
+@commands.is_owner()
+async def stats(ctx: Fuzzy.Context):
+    """Displays internal counters of the bot for monitoring. Only usable by the bot owner."""
+    guilds = bot.db.sync.guilds
+    embed = discord.Embed(title="**Stats**", color=ctx.Color.AUTOMATIC_BLUE)
+    embed.add_field(
+        name="Guild settings cache",
+        value=f"{len(guilds.cache)} guilds\n{guilds.hits} hits\n{guilds.misses} misses",
+    )
+    embed.add_field(
+        name="REST fallbacks",
+        value="\n".join(f"{count} {kind}" for kind, count in bot.rest_fallbacks.items())
+        or "none",
+    )
+    embed.add_field(
+        name="Action queue",
+        value="\n".join(
+            f"{priority.name.lower()}: {bot.actions.depth(priority)} queued, "
+            f"{bot.actions.mean_wait(priority):.2f}s avg wait, "
+            f"{bot.actions.max_wait[priority]:.2f}s max"
+            for priority in ActionPriority
+        )
+        + f"\n{len(bot.actions.busy)} routes busy",
+    )
+    embed.add_field(
+        name="Direct messages",
+        value=f"{bot.direct_messages.succeeded} delivered\n{bot.direct_messages.failed} failed\n"
+        f"{bot.direct_messages.retried} retries\n{len(bot.direct_messages)} pending, "
+        f"{bot.direct_messages.active} sending\n{bot.skipped_direct_messages} skipped, "
+        f"{len(bot.db.sync.closed_dms.cache)} users closed",
+    )
+    embed.add_field(
+        name="Mod log",
+        value=f"{bot.log_buffer.entries} entries\n{bot.log_buffer.messages} messages\n"
+        f"{sum(len(entries) for _, entries in bot.log_buffer.batches.values())} buffered",
+    )
+    embed.add_field(
+        name="Log sinks",
+        value="\n".join(
+            f"{kind.name.lower()}: {bot.log_router.sent[kind]} sent, "
+            f"{bot.log_router.failed[kind]} failed"
+            for kind in LogSinks
+        )
+        + f"\n{len(bot.log_router.sinks[LogSinks.WEBHOOK].pools)} webhook pools",
+    )
+    admin = bot.get_cog("Admin")
+    if admin:
+        embed.add_field(
+            name="Mute role overwrites",
+            value=f"{admin.overwrites_applied} applied\n{admin.overwrites_skipped} already set",
+        )
+    purges = bot.get_cog("Purges")
+    if purges:
+        purged = purges.purged
+        embed.add_field(
+            name="Purges",
+            value=f"{purged['bulk']} bulk deleted\n{purged['single']} deleted one by one\n"
+            f"{purged['failed']} failed\n{purged['scanned']} scanned",
+        )
+    mutes = bot.get_cog("Mutes")
+    if mutes:
+        embed.add_field(
+            name="Active mute index",
+            value=f"{len(bot.db.sync.mutes.index)} mutes\n{mutes.join_checks} joins checked\n"
+            f"{mutes.remutes} re-muted",
+        )
+    embed.add_field(
+        name="Role hierarchy cache",
+        value=f"{len(bot.hierarchy.guilds)} guilds\n{bot.hierarchy.hits} hits\n"
+        f"{bot.hierarchy.misses} misses\n{bot.hierarchy.invalidations} invalidations",
+    )
+    bans = bot.get_cog("Bans")
+    if bans:
+        embed.add_field(
+            name="Ban events",
+            value=f"{bans.ban_events['events']} events\n{bans.ban_events['batches']} batches\n"
+            f"{bans.ban_events['audit_log_reads']} audit log reads\n"
+            f"{bans.ban_events['unattributed']} unattributed",
+        )
+    backlog = bot.actions.backlog()
+    for name in ("Mutes", "Locks"):
+        cog = bot.get_cog(name)
+        if cog:
+            next_deadline = cog.expiry.next_deadline()
+            embed.add_field(
+                name=f"{name} expiry",
+                value=f"{len(cog.expiry)} pending\n{cog.expiry.expired} expired\n"
+                f"{cog.expiry.wakeups} wakeups\n"
+                f"lag: {cog.expiry.mean_lag():.2f}s avg, {cog.expiry.max_lag:.2f}s max\n"
+                f"{len(cog.expiry.pool)} queued\n"
+                f"{cog.expiry.overdue} left to catch up on\n"
+                f"next: {next_deadline or 'none'}",
+            )
+            backlog.update(cog.expiry.pool.backlog())
+    embed.add_field(
+        name="Backlog by guild",
+        value="\n".join(
+            f"{bot.get_guild(guild_id) or guild_id or 'direct messages'}: {count}"
+            for guild_id, count in backlog.most_common(5)
+        )
+        or "none",
+    )
+    await ctx.send(embed=embed)
+
+
 @bot.event
 async def on_guild_join(guild: discord.Guild):
-    guild_settings = bot.db.guilds.find_by_id(guild.id)
+    guild_settings = await bot.db.guilds.find_by_id(guild.id)
     if not guild_settings:
         # noinspection PyTypeChecker
-        bot.db.guilds.save(
+        await bot.db.guilds.save(
             GuildSettings(
                 guild.id,
                 None,
@@ -124,6 +234,7 @@ async def on_guild_join(guild: discord.Guild):
                 DurationType.YEARS,
                 30,
                 None,
+                LogSinks.CHANNEL,
             )
         )
 
@@ -275,6 +386,7 @@ async def on_command_error(ctx: Fuzzy.Context, error):
 
 def main():  # pylint: disable=missing-function-docstring
     bot.run(config["discord"]["token"])
+    database.close()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,27 @@
-from typing import Optional
+import asyncio
+import dataclasses
+from datetime import datetime
+from typing import List, Optional
 
 import discord
 from discord.ext import commands
 
 from fuzzy import Fuzzy
-from fuzzy.models import DurationType
+from fuzzy.customizations import ProgressMessage
+from fuzzy.models import DurationType, LogSinks
+from fuzzy.scheduling import ActionPriority
 
 
 class Admin(Fuzzy.Cog):
+    def __init__(self, *args):
+        super().__init__(*args)
+        # How many channel overwrites of the mute role are changed at the same time
+        self.permission_workers = self.bot.config["discord"].getint(
+            "permission_workers", 4
+        )
+        self.overwrites_applied = 0
+        self.overwrites_skipped = 0
+
     @commands.group()
     @commands.has_guild_permissions(manage_guild=True)
     async def admin(self, ctx: Fuzzy.Context):
@@ -20,9 +34,8 @@ class Admin(Fuzzy.Cog):
         `channel` is the channel to post the logs in. If left empty, Fuzzy uses the current channel."""
         if not channel:
             channel = ctx.channel
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
-        guild.mod_log = channel.id
-        ctx.db.guilds.save(guild)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        await ctx.db.guilds.save(dataclasses.replace(guild, mod_log=channel.id))
         await ctx.reply(f"Updated the mod log channel to {channel.mention}")
 
     @commands.command(parent=admin)
@@ -34,22 +47,51 @@ class Admin(Fuzzy.Cog):
         `channel` is the channel to post the logs in. If left empty, Fuzzy uses the current channel."""
         if not channel:
             channel = ctx.channel
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
-        guild.public_log = channel.id
-        ctx.db.guilds.save(guild)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        await ctx.db.guilds.save(dataclasses.replace(guild, public_log=channel.id))
         await ctx.reply(f"Updated the public log channel to {channel.mention}")
         await self.bot.post_log(
             ctx.guild,
             msg=f"{ctx.author.name}#{ctx.author.discriminator} updated public log channel to {channel.mention}",
         )
 
+    @commands.command(parent=admin)
+    @commands.has_guild_permissions(manage_guild=True)
+    async def log_sinks(self, ctx: Fuzzy.Context, *sinks: str):
+        """Updates where the logs are written to.
+        `sinks` is a space-separated list of `channel` to post them as Fuzzy, `webhook` to post them through
+        webhooks in the log channels, which doesn't slow down moderation when there's a lot to log, and `file` to
+        write them to Fuzzy's log file. If left empty, shows the current sinks."""
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        if not sinks:
+            await ctx.reply(f"Logs are written to: {self.describe(guild.log_sinks)}")
+            return
+        chosen = LogSinks(0)
+        for name in sinks:
+            try:
+                chosen |= LogSinks[name.upper()]
+            except KeyError:
+                raise commands.BadArgument(f"Unknown log sink {name}.")
+        await ctx.db.guilds.save(dataclasses.replace(guild, log_sinks=chosen))
+        # e.g. after the permission to manage webhooks was granted
+        self.bot.log_router.sinks[LogSinks.WEBHOOK].retry(ctx.guild.id)
+        await ctx.reply(f"Logs are written to: {self.describe(chosen)}")
+        await self.bot.post_log(
+            ctx.guild,
+            msg=f"{ctx.author.name}#{ctx.author.discriminator} updated log sinks to {self.describe(chosen)}",
+        )
+
+    @staticmethod
+    def describe(sinks: LogSinks) -> str:
+        return ", ".join(sink.name.lower() for sink in LogSinks if sink in sinks)
+
     @commands.command(parent=admin)
     @commands.has_guild_permissions(manage_guild=True)
     async def auto_pardon(self, ctx: Fuzzy.Context, time: str):
         """Updates how long till Infractions are auto pardoned.
         `time` is an amount followed by a letter to indicate type. I.E 6m would be 6 months.
         Can take (d)ays (m)onths or (y)ears."""
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
         duration_type = None
         if time[-1].lower() == "d":
             duration_type = DurationType.DAYS
@@ -57,15 +99,61 @@ class Admin(Fuzzy.Cog):
             duration_type = DurationType.MONTHS
         if time[-1].lower() == "y":
             duration_type = DurationType.YEARS
-        guild.duration_type = duration_type
-        guild.duration = int(time[:-1])
-        ctx.db.guilds.save(guild)
+        if not duration_type or not time[:-1].isdigit():
+            raise commands.BadArgument(
+                "Time has to be a number followed by d, m or y, i.e. 6m."
+            )
+        await ctx.db.guilds.save(
+            dataclasses.replace(
+                guild, duration_type=duration_type, duration=int(time[:-1])
+            )
+        )
         await ctx.reply(f"Infractions will auto pardon now after {time}")
         await self.bot.post_log(
             ctx.guild,
             msg=f"{ctx.author.name}#{ctx.author.discriminator} updated auto pardon to {time}",
         )
 
+    @commands.group(parent=admin)
+    @commands.has_guild_permissions(manage_guild=True)
+    async def closed_dms(self, ctx: Fuzzy.Context):
+        """Manages the members whose direct messages recently failed because they don't accept any. Fuzzy
+        doesn't try to message them again for a while."""
+
+    @commands.command(parent=closed_dms)
+    @commands.has_guild_permissions(manage_guild=True)
+    async def show(self, ctx: Fuzzy.Context):
+        """Lists the members of this server Fuzzy currently doesn't send direct messages to."""
+        since = datetime.utcnow() - self.bot.closed_dm_ttl
+        closed = [
+            f"{member.mention}: since {failed_on:%Y-%m-%d %H:%M} UTC"
+            for member, failed_on in self.closed_members(ctx.guild)
+            if failed_on > since
+        ]
+        await ctx.reply(
+            "\n".join(closed) or "Direct messages to all members are sent.",
+            title="Closed direct messages",
+        )
+
+    @commands.command(parent=closed_dms)
+    @commands.has_guild_permissions(manage_guild=True)
+    async def clear(self, ctx: Fuzzy.Context, who: commands.Greedy[discord.Member]):
+        """Lets Fuzzy try to send direct messages to members again, e.g. after they opened their DMs.
+        `who` is a space-separated list of members. If left empty, all members of this server are cleared."""
+        if not who:
+            who = [member for member, _ in self.closed_members(ctx.guild)]
+        async with ctx.db.transaction():
+            for member in who:
+                await ctx.db.closed_dms.delete(member.id)
+        await ctx.reply(f"Cleared closed direct messages of {len(who)} members.")
+
+    def closed_members(self, guild: discord.Guild):
+        """The members of the guild whose direct messages failed, with when they did."""
+        for user_id, failed_on in list(self.bot.db.sync.closed_dms.cache.items()):
+            member = guild.get_member(user_id)
+            if member:
+                yield member, failed_on
+
     @commands.group(parent=admin)
     @commands.has_guild_permissions(manage_guild=True)
     async def mutes(self, ctx: Fuzzy.Context):
@@ -77,9 +165,8 @@ class Admin(Fuzzy.Cog):
         """This will assign an already existing role as the role to use for muting a member.
         This is useful if you have used a different moderation bot previously and would like to reuse that role.
         `role` is a mention, id or name of a role to use for muting."""
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
-        guild.mute_role = role.id
-        ctx.db.guilds.save(guild)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        await ctx.db.guilds.save(dataclasses.replace(guild, mute_role=role.id))
         await ctx.reply(
             f"{self.bot.user.display_name} will now use {role.name} when muting someone."
         )
@@ -93,50 +180,19 @@ class Admin(Fuzzy.Cog):
     async def create(self, ctx: Fuzzy.Context):
         """This creates a new role for muting. It will go through every channel and category on the server and
         add this role as an override that blocks 'Send Messages' permissions"""
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
         role = await ctx.guild.create_role(name="Mute", color=0x818386)
-        guild.mute_role = role.id
-        ctx.db.guilds.save(guild)
-
-        channel_errors = []
-        for channel in ctx.guild.channels:
-            if (
-                isinstance(channel, discord.TextChannel)
-                and not channel.permissions_synced
-            ):
-                try:
-                    await channel.set_permissions(role, send_messages=False)
-                except discord.Forbidden:
-                    channel_errors.append(channel)
-        category_errors = []
-        for category in ctx.guild.categories:
-            try:
-                await category.set_permissions(role, send_messages=False)
-            except discord.Forbidden:
-                category_errors.append(category)
+        await ctx.db.guilds.save(dataclasses.replace(guild, mute_role=role.id))
+
+        errors = await self.apply_mute_role(ctx, role)
 
         await ctx.reply(
             f"{self.bot.user.display_name} will now use {role.mention} when muting someone."
         )
-        if category_errors or channel_errors:
+        if errors:
             await ctx.reply(
                 f"Failed to update the following due to mission permissions."
-                + (
-                    (
-                        f"\n**Categories:** "
-                        + ", ".join(category.name for category in category_errors)
-                    )
-                    if category_errors
-                    else ""
-                )
-                + (
-                    (
-                        f"\n**Channels:** "
-                        + " ".join(channel.mention for channel in channel_errors)
-                    )
-                    if channel_errors
-                    else ""
-                )
+                + self.describe_channels(errors)
             )
         await self.bot.post_log(
             ctx.guild,
@@ -148,27 +204,11 @@ class Admin(Fuzzy.Cog):
     async def refresh(self, ctx: Fuzzy.Context):
         """This refreshes the permissions of the mute role. It will go through every channel and
         category on the server and add this role as an override that blocks 'Send Messages' permissions"""
-        guild = ctx.db.guilds.find_by_id(ctx.guild.id)
+        guild = await ctx.db.guilds.find_by_id(ctx.guild.id)
         role = ctx.guild.get_role(guild.mute_role)
-        guild.mute_role = role.id
-        ctx.db.guilds.save(guild)
-        channel_errors = []
-        for channel in ctx.guild.channels:
-            if (
-                isinstance(channel, discord.TextChannel)
-                and not channel.permissions_synced
-            ):
-                try:
-                    await channel.set_permissions(role, send_messages=False)
-                except discord.Forbidden:
-                    channel_errors.append(channel)
-        category_errors = []
-        for category in ctx.guild.categories:
-            try:
-                await category.set_permissions(role, send_messages=False)
-            except discord.Forbidden:
-                category_errors.append(category)
-        if not channel_errors and not category_errors:
+        await ctx.db.guilds.save(dataclasses.replace(guild, mute_role=role.id))
+        errors = await self.apply_mute_role(ctx, role)
+        if not errors:
             await ctx.reply(
                 f"{role.mention} permissions have been refreshed on the server. If issues persist "
                 f" check if a role the user has gives them explict 'Send Messages' permissions"
@@ -176,24 +216,105 @@ class Admin(Fuzzy.Cog):
         else:
             await ctx.reply(
                 f"Failed to update the following due to mission permissions."
-                + (
-                    (
-                        f"\n**Categories:** "
-                        + ", ".join(category.name for category in category_errors)
-                    )
-                    if category_errors
-                    else ""
-                )
-                + (
-                    (
-                        f"\n**Channels:** "
-                        + " ".join(channel.mention for channel in channel_errors)
-                    )
-                    if channel_errors
-                    else ""
-                )
+                + self.describe_channels(errors)
             )
         await self.bot.post_log(
             ctx.guild,
             msg=f"{ctx.author.name}#{ctx.author.discriminator} refreshed permissions on {role.name}",
         )
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        """Lets the mute role deny sending messages in new channels, unless they inherited that."""
+        guild = await self.bot.db.guilds.find_by_id(channel.guild.id)
+        role = channel.guild.get_role(guild.mute_role) if guild else None
+        if role and self.needs_mute_overwrite(channel, role):
+            try:
+                await self.set_mute_overwrite(channel, role)
+            except discord.HTTPException as ex:
+                self.log.info(f"Couldn't add mute role to {channel}: {ex}")
+
+    @staticmethod
+    def needs_mute_overwrite(
+        channel: discord.abc.GuildChannel, role: discord.Role
+    ) -> bool:
+        return (
+            isinstance(channel, (discord.TextChannel, discord.CategoryChannel))
+            and channel.overwrites_for(role).send_messages is not False
+        )
+
+    async def set_mute_overwrite(
+        self, channel: discord.abc.GuildChannel, role: discord.Role
+    ):
+        """Denies the role sending messages, keeping the rest of its overwrite."""
+        overwrite = channel.overwrites_for(role)
+        overwrite.send_messages = False
+        await self.bot.actions.submit(
+            ActionPriority.MODERATION,
+            channel.guild.id,
+            ("channel_permissions", channel.id),
+            channel.set_permissions,
+            role,
+            overwrite=overwrite,
+        )
+        self.overwrites_applied += 1
+
+    async def apply_mute_role(
+        self, ctx: Fuzzy.Context, role: discord.Role
+    ) -> List[discord.abc.GuildChannel]:
+        """
+        Makes the mute role deny sending messages in every category and text channel, returning the
+        ones that couldn't be updated. Only the overwrites that differ are changed, which also
+        skips the channels synced with a category that already had it, and only a few at a time so
+        the guild's other actions don't queue behind all of them.
+        """
+        outdated = [
+            channel
+            for channel in ctx.guild.categories + ctx.guild.text_channels
+            if self.needs_mute_overwrite(channel, role)
+        ]
+        self.overwrites_skipped += (
+            len(ctx.guild.categories) + len(ctx.guild.text_channels) - len(outdated)
+        )
+        slots = asyncio.Semaphore(self.permission_workers)
+        errors = []
+
+        async def update(channel: discord.abc.GuildChannel):
+            async with slots:
+                try:
+                    await self.set_mute_overwrite(channel, role)
+                except discord.HTTPException:
+                    errors.append(channel)
+                    progress.advance(False)
+                else:
+                    progress.advance()
+
+        async with ProgressMessage(
+            ctx, "Updating channel permissions", len(outdated)
+        ) as progress:
+            await asyncio.gather(*(update(channel) for channel in outdated))
+        return errors
+
+    @staticmethod
+    def describe_channels(channels: List[discord.abc.GuildChannel]) -> str:
+        categories = [
+            channel
+            for channel in channels
+            if isinstance(channel, discord.CategoryChannel)
+        ]
+        text_channels = [channel for channel in channels if channel not in categories]
+        return (
+            (
+                f"\n**Categories:** "
+                + ", ".join(category.name for category in categories)
+            )
+            if categories
+            else ""
+        ) + (
+            (
+                f"\n**Channels:** "
+                + " ".join(channel.mention for channel in text_channels)
+            )
+            if text_channels
+            else ""
+        )
@@ -1,5 +1,7 @@
 import asyncio
+import re
 import typing
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -7,35 +9,87 @@ import discord
 from discord.ext import commands
 
 from fuzzy import Fuzzy
+from fuzzy.customizations import ProgressMessage
 from fuzzy.models import DBUser, Infraction, InfractionType
+from fuzzy.scheduling import ActionPriority
+
+# Whom a command bans or unbans, users in attached ID lists may be known by ID only
+Target = typing.Union[discord.Member, discord.User, discord.Object]
 
 
 class Bans(Fuzzy.Cog):
+    # Snowflakes in attached ID lists, and how large such a list may be
+    USER_ID = re.compile(r"\b\d{15,21}\b")
+    MAX_ID_FILE_SIZE = 1_000_000
+    # How many ban audit log entries (100 per page) are read at most to attribute a batch of bans
+    MAX_AUDIT_LOG_ENTRIES = 1000
+    # Seconds the event of a ban made with the ban command is waited for before it's forgotten
+    OWN_BAN_GRACE = 60
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        settings = self.bot.config["discord"]
+        self.dm_wait = settings.getfloat("ban_dm_wait", 5.0)
+        # Seconds to collect a guild's ban events before recording them together
+        self.event_window = settings.getfloat("ban_event_window", 2.0)
+        # Banned users waiting to be recorded and the task recording them, per guild
+        self.pending_bans: typing.Dict[int, typing.Dict[int, discord.User]] = {}
+        self.ingestion: typing.Dict[int, asyncio.Task] = {}
+        # Infractions of the bans made with the ban command whose events weren't recorded yet, per
+        # guild and user. A mass ban may take minutes, so they're not looked up by their time.
+        self.own_bans: typing.Dict[int, typing.Dict[int, Infraction]] = {}
+        # ban events, batches, audit log reads and bans without a matching audit log entry
+        self.ban_events = Counter()
+
     @commands.Cog.listener()
     async def on_member_ban(self, guild: discord.Guild, user: discord.User):
-        """Posts a ban to the Log channel. Checks to see if Fuzzy was used for ban and if not, creates a new
-        infraction log."""
-        await asyncio.sleep(0.5)
-
-        infraction = self.bot.db.infractions.find_recent_ban_by_id_time_limited(user.id, guild.id)
-        if not infraction:
-            async for entry in guild.audit_logs(limit=10,
-                                                oldest_first=False,
-                                                after=(datetime.utcnow() - timedelta(minutes=1)),
-                                                action=discord.AuditLogAction.ban):
-                if entry.target.id == user.id:
+        """Queues a ban to be posted to the Log channel. Bans arriving in a burst, i.e. a raid being banned by
+        another bot, are recorded together."""
+        self.ban_events["events"] += 1
+        self.pending_bans.setdefault(guild.id, {})[user.id] = user
+        if guild.id not in self.ingestion:
+            self.ingestion[guild.id] = asyncio.get_event_loop().create_task(self.ingest_bans(guild))
 
+    async def ingest_bans(self, guild: discord.Guild):
+        """Posts the bans of a guild collected over the event window to the Log channel. Checks to see if Fuzzy was
+        used for them and if not, creates new infraction logs from one pass over the audit log."""
+        since = datetime.utcnow() - timedelta(minutes=1)
+        await asyncio.sleep(self.event_window)
+        # Bans arriving from here on start the next batch.
+        del self.ingestion[guild.id]
+        users = self.pending_bans.pop(guild.id)
+        self.ban_events["batches"] += 1
+        try:
+            own_bans = self.own_bans.get(guild.id, {})
+            infractions = {user_id: own_bans.pop(user_id) for user_id in users if user_id in own_bans}
+            if not own_bans:
+                self.own_bans.pop(guild.id, None)
+            # Bans of users only known by ID get their name now, as do users renamed since.
+            to_save = []
+            for user_id, infraction in infractions.items():
+                name = f"{users[user_id].name}#{users[user_id].discriminator}"
+                if infraction.user.name != name:
+                    infraction.user = DBUser(user_id, name)
+                    to_save.append(infraction)
+            missing = [user for user_id, user in users.items() if user_id not in infractions]
+            if missing:
+                entries = await self.find_ban_entries(guild, [user.id for user in missing], since)
+                guild_settings = await self.bot.db.guilds.find_by_id(guild.id)
+                for user in missing:
+                    entry = entries.get(user.id)
                     # noinspection PyTypeChecker
                     mod = DBUser(0, "Unknown#????")
-                    if not entry.user.bot:
+                    if not entry:
+                        self.ban_events["unattributed"] += 1
+                    elif not entry.user.bot:
                         mod = DBUser(entry.user.id, f"{entry.user.name}#{entry.user.discriminator}")
-                    infraction = self.bot.db.infractions.save(
+                    to_save.append(
                         Infraction(
                             None,
                             DBUser(user.id, f"{user.name}#{user.discriminator}"),
                             mod,
-                            self.bot.db.guilds.find_by_id(guild.id),
-                            f"{entry.reason}",
+                            guild_settings,
+                            (entry.reason if entry else None) or "",
                             datetime.utcnow(),
                             InfractionType.BAN,
                             None,
@@ -43,30 +97,71 @@ class Bans(Fuzzy.Cog):
                             None,
                         )
                     )
+            for infraction in await self.bot.db.infractions.save_all(to_save):
+                if infraction:
+                    infractions[infraction.user.id] = infraction
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception(f"Failed to record {len(users)} bans on {guild}")
+            return
+
+        for user_id in users:
+            infraction = infractions.get(user_id)
+            if not infraction:
+                continue
+            msg = (
+                f"**Banned:** {infraction.user.name} (ID {infraction.user.id})\n"
+                f"**Mod:** <@{infraction.moderator.id}>\n"
+                f"**Reason:** {infraction.reason or '(no reason specified)'}\n"
+            )
+            msg += (
+                f"This can be published to the published to the public log channel with "
+                f"`{self.bot.command_prefix}publish ban {infraction.id}`"
+                if infraction.reason
+                else f"Reason can be updated with "
+                f"`{self.bot.command_prefix}reason {infraction.id} <your reason here>`"
+            )
+            await self.bot.post_log(
+                guild,
+                title=f"Ban #{infraction.id}",
+                msg=msg,
+                color=self.bot.Context.Color.BAD,
+            )
+
+    def forget_own_ban(self, guild_id: int, user_id: int, infraction: Infraction):
+        own_bans = self.own_bans.get(guild_id, {})
+        if own_bans.get(user_id) is infraction:
+            del own_bans[user_id]
+            if not own_bans:
+                del self.own_bans[guild_id]
+
+    async def find_ban_entries(
+        self, guild: discord.Guild, user_ids: typing.List[int], since: datetime
+    ) -> typing.Dict[int, discord.AuditLogEntry]:
+        """The most recent audit log entries banning the users, read page by page until all of them are found,
+        the entries get older than `since` or MAX_AUDIT_LOG_ENTRIES were read."""
+        pending = set(user_ids)
+        entries = {}
+        self.ban_events["audit_log_reads"] += 1
+        try:
+            # Newest first, discord.py ignores `after` in that order, so the age is checked here.
+            async for entry in guild.audit_logs(
+                limit=self.MAX_AUDIT_LOG_ENTRIES, oldest_first=False, action=discord.AuditLogAction.ban
+            ):
+                if entry.created_at < since:
                     break
-        msg = (
-            f"**Banned:** {infraction.user.name} (ID {infraction.user.id})\n"
-            f"**Mod:** <@{infraction.moderator.id}>\n"
-            f"**Reason:** {infraction.reason or '(no reason specified)'}\n"
-        )
-        msg += (
-            f"This can be published to the published to the public log channel with "
-            f"`{self.bot.command_prefix}publish ban {infraction.id}`"
-            if infraction.reason
-            else f"Reason can be updated with "
-            f"`{self.bot.command_prefix}reason {infraction.id} <your reason here>`"
-        )
-        await self.bot.post_log(
-            guild,
-            title=f"Ban #{infraction.id}",
-            msg=msg,
-            color=self.bot.Context.Color.BAD,
-        )
+                if entry.target and entry.target.id in pending:
+                    pending.discard(entry.target.id)
+                    entries[entry.target.id] = entry
+                    if not pending:
+                        break
+        except discord.HTTPException as ex:
+            self.log.info(f"Couldn't read the audit log of {guild}: {ex}")
+        return entries
 
     @commands.Cog.listener()
     async def on_member_unban(self, guild: discord.Guild, user: discord.User):
         """Posts an unban to the Log channel."""
-        infraction = self.bot.db.infractions.find_recent_ban_by_id(user.id, guild.id)
+        infraction = await self.bot.db.infractions.find_recent_ban_by_id(user.id, guild.id)
 
         await self.bot.post_log(
             guild,
@@ -82,82 +177,154 @@ class Bans(Fuzzy.Cog):
     async def ban(
         self,
         ctx: Fuzzy.Context,
-        who: typing.Union[discord.Member, discord.User],
+        who: commands.Greedy[typing.Union[discord.Member, discord.User]],
         *,
         reason: Optional[str] = "",
     ):
-        """Bans a user from the server.
-        `who` is a space-separated list of users. This can be mentions, ids or names.
+        """Bans users from the server.
+        `who` is a space-separated list of users. This can be mentions, ids or names. Text files with user IDs can
+        be attached to the message as well, e.g. to ban all accounts of a raid at once.
         `reason` is the reason for the ban. This can be updated later with ${pfx}reason"""
-        infraction = None
+        targets = await self.collect_targets(ctx, who)
+        if not targets:
+            raise commands.BadArgument("Could not find any users to ban.")
+        if any(user.id == ctx.author.id for user in targets):
+            await ctx.reply("You cant ban yourself.")
+        targets = [user for user in targets if user.id != ctx.author.id]
         insufficient_permissions = []
-        if await self.check_if_can_ban(who):
-            if who.id != ctx.author.id:
-                infraction = Infraction.create(
-                    ctx, who, reason, InfractionType.BAN
+        allowed = []
+        for user, can_ban in zip(targets, self.bot.hierarchy.can_moderate(ctx.guild, targets)):
+            if can_ban:
+                allowed.append(user)
+            else:
+                insufficient_permissions.append(user)
+
+        # All infractions are stored in one transaction, the bans follow once they're committed.
+        guild_settings = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        new_bans = []
+        async with ctx.db.transaction():
+            for user in allowed:
+                infraction = await ctx.db.infractions.save(
+                    Infraction.create(ctx, user, reason, InfractionType.BAN, guild_settings)
                 )
-                infraction = ctx.db.infractions.save(infraction)
                 if infraction:
-                    try:
-                        await self.bot.direct_message(
-                            who,
-                            title=f"Ban ID {infraction.id}",
-                            msg=f"You have been banned from {ctx.guild.name} "
-                            + (f'for "{reason}"' if reason else ""),
-                        )
-                    except discord.Forbidden or discord.HTTPException:
-                        pass
-                try:
-                    await ctx.guild.ban(who, reason=reason, delete_message_days=0)
-                except discord.Forbidden:
-                    pass
+                    new_bans.append((user, infraction))
+        for user, infraction in new_bans:
+            self.own_bans.setdefault(ctx.guild.id, {})[user.id] = infraction
 
+        banned_users = []
+        errors = []
+        deliveries = []
+
+        async def execute(user: Target, infraction: Infraction):
+            # Users only known by ID can't be messaged without looking them up first.
+            if not isinstance(user, discord.Object):
+                delivery = self.bot.direct_message(
+                    user,
+                    title=f"Ban ID {infraction.id}",
+                    msg=f"You have been banned from {ctx.guild.name} "
+                    + (f'for "{reason}"' if reason else ""),
+                )
+                deliveries.append((user, delivery))
+                # Users can't be messaged once they share no server with the bot anymore, so the ban
+                # waits a little for the message to arrive.
+                await asyncio.wait([delivery], timeout=self.dm_wait)
+            try:
+                await self.bot.actions.submit(
+                    ActionPriority.MODERATION,
+                    ctx.guild.id,
+                    ("ban", ctx.guild.id),
+                    ctx.guild.ban,
+                    user,
+                    reason=reason,
+                    delete_message_days=0,
+                )
+            except discord.HTTPException:
+                self.forget_own_ban(ctx.guild.id, user.id, infraction)
+                await ctx.db.infractions.delete(infraction.id)
+                errors.append(user)
+                progress.advance(False)
             else:
-                await ctx.reply("You cant ban yourself.")
-        else:
-            insufficient_permissions.append(who)
-        if infraction:
+                asyncio.get_event_loop().call_later(
+                    self.OWN_BAN_GRACE, self.forget_own_ban, ctx.guild.id, user.id, infraction
+                )
+                banned_users.append(
+                    f"{mention(user) if isinstance(user, discord.Object) else infraction.user.name}: "
+                    f"Ban ID {infraction.id}"
+                )
+                progress.advance()
+
+        async with ProgressMessage(ctx, "Banning", len(new_bans)) as progress:
+            await asyncio.gather(*(execute(user, infraction) for user, infraction in new_bans))
+        self.bot.report_undelivered(ctx, deliveries)
+
+        if banned_users:
             await ctx.reply(
                 title="Banned",
-                msg=(f"**Reason:** {reason}\n" if reason else "") + f"{infraction.user.name}: Ban ID {infraction.id}",
+                msg=(f"**Reason:** {reason}\n" if reason else "") + "\n".join(banned_users),
                 color=ctx.Color.BAD,
             )
+        if errors:
+            await ctx.reply(
+                f"Error banning the following users: {' '.join(mention(user) for user in errors)}"
+            )
         if insufficient_permissions:
             await ctx.reply(
                 f"Insufficient permissions to ban the following users: "
-                f"{' '.join(user.mention for user in insufficient_permissions)}"
+                f"{' '.join(mention(user) for user in insufficient_permissions)}"
             )
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
     async def unban(self, ctx: Fuzzy.Context, who: commands.Greedy[discord.User]):
-        """Unbans a user from the server. This does not pardon the infraction automatically. use ${pfx}pardon to
+        """Unbans users from the server. This does not pardon the infraction automatically. use ${pfx}pardon to
         do that.
-        `who` is a space-separated list of users. This can be mentions, ids or names."""
+        `who` is a space-separated list of users. This can be mentions, ids or names. Text files with user IDs can
+        be attached to the message as well."""
+        users = await self.collect_targets(ctx, who)
+        if not users:
+            raise commands.BadArgument("Could not find any users to unban.")
         unbanned_users = []
         errors = []
-        for user in who:  # type: discord.User
+        deliveries = []
+
+        async def execute(user: Target):
             try:
-                await ctx.guild.unban(user)
-            except discord.NotFound or discord.HTTPException:
+                await self.bot.actions.submit(
+                    ActionPriority.MODERATION,
+                    ctx.guild.id,
+                    ("unban", ctx.guild.id),
+                    ctx.guild.unban,
+                    user,
+                )
+            except discord.HTTPException:
                 errors.append(user)
-            else:
-                infraction = ctx.db.infractions.find_recent_ban_by_id(user.id, ctx.guild.id)
-                if infraction:
-                    unbanned_users.append(f"{infraction.user.name}: Ban ID {infraction.id}")
-                    try:
-                        await self.bot.direct_message(
+                progress.advance(False)
+                return
+            progress.advance()
+            infraction = await ctx.db.infractions.find_recent_ban_by_id(user.id, ctx.guild.id)
+            if infraction:
+                unbanned_users.append(f"{infraction.user.name}: Ban ID {infraction.id}")
+            if infraction and not isinstance(user, discord.Object):
+                deliveries.append(
+                    (
+                        user,
+                        self.bot.direct_message(
                             user,
                             title=f"Unban ID {infraction.id}",
                             msg=f"You have been unbanned from {ctx.guild.name}",
-                        )
-                    except discord.Forbidden or discord.HTTPException:
-                        pass
+                        ),
+                    )
+                )
+
+        async with ProgressMessage(ctx, "Unbanning", len(users)) as progress:
+            await asyncio.gather(*(execute(user) for user in users))
+        self.bot.report_undelivered(ctx, deliveries)
 
         if errors:
             msg = ""
             for user in errors:
-                msg += f"{user.mention} "
+                msg += f"{mention(user)} "
             await ctx.reply(f"Error unbanning the following users: {msg}")
         if unbanned_users:
             unban_string = "\n".join(unbanned_users)
@@ -167,17 +334,26 @@ class Bans(Fuzzy.Cog):
                 color=ctx.Color.GOOD,
             )
 
-    async def check_if_can_ban(
-        self, member: typing.Union[discord.Member, discord.User]
-    ):
-        if isinstance(member, discord.User):
-            return True
-        guild: discord.Guild = member.guild
-        bot_member_account: discord.Member = await member.guild.fetch_member(
-            self.bot.user.id
-        )
-        return (
-            guild.roles.index(bot_member_account.roles[-1])
-            > guild.roles.index(member.roles[-1])
-            and guild.owner_id != member.id
-        )
+    async def collect_targets(
+        self, ctx: Fuzzy.Context, who: typing.List[typing.Union[discord.Member, discord.User]]
+    ) -> typing.List[Target]:
+        """The users given as arguments and by ID in text files attached to the command, without
+        duplicates. Attached users that aren't cached stay a discord.Object of their ID, looking
+        up hundreds of raid accounts one by one isn't needed to ban them."""
+        users = {user.id: user for user in who}
+        for attachment in ctx.message.attachments:
+            if attachment.size <= self.MAX_ID_FILE_SIZE:
+                text = (await attachment.read()).decode(errors="ignore")
+                for user_id in map(int, self.USER_ID.findall(text)):
+                    if user_id not in users:
+                        users[user_id] = (
+                            ctx.guild.get_member(user_id)
+                            or self.bot.get_user(user_id)
+                            or discord.Object(user_id)
+                        )
+        return list(users.values())
+
+
+def mention(user: Target) -> str:
+    """Mentions the user, also if only their ID is known."""
+    return f"<@{user.id}>"
@@ -23,7 +23,7 @@ class InfractionAdmin(Fuzzy.Cog):
         `infraction_ids` is the Infraction ID that is to be pardoned
         """
         all_errors = []
-        infraction: Infraction = ctx.db.infractions.find_by_id(
+        infraction: Infraction = await ctx.db.infractions.find_by_id(
             infraction_id, ctx.guild.id
         )
         if not infraction:
@@ -35,17 +35,17 @@ class InfractionAdmin(Fuzzy.Cog):
             and infraction.published_unban
         ):
             channel: discord.TextChannel = ctx.guild.get_channel(
-                ctx.db.guilds.find_by_id(ctx.guild.id).public_log
+                (await ctx.db.guilds.find_by_id(ctx.guild.id)).public_log
             )
             message: discord.Message = await channel.fetch_message(
                 infraction.published_unban.message_id
             )
             if message:
-                await message.edit(
-                    embed=InfractionAdmin.create_unban_embed(infraction)
+                await ctx.bot.log_router.edit(
+                    message, InfractionAdmin.create_unban_embed(infraction)
                 )
             else:
-                ctx.db.published_messages.delete_with_type(
+                await ctx.db.published_messages.delete_with_type(
                     infraction.id, infraction.published_unban.publish_type
                 )
                 infraction.published_ban = None
@@ -57,7 +57,7 @@ class InfractionAdmin(Fuzzy.Cog):
                 datetime.utcnow(),
                 reason,
             )
-        pardon = ctx.db.pardons.save(pardon)
+        pardon = await ctx.db.pardons.save(pardon)
         if pardon:
             infraction.pardon = pardon
         else:
@@ -87,7 +87,7 @@ class InfractionAdmin(Fuzzy.Cog):
         all_infractions = []
         all_errors = []
         for infraction_id in infraction_ids:
-            infraction: Infraction = ctx.db.infractions.find_by_id(
+            infraction: Infraction = await ctx.db.infractions.find_by_id(
                 infraction_id, ctx.guild.id
             )
             if infraction:
@@ -97,10 +97,11 @@ class InfractionAdmin(Fuzzy.Cog):
         if not all_infractions:
             raise UnableToComply("Could not find any Infractions with those IDs.")
 
-        for infraction in all_infractions:
-            if infraction.pardon:
-                ctx.db.pardons.delete(infraction.id)
-            ctx.db.infractions.delete(infraction.id)
+        async with ctx.db.transaction():
+            for infraction in all_infractions:
+                if infraction.pardon:
+                    await ctx.db.pardons.delete(infraction.id)
+                await ctx.db.infractions.delete(infraction.id)
         if all_errors:
             msg = "Error forgetting: " + " ".join(all_errors)
             await ctx.reply(msg, color=ctx.Color.I_GUESS)
@@ -127,7 +128,7 @@ class InfractionAdmin(Fuzzy.Cog):
         `infraction_id` is the ID of the Infraction that is to updated.
         `reason` is the new reason to be saved to these infractions
         """
-        infraction: Infraction = ctx.db.infractions.find_by_id(
+        infraction: Infraction = await ctx.db.infractions.find_by_id(
             infraction_id, ctx.guild.id
         )
         if not infraction:
@@ -138,25 +139,25 @@ class InfractionAdmin(Fuzzy.Cog):
             infraction.moderator.name = (
                 f"{ctx.author.name}#{ctx.author.discriminator}"
             )
-        ctx.db.infractions.save(infraction)
+        await ctx.db.infractions.save(infraction)
         if (
             infraction.infraction_type.value == InfractionType.BAN.value
             and infraction.published_ban
         ):
             channel: discord.TextChannel = ctx.guild.get_channel(
-                ctx.db.guilds.find_by_id(ctx.guild.id).public_log
+                (await ctx.db.guilds.find_by_id(ctx.guild.id)).public_log
             )
             # noinspection PyUnresolvedReferences
             message: discord.Message = await channel.fetch_message(
                 infraction.published_ban.message_id
             )
             if message:
-                await message.edit(
-                    embed=InfractionAdmin.create_ban_embed(infraction)
+                await ctx.bot.log_router.edit(
+                    message, InfractionAdmin.create_ban_embed(infraction)
                 )
             else:
                 # noinspection PyUnresolvedReferences
-                ctx.db.published_messages.delete_with_type(
+                await ctx.db.published_messages.delete_with_type(
                     infraction.id, infraction.published_ban.publish_type
                 )
                 infraction.published_ban = None
@@ -185,7 +186,7 @@ class InfractionAdmin(Fuzzy.Cog):
         all_errors = []
 
         for infraction_id in infraction_ids:
-            infraction: Infraction = ctx.db.infractions.find_by_id(
+            infraction: Infraction = await ctx.db.infractions.find_by_id(
                 infraction_id, ctx.guild.id
             )
             if (
@@ -213,11 +214,11 @@ class InfractionAdmin(Fuzzy.Cog):
                 )
             await ctx.reply(msg, color=ctx.Color.I_GUESS)
 
-        guild: GuildSettings = ctx.db.guilds.find_by_id(ctx.guild.id)
+        guild: GuildSettings = await ctx.db.guilds.find_by_id(ctx.guild.id)
         # noinspection PyTypeChecker
         channel: discord.TextChannel = None
         if guild.public_log:
-            channel = await ctx.bot.fetch_channel(guild.public_log)
+            channel = await ctx.bot.resolve_channel(guild.public_log)
         if channel is None:
             await ctx.reply(msg="Error Fetching Public Log Channel")
             return
@@ -225,10 +226,12 @@ class InfractionAdmin(Fuzzy.Cog):
         all_published_bans = []
         all_message_errors = []
         for ban in all_bans:
-            message = await channel.send(embed=InfractionAdmin.create_ban_embed(ban))
+            message = await ctx.bot.log_router.publish(
+                channel, InfractionAdmin.create_ban_embed(ban)
+            )
             if message:
                 all_published_bans.append(
-                    ctx.db.published_messages.save(
+                    await ctx.db.published_messages.save(
                         PublishedMessage(ban.id, message.id, PublishType.BAN)
                     )
                 )
@@ -269,7 +272,7 @@ class InfractionAdmin(Fuzzy.Cog):
         all_errors = []
 
         for infraction_id in infraction_ids:
-            infraction: Infraction = ctx.db.infractions.find_by_id(
+            infraction: Infraction = await ctx.db.infractions.find_by_id(
                 infraction_id, ctx.guild.id
             )
             if (
@@ -306,11 +309,11 @@ class InfractionAdmin(Fuzzy.Cog):
                 )
             await ctx.reply(msg, color=ctx.Color.I_GUESS)
 
-        guild: GuildSettings = ctx.db.guilds.find_by_id(ctx.guild.id)
+        guild: GuildSettings = await ctx.db.guilds.find_by_id(ctx.guild.id)
         # noinspection PyTypeChecker
         channel: discord.TextChannel = None
         if guild.public_log:
-            channel = await ctx.bot.fetch_channel(guild.public_log)
+            channel = await ctx.bot.resolve_channel(guild.public_log)
         if channel is None:
             await ctx.reply(msg="Error Fetching Public Log Channel")
             return
@@ -318,10 +321,12 @@ class InfractionAdmin(Fuzzy.Cog):
         all_published_unbans = []
         all_message_errors = []
         for ban in all_unbans:
-            message = await channel.send(embed=InfractionAdmin.create_unban_embed(ban))
+            message = await ctx.bot.log_router.publish(
+                channel, InfractionAdmin.create_unban_embed(ban)
+            )
             if message:
                 all_published_unbans.append(
-                    ctx.db.published_messages.save(
+                    await ctx.db.published_messages.save(
                         PublishedMessage(ban.id, message.id, PublishType.UNBAN)
                     )
                 )
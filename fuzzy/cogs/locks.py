@@ -1,42 +1,75 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Optional
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from fuzzy import Fuzzy
-from fuzzy.customizations import ParseableTimedelta
+from fuzzy.customizations import CatchUpLog, ParseableTimedelta
 from fuzzy.models import DBUser, Lock
+from fuzzy.scheduling import ActionPriority, ExpiryScheduler
 
 
 class Locks(Fuzzy.Cog):
     def __init__(self, *args):
-        self.execute_expired_locks.start()  # pylint: disable=no-member
         super().__init__(*args)
+        settings = self.bot.config["discord"]
+        self.expiry = ExpiryScheduler(
+            self.log,
+            self.bot.db.locks.find_end_times,
+            self.execute_expired_lock,
+            settings.getint("expiry_workers", 8),
+            CatchUpLog(self.bot, "channel locks").report,
+            settings.getfloat("catch_up_rate", 5.0),
+            settings.getint("catch_up_chunk", 50),
+            settings.getint("expiry_guild_workers", 2),
+        )
+        self.expiry.start()
+
+    def cog_unload(self):
+        self.expiry.stop()
 
-    @tasks.loop(seconds=0.5)
-    async def execute_expired_locks(self):
-        """Finds expired locks and unlocks them."""
-        locks: List[Lock] = self.bot.db.locks.find_expired_locks()
-        for lock in locks:
-            guild: discord.Guild = self.bot.get_guild(lock.guild.id)
-            # noinspection PyTypeChecker
-            channel: discord.TextChannel = None
-            # noinspection PyTypeChecker
-            everyone_role: discord.Role = None
-            if guild:
-                channel = guild.get_channel(lock.channel_id)
-                everyone_role = guild.get_role(lock.guild.id)
-            if channel and everyone_role:
-                await channel.set_permissions(
-                    everyone_role, send_messages=lock.previous_value
+    async def execute_expired_lock(self, channel_id: int):
+        """Unlocks a channel whose lock expired."""
+        lock: Lock = await self.bot.db.locks.find_by_id(channel_id)
+        # the channel may have been locked again since this deadline was taken
+        if not lock or lock.end_time > datetime.utcnow():
+            return
+        guild: discord.Guild = await self.bot.resolve_guild(lock.guild.id)
+        # noinspection PyTypeChecker
+        channel: discord.TextChannel = None
+        # noinspection PyTypeChecker
+        everyone_role: discord.Role = None
+        if guild:
+            channel = guild.get_channel(lock.channel_id)
+            everyone_role = guild.get_role(lock.guild.id)
+        if not channel:
+            # gone along with the channel or the guild, there's nothing left to unlock
+            await self.bot.db.locks.delete(lock.channel_id)
+            return
+        msg = f"{channel.mention} was unlocked by {self.bot.user.display_name}"
+        color = self.bot.Context.Color.GOOD
+        if everyone_role:
+            try:
+                await self.bot.actions.submit(
+                    ActionPriority.MODERATION,
+                    guild.id,
+                    ("channel_permissions", channel.id),
+                    channel.set_permissions,
+                    everyone_role,
+                    send_messages=lock.previous_value,
                 )
-            await self.bot.post_log(
-                guild,
-                msg=f"{channel.mention} was unlocked by {self.bot.user.display_name}",
-                color=self.bot.Context.Color.GOOD,
-            )
-            self.bot.db.locks.delete(lock.channel_id)
+            except discord.HTTPException as ex:
+                # discord.py already retried what's worth retrying, e.g. the bot lost its
+                # permissions. The lock is still deleted, it would only fail the same way later.
+                self.log.warning(f"Couldn't unlock {channel}: {ex}")
+                msg = (
+                    f"{channel.mention} lock expired, "
+                    f"but it couldn't be unlocked: {ex.text}"
+                )
+                color = self.bot.Context.Color.I_GUESS
+        await self.bot.db.locks.delete(lock.channel_id)
+        await self.bot.post_log(guild, msg=msg, color=color)
 
     @commands.command()
     async def lock(
@@ -62,19 +95,29 @@ class Locks(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to lock channel.")
             return
         if channel in ctx.guild.channels:
-            lock = ctx.db.locks.save(
+            end_time = datetime.utcnow() + time
+            lock = await ctx.db.locks.save(
                 Lock(
                     channel.id or ctx.channel.id,
                     channel.overwrites_for(everyone_role).read_messages,
                     DBUser(
                         ctx.author.id, f"{ctx.author.name}#{ctx.author.discriminator}"
                     ),
-                    ctx.db.guilds.find_by_id(ctx.guild.id),
+                    await ctx.db.guilds.find_by_id(ctx.guild.id),
                     reason,
-                    datetime.utcnow() + time,
+                    end_time,
                 )
             )
-            await channel.set_permissions(everyone_role, send_messages=False)
+            await self.bot.actions.submit(
+                ActionPriority.MODERATION,
+                ctx.guild.id,
+                ("channel_permissions", channel.id),
+                channel.set_permissions,
+                everyone_role,
+                send_messages=False,
+            )
+            if lock:
+                self.expiry.schedule(lock.channel_id, end_time, ctx.guild.id)
         if not lock:
             try:
                 await ctx.reply("Could not find a channel with those IDs.")
@@ -107,11 +150,17 @@ class Locks(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to unlock channel.")
             return
         if channel in ctx.guild.channels:
-            lock = ctx.db.locks.find_by_id(channel.id)
-            await channel.set_permissions(
-                everyone_role, send_messages=lock.previous_value
+            lock = await ctx.db.locks.find_by_id(channel.id)
+            await self.bot.actions.submit(
+                ActionPriority.MODERATION,
+                ctx.guild.id,
+                ("channel_permissions", channel.id),
+                channel.set_permissions,
+                everyone_role,
+                send_messages=lock.previous_value,
             )
-            ctx.db.locks.delete(lock.channel_id)
+            await ctx.db.locks.delete(lock.channel_id)
+            self.expiry.cancel(lock.channel_id)
         if not lock:
             await ctx.reply("Could not find a locked channel with that ID.")
             return
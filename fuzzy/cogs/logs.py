@@ -20,7 +20,7 @@ class Logs(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to access someone else's log.")
             return
 
-        all_infraction: List[Infraction] = ctx.db.infractions.find_all_for_user(
+        all_infraction: List[Infraction] = await ctx.db.infractions.find_all_for_user(
             who.id, ctx.guild.id
         )
         if not all_infraction:
@@ -44,7 +44,7 @@ class Logs(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to access someone else's log.")
             return
 
-        all_infraction: List[Infraction] = ctx.db.infractions.find_warns_for_user(
+        all_infraction: List[Infraction] = await ctx.db.infractions.find_warns_for_user(
             who.id, ctx.guild.id
         )
         if not all_infraction:
@@ -68,7 +68,7 @@ class Logs(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to access someone else's log.")
             return
 
-        all_infraction: List[Infraction] = ctx.db.infractions.find_mutes_for_user(
+        all_infraction: List[Infraction] = await ctx.db.infractions.find_mutes_for_user(
             who.id, ctx.guild.id
         )
         if not all_infraction:
@@ -92,7 +92,7 @@ class Logs(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to access someone else's log.")
             return
 
-        all_infraction: List[Infraction] = ctx.db.infractions.find_bans_for_user(
+        all_infraction: List[Infraction] = await ctx.db.infractions.find_bans_for_user(
             who.id, ctx.guild.id
         )
         if not all_infraction:
@@ -116,12 +116,21 @@ class Logs(Fuzzy.Cog):
             await ctx.reply("Insufficient permissions to access someone else's log.")
             return
 
-        mod_actions = ctx.db.infractions.find_mod_actions(who.id, ctx.guild.id)
+        mod_actions = await ctx.db.infractions.find_mod_actions(who.id, ctx.guild.id)
+        msg = ""
+        for name, key in (("Bans", "bans"), ("Mutes", "mutes"), ("Warns", "warns")):
+            counts = mod_actions[key]
+            windows = " · ".join(
+                f"{days}d: {count}" for days, count in counts["days"].items()
+            )
+            msg += (
+                f"**{name}: {counts['total']}** "
+                f"({counts['active']} active, {counts['pardoned']} pardoned)\n"
+                f"{windows}\n"
+            )
         await ctx.reply(
             title=f"Moderation log for {who.name}#{who.discriminator}",
-            msg=f"Bans: {mod_actions['bans']}\n"
-            f"Mutes: {mod_actions['mutes']}\n"
-            f"Warns: {mod_actions['warns']}",
+            msg=msg,
         )
 
     @staticmethod
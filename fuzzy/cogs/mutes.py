@@ -1,48 +1,79 @@
+import asyncio
 import typing
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Optional
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from fuzzy import Fuzzy
 from fuzzy.models import DBUser, Infraction, InfractionType, Mute
 
-from ..customizations import ParseableTimedelta
+from ..customizations import CatchUpLog, ParseableTimedelta
+from ..scheduling import ActionPriority, ExpiryScheduler
 
 
 class Mutes(Fuzzy.Cog):
     def __init__(self, *args):
-        self.execute_expired_mutes.start()  # pylint: disable=no-member
         super().__init__(*args)
+        settings = self.bot.config["discord"]
+        self.expiry = ExpiryScheduler(
+            self.log,
+            self.bot.db.mutes.find_end_times,
+            self.execute_expired_mute,
+            settings.getint("expiry_workers", 8),
+            CatchUpLog(self.bot, "mutes").report,
+            settings.getfloat("catch_up_rate", 5.0),
+            settings.getint("catch_up_chunk", 50),
+            settings.getint("expiry_guild_workers", 2),
+        )
+        self.expiry.start()
+        self.join_checks = 0
+        self.remutes = 0
 
-    @tasks.loop(seconds=0.5)
-    async def execute_expired_mutes(self):
-        """Finds expired mutes and unmutes the user"""
-        mutes: List[Mute] = self.bot.db.mutes.find_expired_mutes()
-        for mute in mutes:
-            guild: discord.Guild = await self.bot.fetch_guild(mute.infraction.guild.id)
-            # noinspection PyTypeChecker
-            user: discord.Member = None
-            # noinspection PyTypeChecker
-            mute_role: discord.Role = None
-            if guild:
-                user = await guild.fetch_member(mute.user.id)
-                mute_role = guild.get_role(mute.infraction.guild.mute_role)
-            if user and mute_role:
-                await user.remove_roles(mute_role)
-                try:
-                    await self.bot.direct_message(
-                        user, msg=f"Your mute on {guild.name} has expired."
-                    )
-                except discord.Forbidden or discord.HTTPException:
-                    pass
-            self.bot.db.mutes.delete(mute.infraction.id)
-            await self.bot.post_log(
-                guild,
-                msg=f"{mute.user.name} mute expired.",
-                color=self.bot.Context.Color.AUTOMATIC_BLUE,
-            )
+    def cog_unload(self):
+        self.expiry.stop()
+
+    async def execute_expired_mute(self, infraction_id: int):
+        """Unmutes the user of an expired mute"""
+        mute: Mute = await self.bot.db.mutes.find_by_id(infraction_id)
+        if not mute:
+            return
+        guild: discord.Guild = await self.bot.resolve_guild(mute.infraction.guild.id)
+        # noinspection PyTypeChecker
+        user: discord.Member = None
+        # noinspection PyTypeChecker
+        mute_role: discord.Role = None
+        if guild:
+            user = await self.bot.resolve_member(guild, mute.user.id)
+            mute_role = guild.get_role(mute.infraction.guild.mute_role)
+        msg = f"{mute.user.name} mute expired."
+        color = self.bot.Context.Color.AUTOMATIC_BLUE
+        if user and mute_role:
+            try:
+                await self.bot.actions.submit(
+                    ActionPriority.MODERATION,
+                    guild.id,
+                    ("member_role", guild.id),
+                    user.remove_roles,
+                    mute_role,
+                )
+            except discord.HTTPException as ex:
+                # discord.py already retried what's worth retrying, e.g. the bot lost its
+                # permissions. The mute is still deleted, it would only fail the same way later.
+                self.log.warning(f"Couldn't lift mute {infraction_id}: {ex}")
+                msg = (
+                    f"{mute.user.name} mute expired, "
+                    f"but the mute role couldn't be removed: {ex.text}"
+                )
+                color = self.bot.Context.Color.I_GUESS
+            else:
+                self.bot.direct_message(
+                    user, msg=f"Your mute on {guild.name} has expired."
+                )
+        await self.bot.db.mutes.delete(mute.infraction.id)
+        if guild:
+            await self.bot.post_log(guild, msg=msg, color=color)
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -69,55 +100,112 @@ class Mutes(Fuzzy.Cog):
                 raise commands.BadArgument("Time difference may not be zero.")
 
         muted_members = []
-        error_sending_dm = []
-        mute_role: discord.Role = ctx.guild.get_role(
-            ctx.db.guilds.find_by_id(ctx.guild.id).mute_role
-        )
+        guild_settings = await ctx.db.guilds.find_by_id(ctx.guild.id)
+        mute_role: discord.Role = ctx.guild.get_role(guild_settings.mute_role)
         if not mute_role:
             await ctx.reply(
                 "Could not find a mute role for this server.", color=ctx.Color.I_GUESS
             )
             return
-        for member in who:  # type: discord.User
-            if member.id != ctx.author.id:
-                active_mute = ctx.db.mutes.find_active_mute(member.id, ctx.guild.id)
+        # Muting only gives members the role, so who they are doesn't matter, only that the bot
+        # is above the role.
+        if not self.bot.hierarchy.can_assign(ctx.guild, mute_role):
+            await ctx.reply(
+                "The mute role has to be below the bot's highest role.",
+                color=ctx.Color.I_GUESS,
+            )
+            return
+        # All database writes first, in one transaction, so a failure can't leave half the
+        # members muted; the Discord side effects follow once they're committed.
+        new_mutes = []
+        replaced_mutes = []
+        end_time = datetime.utcnow() + time
+        async with ctx.db.transaction():
+            for member in who:  # type: discord.User
+                if member.id == ctx.author.id:
+                    continue
+                active_mute = await ctx.db.mutes.find_active_mute(
+                    member.id, ctx.guild.id
+                )
                 if active_mute:
-                    ctx.db.mutes.delete(active_mute.infraction.id)
+                    await ctx.db.mutes.delete(active_mute.infraction.id)
+                    replaced_mutes.append(active_mute.infraction.id)
 
-                infraction = Infraction.create(ctx, member, reason, InfractionType.MUTE)
-                infraction = ctx.db.infractions.save(infraction)
+                infraction = Infraction.create(
+                    ctx, member, reason, InfractionType.MUTE, guild_settings
+                )
+                infraction = await ctx.db.infractions.save(infraction)
 
                 if infraction.id:
-                    end_time = datetime.utcnow() + time
                     mute = Mute(
                         infraction,
                         end_time,
                         DBUser(member.id, f"{member.name}#{member.discriminator}"),
                     )
-                    ctx.db.mutes.save(mute)
+                    await ctx.db.mutes.save(mute)
+                    new_mutes.append((member, infraction))
 
-                    if isinstance(member, discord.Member):
-                        await member.add_roles(mute_role)
-                    muted_members.append(
-                        f"{member.mention}: Mute **ID {infraction.id}**"
-                    )
-                    try:
-                        await self.bot.direct_message(
-                            member,
-                            title=f"Mute ID {infraction.id}",
-                            msg=f"You have been muted on {ctx.guild.name} "
-                            + (f'for "{reason}"' if reason else "")
-                            + f"for {time}",
-                        )
-                    except discord.Forbidden or discord.HTTPException:
-                        error_sending_dm.append(member)
-            else:
-                await ctx.reply("You cant mute yourself.")
-        if error_sending_dm:
+        for infraction_id in replaced_mutes:
+            self.expiry.cancel(infraction_id)
+        for _, infraction in new_mutes:
+            self.expiry.schedule(infraction.id, end_time, ctx.guild.id)
+
+        if any(member.id == ctx.author.id for member in who):
+            await ctx.reply("You cant mute yourself.")
+        # Users who aren't members get the role once they join, see on_member_join.
+        in_guild = [
+            (member, infraction)
+            for member, infraction in new_mutes
+            if isinstance(member, discord.Member)
+        ]
+        results = await asyncio.gather(
+            *(
+                self.bot.actions.submit(
+                    ActionPriority.MODERATION,
+                    ctx.guild.id,
+                    ("member_role", ctx.guild.id),
+                    member.add_roles,
+                    mute_role,
+                )
+                for member, _ in in_guild
+            ),
+            return_exceptions=True,
+        )
+        # The mutes that couldn't be applied are taken back, like failed bans.
+        errors = []
+        for (member, infraction), result in zip(in_guild, results):
+            if isinstance(result, Exception):
+                self.log.info(f"Couldn't mute {member}: {result}")
+                errors.append((member, infraction))
+        if errors:
+            async with ctx.db.transaction():
+                for _, infraction in errors:
+                    await ctx.db.mutes.delete(infraction.id)
+                    await ctx.db.infractions.delete(infraction.id)
+            for _, infraction in errors:
+                self.expiry.cancel(infraction.id)
+            failed = {infraction.id for _, infraction in errors}
+            new_mutes = [
+                (member, infraction)
+                for member, infraction in new_mutes
+                if infraction.id not in failed
+            ]
             await ctx.reply(
-                f"Could not send direct message to the following users: "
-                f"{' '.join(member.mention for member in error_sending_dm)}"
+                "Error muting the following users: "
+                + " ".join(member.mention for member, _ in errors)
+            )
+        deliveries = []
+        for member, infraction in new_mutes:
+            muted_members.append(f"{member.mention}: Mute **ID {infraction.id}**")
+            delivery = self.bot.direct_message(
+                member,
+                title=f"Mute ID {infraction.id}",
+                msg=f"You have been muted on {ctx.guild.name} "
+                + (f'for "{reason}"' if reason else "")
+                + f"for {time}",
             )
+            deliveries.append((member, delivery))
+        self.bot.report_undelivered(ctx, deliveries)
         if muted_members:
             mute_string = "\n".join(muted_members)
             await ctx.reply(
@@ -147,29 +235,49 @@ class Mutes(Fuzzy.Cog):
         their name."""
         unmuted_members = []
         all_errors = []
-        for member in who:  # type: discord.User
-            active_mute = ctx.db.mutes.find_active_mute(member.id, ctx.guild.id)
-            if active_mute:
-                ctx.db.mutes.delete(active_mute.infraction.id)
-            else:
-                all_errors.append(member.mention)
-            mute_role: discord.Role = ctx.guild.get_role(
-                ctx.db.guilds.find_by_id(ctx.guild.id).mute_role
-            )
+        deliveries = []
+        mute_role: discord.Role = ctx.guild.get_role(
+            (await ctx.db.guilds.find_by_id(ctx.guild.id)).mute_role
+        )
+        if mute_role is None:
+            await ctx.reply("Error fetching mute role:")
+            return
 
-            if mute_role is None:
-                await ctx.reply("Error fetching mute role:")
-                return
+        removed_mutes = []
+        async with ctx.db.transaction():
+            for member in who:  # type: discord.User
+                active_mute = await ctx.db.mutes.find_active_mute(
+                    member.id, ctx.guild.id
+                )
+                if active_mute:
+                    await ctx.db.mutes.delete(active_mute.infraction.id)
+                    removed_mutes.append(active_mute.infraction.id)
+                else:
+                    all_errors.append(member.mention)
+        for infraction_id in removed_mutes:
+            self.expiry.cancel(infraction_id)
+
+        for member in who:  # type: discord.User
             if isinstance(member, discord.Member):
                 if mute_role in member.roles:
-                    await member.remove_roles(mute_role)
-                    try:
-                        await self.bot.direct_message(
-                            member, msg=f"Your mute on {ctx.guild.name} was removed."
+                    await self.bot.actions.submit(
+                        ActionPriority.MODERATION,
+                        ctx.guild.id,
+                        ("member_role", ctx.guild.id),
+                        member.remove_roles,
+                        mute_role,
+                    )
+                    deliveries.append(
+                        (
+                            member,
+                            self.bot.direct_message(
+                                member,
+                                msg=f"Your mute on {ctx.guild.name} was removed.",
+                            ),
                         )
-                    except discord.Forbidden or discord.HTTPException:
-                        pass
+                    )
             unmuted_members.append(member.mention)
+        self.bot.report_undelivered(ctx, deliveries)
 
         msg = ""
         if all_errors:
@@ -186,11 +294,20 @@ class Mutes(Fuzzy.Cog):
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         """Checks if a member who joined the server, had a pre=existing mute and reapplies it if necessary."""
-        active_mute = self.bot.db.mutes.find_active_mute(member.id, member.guild.id)
-        if active_mute:
-
-            mute_role: discord.Role = member.guild.fetch_role(
-                self.bot.db.guilds.find_by_id(member.guild.id).mute_role
+        self.join_checks += 1
+        # A dictionary lookup, joins are checked without touching the database.
+        if not self.bot.db.mutes.indexed(member.id, member.guild.id):
+            return
+        guild = await self.bot.db.guilds.find_by_id(member.guild.id)
+        mute_role: discord.Role = (
+            member.guild.get_role(guild.mute_role) if guild else None
+        )
+        if mute_role:
+            await self.bot.actions.submit(
+                ActionPriority.MODERATION,
+                member.guild.id,
+                ("member_role", member.guild.id),
+                member.add_roles,
+                mute_role,
             )
-            if mute_role:
-                await member.add_roles(mute_role)
+            self.remutes += 1
@@ -1,20 +1,162 @@
+import asyncio
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from typing import Deque, List
+
+import discord
 from discord.ext import commands
 
 from fuzzy import Fuzzy
+from fuzzy.customizations import ProgressMessage, PurgeFilter
+from fuzzy.scheduling import ActionPriority
 
 
 class Purges(Fuzzy.Cog):
+    # Discord bulk deletes up to 100 messages at once, if they're younger than 14 days.
+    BULK_SIZE = 100
+    BULK_MAX_AGE = timedelta(days=14)
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        settings = self.bot.config["discord"]
+        # How many messages a filtered purge looks at before giving up on finding `amount`
+        self.scan_limit = settings.getint("purge_scan_limit", 5000)
+        # How many old messages are queued for deletion at a time. The action queue deletes them
+        # one after another per channel, this only bounds how far ahead of it a purge reads.
+        self.single_in_flight = settings.getint("purge_workers", 5)
+        # bulk/single deleted, failed and scanned messages of all purges
+        self.purged = Counter()
+
     @commands.command()
     @commands.has_permissions(manage_messages=True)
-    async def purge(self, ctx: Fuzzy.Context, amount: int):
+    async def purge(
+        self, ctx: Fuzzy.Context, amount: int, *, filters: PurgeFilter = None
+    ):
         """Deletes the most recent messages in a channel.
-        `amount` is the number of messages to delete."""
-        amount += 1
-        deleted = await ctx.channel.purge(
-            limit=amount,
-            bulk=True,
-        )
+        `amount` is the number of messages to delete.
+        `filters` optionally limit which messages are deleted: `from:<user>` (can be repeated), `bots`,
+        `contains:<text>`, `regex:<pattern>`, `attachments`, `links`, `before:<message ID>` and
+        `after:<message ID>`. Use quotes for text with spaces, i.e. `contains:"free nitro"`."""
+        if amount < 1:
+            raise commands.BadArgument("Amount has to be at least 1.")
+        filters = filters or PurgeFilter()
+        channel: discord.TextChannel = ctx.channel
+        # with some leeway for the time the purge takes
+        cutoff = datetime.utcnow() - self.BULK_MAX_AGE + timedelta(minutes=10)
+        bulk_cutoff = discord.utils.time_snowflake(cutoff)
+        before = discord.Object(filters.before) if filters.before else ctx.message
+        after = discord.Object(filters.after) if filters.after else None
+        counts = Counter()
+        chunk: List[discord.Message] = []
+        bulk_deletes: Deque[asyncio.Task] = deque()
+        single_deletes = set()
+        slots = asyncio.Semaphore(self.single_in_flight)
+        loop = asyncio.get_event_loop()
+
+        # deleted along with the final reply, so the purge leaves nothing behind
+        async with ProgressMessage(ctx, "Purging", amount, delete_after=5) as progress:
+            # History is streamed page by page and matches are deleted as it goes, so only a few
+            # chunks are held in memory at a time.
+            async for message in channel.history(
+                limit=max(amount, self.scan_limit) if filters else amount,
+                before=before,
+                after=after,
+                oldest_first=False,
+            ):
+                counts["scanned"] += 1
+                if not filters.matches(message):
+                    continue
+                counts["matched"] += 1
+                if message.id > bulk_cutoff:
+                    chunk.append(message)
+                    if len(chunk) == self.BULK_SIZE:
+                        bulk_deletes.append(
+                            loop.create_task(
+                                self.delete_bulk(channel, chunk, counts, progress)
+                            )
+                        )
+                        chunk = []
+                        while len(bulk_deletes) > 2:
+                            await bulk_deletes.popleft()
+                else:
+                    await slots.acquire()
+                    task = loop.create_task(
+                        self.delete_single(message, counts, progress, slots)
+                    )
+                    single_deletes.add(task)
+                    task.add_done_callback(single_deletes.discard)
+                if counts["matched"] == amount:
+                    break
+            if chunk:
+                bulk_deletes.append(
+                    loop.create_task(self.delete_bulk(channel, chunk, counts, progress))
+                )
+            await asyncio.gather(*bulk_deletes, *single_deletes)
+
+        self.purged.update(counts)
+        try:
+            await ctx.message.delete()
+        except discord.HTTPException:
+            pass
+        deleted = counts["bulk"] + counts["single"]
         await ctx.reply(
-            f"Purged {len(deleted) - 1} messages from {ctx.channel.mention}.",
+            f"Purged {deleted} messages from {channel.mention}"
+            + (
+                f", {counts['single']} of them older than 14 days"
+                if counts["single"]
+                else ""
+            )
+            + (f". {counts['failed']} could not be deleted" if counts["failed"] else "")
+            + f". Looked at {counts['scanned']} messages.",
             delete_after=5,
         )
+
+    async def delete_bulk(
+        self,
+        channel: discord.TextChannel,
+        messages: List[discord.Message],
+        counts: Counter,
+        progress: ProgressMessage,
+    ):
+        try:
+            await self.bot.actions.submit(
+                ActionPriority.CLEANUP,
+                channel.guild.id,
+                ("bulk_delete", channel.id),
+                channel.delete_messages,
+                messages,
+            )
+        except discord.HTTPException as ex:
+            self.log.info(f"Couldn't bulk delete in {channel}: {ex}")
+            counts["failed"] += len(messages)
+            progress.advance(False, len(messages))
+        else:
+            counts["bulk"] += len(messages)
+            progress.advance(count=len(messages))
+
+    async def delete_single(
+        self,
+        message: discord.Message,
+        counts: Counter,
+        progress: ProgressMessage,
+        slots: asyncio.Semaphore,
+    ):
+        """Deletes a message too old to be bulk deleted. These share a much tighter rate limit,
+        the action queue runs them one after another per channel, behind everything else."""
+        try:
+            await self.bot.actions.submit(
+                ActionPriority.CLEANUP,
+                message.guild.id,
+                ("delete_message", message.channel.id),
+                message.delete,
+            )
+        except discord.NotFound:
+            pass  # someone else was faster
+        except discord.HTTPException:
+            counts["failed"] += 1
+            progress.advance(False)
+            return
+        finally:
+            slots.release()
+        counts["single"] += 1
+        progress.advance()
@@ -24,19 +24,22 @@ class Warns(Fuzzy.Cog):
         later with `${pfx}reason`"""
         infraction = None
         if who.id != ctx.author.id:
-            infraction = Infraction.create(ctx, who, reason, InfractionType.WARN)
-            infraction = ctx.db.infractions.save(infraction)
+            infraction = Infraction.create(
+                ctx,
+                who,
+                reason,
+                InfractionType.WARN,
+                await ctx.db.guilds.find_by_id(ctx.guild.id),
+            )
+            infraction = await ctx.db.infractions.save(infraction)
             if infraction:
-                try:
-                    await self.bot.direct_message(
-                        who,
-                        title=f"Warning ID {infraction.id}",
-                        msg=f"You have been warned on {ctx.guild.name} "
-                        + (f'for "{reason}"' if reason else ""),
-                    )
-                except discord.Forbidden or discord.HTTPException:
-                    await ctx.reply(
-                        f"Could not send direct message to {who.mention}")
+                delivery = self.bot.direct_message(
+                    who,
+                    title=f"Warning ID {infraction.id}",
+                    msg=f"You have been warned on {ctx.guild.name} "
+                    + (f'for "{reason}"' if reason else ""),
+                )
+                self.bot.report_undelivered(ctx, [(who, delivery)])
         else:
             await ctx.reply("You cant warn yourself.")
 
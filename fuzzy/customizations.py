@@ -1,17 +1,26 @@
+import abc
+import asyncio
 import enum
+import functools
+import json
 import logging
 import random
 import re
+import shlex
 import typing
+from collections import Counter, defaultdict
 from copy import copy
+from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta, timezone
-from typing import Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import discord
 from discord import Activity, ActivityType
 from discord.ext import commands
 
-from fuzzy.databases import Database
+from fuzzy.databases import AsyncDatabase
+from fuzzy.models import LogSinks
+from fuzzy.scheduling import ActionPriority, ActionQueue, RetryingDispatcher
 
 
 class Fuzzy(commands.Bot):
@@ -42,7 +51,7 @@ class Fuzzy(commands.Bot):
             return self.cog.log.getChild(name)
 
         @property
-        def db(self) -> Database:
+        def db(self) -> AsyncDatabase:
             """Return the bot's database connection."""
             return self.bot.db
 
@@ -126,7 +135,7 @@ class Fuzzy(commands.Bot):
                 return self.author.guild_permissions.manage_guild
             if kind == discord.Role:
                 return self.author.guild_permissions.manage_roles and (
-                    self.author.top_role > subject or self.guild.owner == self.author
+                    self.bot.hierarchy.outranks(self.author, subject)
                 )
 
             raise ValueError(f"unsupported subject {kind}")
@@ -140,17 +149,51 @@ class Fuzzy(commands.Bot):
             self.bot: Fuzzy = bot
             self.log = bot.log.getChild(self.__class__.__name__)
 
-    def __init__(self, config, database: Database, **kwargs):
+    # Discord's error code for users who don't accept direct messages from the bot
+    CANNOT_MESSAGE_USER = 50007
+
+    def __init__(self, config, database: AsyncDatabase, **kwargs):
         self.config = config
 
         self.log = logging.getLogger("Fuzzy")
         self.log.setLevel(logging.INFO)
-        self.db: Database = database
+        self.db: AsyncDatabase = database
+        # How often the resolve_* helpers missed the gateway cache and went to the REST API,
+        # by kind of object.
+        self.rest_fallbacks: typing.Counter[str] = Counter()
+        self.log_buffer = LogBuffer(self, config["log"].getfloat("buffer_window", 2.0))
+        self.log_router = LogRouter(self, config["log"])
+        self.actions = ActionQueue(
+            self.log.getChild("actions"),
+            config["discord"].getint("action_workers", 10),
+            config["discord"].getint("action_guild_workers", 3),
+        )
+        self.direct_messages = RetryingDispatcher(
+            self.log.getChild("direct_messages"),
+            self.is_temporary,
+            config["discord"].getint("dm_workers", 4),
+            config["discord"].getint("dm_retries", 3),
+            config["discord"].getfloat("dm_backoff", 2.0),
+        )
+        # Users whose direct messages failed with CANNOT_MESSAGE_USER aren't messaged again for
+        # this long, see db.closed_dms.
+        self.closed_dm_ttl = timedelta(
+            hours=config["discord"].getfloat("closed_dm_ttl", 24.0)
+        )
+        self.skipped_direct_messages = 0
         super().__init__(command_prefix=config["discord"]["prefix"], **kwargs)
+        self.hierarchy = HierarchyCache(self)
 
     async def get_context(self, message, *, cls=Context):
         return await super().get_context(message, cls=cls)
 
+    @staticmethod
+    def is_temporary(error: Exception) -> bool:
+        """Whether a request that failed with this error may succeed if it's tried again."""
+        if isinstance(error, discord.HTTPException):
+            return error.status >= 500
+        return isinstance(error, (asyncio.TimeoutError, OSError))
+
     @staticmethod
     def random_status() -> Activity:
         """Return a silly status to show to the world"""
@@ -164,8 +207,67 @@ class Fuzzy(commands.Bot):
             ]
         )
 
+    def direct_message(
+        self, to: typing.Union[discord.Member, discord.User], *args, **kwargs
+    ) -> asyncio.Future:
+        """Send a direct message to a user in the background, behind moderation actions and logs,
+        usage same as send_direct_message. The future resolves to whether it was delivered.
+        Users who recently didn't accept one are skipped."""
+        failed_on = self.db.sync.closed_dms.cached(to.id)
+        if failed_on and failed_on > datetime.utcnow() - self.closed_dm_ttl:
+            self.skipped_direct_messages += 1
+            skipped = asyncio.get_event_loop().create_future()
+            skipped.set_result(False)
+            return skipped
+        return self.direct_messages.submit(
+            functools.partial(self.deliver_direct_message, to, *args, **kwargs)
+        )
+
+    async def deliver_direct_message(
+        self, to: typing.Union[discord.Member, discord.User], *args, **kwargs
+    ):
+        """Sends a direct message through the action queue, remembering who doesn't accept them."""
+        try:
+            message = await self.actions.submit(
+                ActionPriority.DM,
+                to.guild.id if isinstance(to, discord.Member) else None,
+                ("dm", to.id),
+                self.send_direct_message,
+                to,
+                *args,
+                **kwargs,
+            )
+        except discord.Forbidden as ex:
+            if ex.code == self.CANNOT_MESSAGE_USER:
+                await self.db.closed_dms.save(to.id, datetime.utcnow())
+            raise
+        if self.db.sync.closed_dms.cached(to.id):
+            await self.db.closed_dms.delete(to.id)
+        return message
+
+    def report_undelivered(
+        self,
+        ctx: "Fuzzy.Context",
+        deliveries: List[Tuple[discord.abc.User, asyncio.Future]],
+    ):
+        """Tells the moderator which of the direct messages couldn't be delivered, once they've
+        all been tried."""
+
+        async def report():
+            delivered = await asyncio.gather(*(future for _, future in deliveries))
+            failed = [user for (user, _), ok in zip(deliveries, delivered) if not ok]
+            if failed:
+                await ctx.reply(
+                    "Could not send direct message to the following users: "
+                    + " ".join(user.mention for user in failed),
+                    color=ctx.Color.I_GUESS,
+                )
+
+        if deliveries:
+            asyncio.get_event_loop().create_task(report())
+
     @staticmethod
-    async def direct_message(
+    async def send_direct_message(
         to: typing.Union[discord.Member, discord.User],
         msg: str = None,
         title: str = discord.Embed.Empty,
@@ -207,14 +309,649 @@ class Fuzzy(commands.Bot):
 
         return await to.send("", embed=embed, delete_after=delete_after)
 
-    async def post_log(self, guild: discord.Guild, *args, **kwargs):
-        """Post a log entry to a guild, usage same as ctx.reply"""
-        configuration = self.db.guilds.find_by_id(guild.id)
+    async def post_log(
+        self,
+        guild: discord.Guild,
+        msg: str = None,
+        title: str = None,
+        color: Context.Color = Context.Color.GOOD,
+    ):
+        """Post a log entry to a guild's mod log. Entries posted shortly after each other are
+        combined into as few messages as possible, see LogBuffer."""
+        configuration = await self.db.guilds.find_by_id(guild.id)
         if not configuration:
             return
         channel = self.get_channel(configuration.mod_log)
         if channel:
-            await self.Context.reply(channel, *args, **kwargs)
+            self.log_buffer.add(channel, msg, title, color)
+
+    async def close(self):
+        await self.log_buffer.flush_all()
+        self.direct_messages.close()
+        await super().close()
+
+    async def resolve_guild(self, guild_id: int) -> Optional[discord.Guild]:
+        """Get a guild from the cache, fetching it only if it isn't cached."""
+        guild = self.get_guild(guild_id)
+        if guild:
+            return guild
+        self.rest_fallbacks["guild"] += 1
+        try:
+            return await self.fetch_guild(guild_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+    async def resolve_member(
+        self, guild: discord.Guild, user_id: int
+    ) -> Optional[discord.Member]:
+        """Get a member of a guild from the cache, fetching them only if they aren't cached."""
+        member = guild.get_member(user_id)
+        if member:
+            return member
+        self.rest_fallbacks["member"] += 1
+        try:
+            return await guild.fetch_member(user_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+    async def resolve_user(self, user_id: int) -> Optional[discord.User]:
+        """Get a user from the cache, fetching them only if they aren't cached."""
+        user = self.get_user(user_id)
+        if user:
+            return user
+        self.rest_fallbacks["user"] += 1
+        try:
+            return await self.fetch_user(user_id)
+        except discord.NotFound:
+            return None
+
+    async def resolve_channel(
+        self, channel_id: int
+    ) -> Optional[discord.abc.GuildChannel]:
+        """Get a channel from the cache, fetching it only if it isn't cached."""
+        channel = self.get_channel(channel_id)
+        if channel:
+            return channel
+        self.rest_fallbacks["channel"] += 1
+        try:
+            return await self.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+
+class LogBuffer:
+    """
+    Collects the log entries of each channel for `window` seconds and posts them together, as
+    few embeds as the limits allow (2048 characters of description, 1024 per field, 25 fields
+    and 6000 characters in all). Consecutive entries of the same color share an embed, a batch
+    is posted early once it fills a whole embed.
+    """
+
+    DESCRIPTION_LIMIT = 2048
+    FIELD_LIMIT = 1024
+    FIELD_COUNT = 25
+    EMBED_LIMIT = 6000
+
+    def __init__(self, bot: Fuzzy, window: float):
+        self.bot = bot
+        self.window = window
+        self.batches: Dict[
+            int, Tuple[discord.abc.Messageable, List[Tuple[str, int]]]
+        ] = {}
+        self.sizes: Dict[int, int] = {}
+        self.timers: Dict[int, asyncio.TimerHandle] = {}
+
+        self.entries = 0
+        self.messages = 0
+
+    def add(
+        self,
+        channel: discord.abc.GuildChannel,
+        msg: str,
+        title: str = None,
+        color: int = Fuzzy.Context.Color.GOOD,
+    ):
+        text = f"**{title}**\n{msg}" if title else str(msg)
+        self.batches.setdefault(channel.id, (channel, []))[1].append((text, color))
+        self.sizes[channel.id] = self.sizes.get(channel.id, 0) + len(text)
+        self.entries += 1
+
+        if self.sizes[channel.id] >= self.EMBED_LIMIT:
+            asyncio.get_event_loop().create_task(self.flush(channel.id))
+        elif channel.id not in self.timers:
+            self.timers[channel.id] = asyncio.get_event_loop().call_later(
+                self.window,
+                lambda: asyncio.get_event_loop().create_task(self.flush(channel.id)),
+            )
+
+    async def flush(self, channel_id: int):
+        """Posts the batch of a channel."""
+        timer = self.timers.pop(channel_id, None)
+        if timer:
+            timer.cancel()
+        self.sizes.pop(channel_id, None)
+        channel, entries = self.batches.pop(channel_id, (None, None))
+        if not entries:
+            return
+
+        embeds = self.pack(entries)
+        self.messages += len(embeds)
+        await self.bot.log_router.post(channel, embeds)
+
+    async def flush_all(self):
+        await asyncio.gather(
+            *(self.flush(channel_id) for channel_id in list(self.batches))
+        )
+
+    @classmethod
+    def pack(cls, entries: List[Tuple[str, int]]) -> List[discord.Embed]:
+        """Packs (text, color) entries into embeds, in order."""
+        embeds = []
+        embed = None
+        size = 0
+        for text, color in entries:
+            for piece in cls.split(text):
+                if embed and embed.color.value == color:
+                    if (
+                        not embed.fields
+                        and size + len(piece) + 1 <= cls.DESCRIPTION_LIMIT
+                    ):
+                        embed.description += "\n" + piece
+                        size += len(piece) + 1
+                        continue
+                    if (
+                        len(embed.fields) < cls.FIELD_COUNT
+                        and size + len(piece) + 1 <= cls.EMBED_LIMIT
+                    ):
+                        embed.add_field(name="\u200b", value=piece, inline=False)
+                        size += len(piece) + 1
+                        continue
+                embed = discord.Embed(color=color, description=piece)
+                embeds.append(embed)
+                size = len(piece)
+        return embeds
+
+    @classmethod
+    def split(cls, text: str) -> List[str]:
+        """Splits text at line breaks into pieces that fit into a field."""
+        pieces = []
+        piece = ""
+        for line in text.split("\n"):
+            while len(line) > cls.FIELD_LIMIT:
+                if piece:
+                    pieces.append(piece)
+                    piece = ""
+                pieces.append(line[: cls.FIELD_LIMIT])
+                line = line[cls.FIELD_LIMIT :]
+            if piece and len(piece) + len(line) + 1 > cls.FIELD_LIMIT:
+                pieces.append(piece)
+                piece = line
+            else:
+                piece = f"{piece}\n{line}" if piece else line
+        if piece:
+            pieces.append(piece)
+        return pieces
+
+
+class GuildHierarchy:
+    """The role order of a guild as moderation checks need it."""
+
+    __slots__ = ("ranks", "bot_rank", "owner_id")
+
+    def __init__(self, guild: discord.Guild):
+        # guild.roles is sorted from the bottom (@everyone) up
+        self.ranks: Dict[int, int] = {
+            role.id: rank for rank, role in enumerate(guild.roles)
+        }
+        self.bot_rank = self.rank(guild.me) if guild.me else -1
+        self.owner_id = guild.owner_id
+
+    def rank(self, member: discord.Member) -> int:
+        return self.ranks.get(member.top_role.id, 0)
+
+
+class HierarchyCache:
+    """
+    Keeps the GuildHierarchy of every guild until its roles, the bot's roles or its owner change,
+    so checking many targets doesn't re-sort the guild's roles for each of them.
+    """
+
+    def __init__(self, bot: Fuzzy):
+        self.bot = bot
+        self.guilds: Dict[int, GuildHierarchy] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        bot.add_listener(self.on_role_changed, "on_guild_role_create")
+        bot.add_listener(self.on_role_changed, "on_guild_role_delete")
+        bot.add_listener(self.on_role_updated, "on_guild_role_update")
+        bot.add_listener(self.on_member_update, "on_member_update")
+        bot.add_listener(self.on_guild_update, "on_guild_update")
+
+    def of(self, guild: discord.Guild) -> GuildHierarchy:
+        hierarchy = self.guilds.get(guild.id)
+        if hierarchy:
+            self.hits += 1
+            return hierarchy
+        self.misses += 1
+        hierarchy = self.guilds[guild.id] = GuildHierarchy(guild)
+        return hierarchy
+
+    def invalidate(self, guild_id: int):
+        if self.guilds.pop(guild_id, None):
+            self.invalidations += 1
+
+    def can_moderate(
+        self,
+        guild: discord.Guild,
+        targets: typing.Sequence[typing.Union[discord.Member, discord.User]],
+    ) -> List[bool]:
+        """Whether the bot is above each of the targets, users who aren't members always are."""
+        hierarchy = self.of(guild)
+        return [
+            not isinstance(target, discord.Member)
+            or (
+                target.id != hierarchy.owner_id
+                and hierarchy.rank(target) < hierarchy.bot_rank
+            )
+            for target in targets
+        ]
+
+    def can_assign(self, guild: discord.Guild, role: discord.Role) -> bool:
+        """Whether the role is below the bot's top role, so the bot may give it to members."""
+        hierarchy = self.of(guild)
+        return hierarchy.ranks.get(role.id, hierarchy.bot_rank) < hierarchy.bot_rank
+
+    def outranks(self, member: discord.Member, role: discord.Role) -> bool:
+        """Whether the member is above the role, the owner is above all of them."""
+        hierarchy = self.of(member.guild)
+        if member.id == hierarchy.owner_id:
+            return True
+        return hierarchy.rank(member) > hierarchy.ranks.get(role.id, 0)
+
+    async def on_role_changed(self, role: discord.Role):
+        self.invalidate(role.guild.id)
+
+    async def on_role_updated(self, before: discord.Role, after: discord.Role):
+        if before.position != after.position:
+            self.invalidate(after.guild.id)
+
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if after.id == self.bot.user.id and before.roles != after.roles:
+            self.invalidate(after.guild.id)
+
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            self.invalidate(after.id)
+
+
+class ProgressMessage:
+    """
+    An embed telling the moderator how far along a command working through many users is, used as
+    an async context manager around the work. It's edited at most every `interval` seconds while
+    the work goes on and once more at the end. Nothing is posted for a single user. With
+    `delete_after` the message is deleted that many seconds after the work is done.
+    """
+
+    def __init__(
+        self,
+        ctx: Fuzzy.Context,
+        title: str,
+        total: int,
+        interval: float = 2.0,
+        delete_after: Optional[float] = None,
+    ):
+        self.ctx = ctx
+        self.title = title
+        self.total = total
+        self.interval = interval
+        self.delete_after = delete_after
+        self.done = 0
+        self.failed = 0
+        self.message: Optional[discord.Message] = None
+        self.updates: Optional[asyncio.Task] = None
+
+    def advance(self, succeeded: bool = True, count: int = 1):
+        self.done += count
+        if not succeeded:
+            self.failed += count
+
+    def embed(self, color: int = Fuzzy.Context.Color.AUTOMATIC_BLUE) -> discord.Embed:
+        return discord.Embed(
+            title=self.title,
+            color=color,
+            description=f"{self.done} of {self.total} done"
+            + (f", {self.failed} failed" if self.failed else ""),
+        )
+
+    async def __aenter__(self) -> "ProgressMessage":
+        if self.total > 1:
+            self.message = await self.ctx.send(embed=self.embed())
+            self.updates = asyncio.get_event_loop().create_task(self.update())
+        return self
+
+    async def __aexit__(self, *_):
+        if self.updates:
+            self.updates.cancel()
+            await self.edit(
+                self.embed(
+                    self.ctx.Color.I_GUESS if self.failed else self.ctx.Color.GOOD
+                )
+            )
+            if self.delete_after is not None:
+                await self.message.delete(delay=self.delete_after)
+
+    async def update(self):
+        shown = (0, 0)
+        while True:
+            await asyncio.sleep(self.interval)
+            if (self.done, self.failed) != shown:
+                shown = (self.done, self.failed)
+                await self.edit(self.embed())
+
+    async def edit(self, embed: discord.Embed):
+        try:
+            await self.ctx.bot.actions.submit(
+                ActionPriority.LOG,
+                self.ctx.guild.id,
+                ("messages", self.ctx.channel.id),
+                self.message.edit,
+                embed=embed,
+            )
+        except discord.HTTPException:
+            # deleted by someone, the command carries on without it
+            pass
+
+
+class CatchUpLog:
+    """
+    Reports an ExpiryScheduler's catch-up in the mod logs, as its report callback. Each guild gets
+    one message when its catch-up starts, edited after every chunk until it's done.
+    """
+
+    def __init__(self, bot: Fuzzy, what: str):
+        self.bot = bot
+        # i.e. "mutes", as in "Lifting 5 mutes that expired while offline"
+        self.what = what
+        self.messages: Dict[int, discord.Message] = {}
+
+    async def report(self, guild_id: int, done: int, total: int):
+        if done == total:
+            description = f"Lifted all {total} {self.what} that expired while offline."
+            color = Fuzzy.Context.Color.GOOD
+        else:
+            description = (
+                f"Lifting {total} {self.what} that expired while offline, "
+                f"{done} done."
+            )
+            color = Fuzzy.Context.Color.AUTOMATIC_BLUE
+        embed = discord.Embed(description=description, color=color)
+        message = self.messages.pop(guild_id, None)
+        if message:
+            try:
+                await self.bot.log_router.edit(message, embed)
+            except discord.HTTPException:
+                message = None  # deleted by someone, post a new one
+        if not message:
+            settings = await self.bot.db.guilds.find_by_id(guild_id)
+            channel = None
+            if settings and settings.mod_log:
+                channel = await self.bot.resolve_channel(settings.mod_log)
+            if not channel:
+                return
+            message = await self.bot.log_router.publish(channel, embed)
+        if message and done < total:
+            self.messages[guild_id] = message
+
+
+class LogSink(abc.ABC):
+    """A destination for log embeds."""
+
+    @abc.abstractmethod
+    async def send(
+        self, channel: discord.TextChannel, embeds: List[discord.Embed]
+    ) -> List[discord.Message]:
+        """Writes the embeds for a log channel, returns the messages posted to Discord if any."""
+        raise NotImplementedError
+
+
+class ChannelSink(LogSink):
+    """Posts as the bot, sharing its rate limits with the moderation actions."""
+
+    def __init__(self, bot: Fuzzy):
+        self.bot = bot
+
+    async def send(
+        self, channel: discord.TextChannel, embeds: List[discord.Embed]
+    ) -> List[discord.Message]:
+        return await asyncio.gather(
+            *(
+                self.bot.actions.submit(
+                    ActionPriority.LOG,
+                    channel.guild.id,
+                    ("messages", channel.id),
+                    channel.send,
+                    embed=embed,
+                )
+                for embed in embeds
+            )
+        )
+
+
+class WebhookSink(LogSink):
+    """
+    Posts through a pool of the bot's webhooks in each log channel. Every webhook has its own rate
+    limit, separate from the bot's, and the embeds are spread over the pool in turns.
+    """
+
+    # How long to leave a channel alone after its webhooks couldn't be set up, doubled after
+    # every further failure up to the maximum.
+    BACKOFF = timedelta(minutes=1)
+    MAX_BACKOFF = timedelta(hours=1)
+
+    def __init__(self, bot: Fuzzy, size: int):
+        self.bot = bot
+        self.size = size
+        self.pools: Dict[int, List[discord.Webhook]] = {}
+        self.turns: typing.Counter[int] = Counter()
+        self.locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # channel ID: (guild ID, when to try again, backoff) of channels whose webhooks couldn't
+        # be set up, e.g. without Manage Webhooks or with the channel's webhook limit reached
+        self.failures: Dict[int, Tuple[int, datetime, timedelta]] = {}
+
+    def available(self, channel: discord.TextChannel) -> bool:
+        """Whether to post through webhooks in the channel, not while backing off from it."""
+        failure = self.failures.get(channel.id)
+        return not failure or failure[1] <= datetime.utcnow()
+
+    def retry(self, guild_id: int):
+        """Forgets the failures in a guild's channels, e.g. after its log sinks were changed."""
+        for channel_id, failure in list(self.failures.items()):
+            if failure[0] == guild_id:
+                del self.failures[channel_id]
+
+    async def pool(self, channel: discord.TextChannel) -> List[discord.Webhook]:
+        """The webhooks of a channel, creating them the first time the channel is used."""
+        async with self.locks[channel.id]:
+            if channel.id not in self.pools:
+                pool = []
+                try:
+                    pool = [
+                        hook
+                        for hook in await channel.webhooks()
+                        if hook.token and hook.user and hook.user.id == self.bot.user.id
+                    ][: self.size]
+                    while len(pool) < self.size:
+                        pool.append(
+                            await channel.create_webhook(
+                                name=f"{self.bot.user.name} log"
+                            )
+                        )
+                except discord.HTTPException:
+                    if not pool:
+                        self.back_off(channel)
+                        raise
+                    # the channel's webhook limit was reached, make do with the ones there are
+                self.failures.pop(channel.id, None)
+                self.pools[channel.id] = pool
+            return self.pools[channel.id]
+
+    def back_off(self, channel: discord.TextChannel):
+        failure = self.failures.get(channel.id)
+        backoff = min(failure[2] * 2, self.MAX_BACKOFF) if failure else self.BACKOFF
+        self.failures[channel.id] = (
+            channel.guild.id,
+            datetime.utcnow() + backoff,
+            backoff,
+        )
+
+    async def send(
+        self, channel: discord.TextChannel, embeds: List[discord.Embed]
+    ) -> List[discord.Message]:
+        pool = await self.pool(channel)
+        sends = []
+        for embed in embeds:
+            hook = pool[self.turns[channel.id] % len(pool)]
+            self.turns[channel.id] += 1
+            sends.append(
+                self.bot.actions.submit(
+                    ActionPriority.LOG,
+                    channel.guild.id,
+                    ("webhook", hook.id),
+                    hook.send,
+                    embed=embed,
+                    username=self.bot.user.name,
+                    avatar_url=str(self.bot.user.avatar_url),
+                    wait=True,
+                )
+            )
+        try:
+            return await asyncio.gather(*sends)
+        except discord.NotFound:
+            # Someone deleted one of the webhooks, the pool is rebuilt on the next send.
+            self.pools.pop(channel.id, None)
+            raise
+
+    async def edit(self, message: discord.Message, embed: discord.Embed):
+        """Edits a message that was posted by one of the webhooks of the pool."""
+        pool = await self.pool(message.channel)
+        hook = next((hook for hook in pool if hook.id == message.webhook_id), None)
+        if not hook:
+            raise discord.InvalidArgument(
+                f"Message {message.id} wasn't posted by one of our webhooks."
+            )
+        await hook.edit_message(message.id, embed=embed)
+
+
+class FileSink(LogSink):
+    """Appends one JSON object per embed to a local file, which is rotated once it's full."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        # A logger of its own that isn't part of the hierarchy, so nothing else ends up in the
+        # file and the entries don't end up in the console.
+        self.writer = logging.Logger("Fuzzy.sinks.file")
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.writer.addHandler(handler)
+
+    async def send(
+        self, channel: discord.TextChannel, embeds: List[discord.Embed]
+    ) -> List[discord.Message]:
+        time = datetime.utcnow().isoformat()
+        for embed in embeds:
+            self.writer.info(
+                json.dumps(
+                    {
+                        "time": time,
+                        "guild": channel.guild.id,
+                        "channel": channel.id,
+                        **embed.to_dict(),
+                    }
+                )
+            )
+        return []
+
+
+class LogRouter:
+    """Sends log embeds to the sinks each guild chose with its log_sinks setting."""
+
+    def __init__(self, bot: Fuzzy, settings):
+        self.bot = bot
+        self.sinks: Dict[LogSinks, LogSink] = {
+            LogSinks.CHANNEL: ChannelSink(bot),
+            LogSinks.WEBHOOK: WebhookSink(bot, settings.getint("webhook_pool", 2)),
+            LogSinks.FILE: FileSink(
+                settings.get("sink_path", "./fuzzy-log.jsonl"),
+                settings.getint("sink_max_bytes", 10_000_000),
+                settings.getint("sink_backups", 5),
+            ),
+        }
+        self.sent: typing.Counter[LogSinks] = Counter()
+        self.failed: typing.Counter[LogSinks] = Counter()
+
+    async def sinks_of(self, guild: discord.Guild) -> LogSinks:
+        settings = await self.bot.db.guilds.find_by_id(guild.id)
+        return settings.log_sinks if settings else LogSinks.CHANNEL
+
+    async def post(
+        self,
+        channel: discord.TextChannel,
+        embeds: List[discord.Embed],
+        sinks: LogSinks = None,
+    ) -> List[discord.Message]:
+        """Writes the embeds to the sinks of the channel's guild, returns the messages posted to
+        Discord."""
+        if sinks is None:
+            sinks = await self.sinks_of(channel.guild)
+        if LogSinks.WEBHOOK in sinks and LogSinks.CHANNEL in sinks:
+            # Both would post the same messages to the same channel.
+            sinks &= ~LogSinks.CHANNEL
+        messages = []
+        for kind, sink in self.sinks.items():
+            if kind not in sinks:
+                continue
+            if kind == LogSinks.WEBHOOK and not sink.available(channel):
+                # The webhooks couldn't be set up there recently, post as the bot right away.
+                kind, sink = LogSinks.CHANNEL, self.sinks[LogSinks.CHANNEL]
+            try:
+                sent = await sink.send(channel, embeds)
+            except discord.HTTPException as ex:
+                self.failed[kind] += 1
+                self.bot.log.error(
+                    f"Couldn't write log to {kind.name} of {channel}: {ex}"
+                )
+                if kind != LogSinks.WEBHOOK:
+                    continue
+                # No permission to manage webhooks or they went away, post as the bot instead.
+                kind = LogSinks.CHANNEL
+                try:
+                    sent = await self.sinks[kind].send(channel, embeds)
+                except discord.HTTPException as ex:
+                    self.failed[kind] += 1
+                    self.bot.log.error(f"Couldn't post log to {channel}: {ex}")
+                    continue
+            self.sent[kind] += len(embeds)
+            messages = messages or sent
+        return messages
+
+    async def publish(
+        self, channel: discord.TextChannel, embed: discord.Embed
+    ) -> Optional[discord.Message]:
+        """Posts an embed that will be edited later on, which always needs a Discord message."""
+        sinks = await self.sinks_of(channel.guild)
+        if not sinks & (LogSinks.CHANNEL | LogSinks.WEBHOOK):
+            sinks |= LogSinks.CHANNEL
+        messages = await self.post(channel, [embed], sinks)
+        return messages[0] if messages else None
+
+    async def edit(self, message: discord.Message, embed: discord.Embed):
+        """Edits a message posted by publish."""
+        if message.webhook_id:
+            await self.sinks[LogSinks.WEBHOOK].edit(message, embed)
+        else:
+            await message.edit(embed=embed)
 
 
 class ParseableTimedelta(timedelta):
@@ -246,3 +983,74 @@ class ParseableTimedelta(timedelta):
             delta += cls(seconds=int(secsm[1]))
 
         return delta
+
+
+class PurgeFilter:
+    """
+    Which messages a purge deletes, parsed from words like `from:@user bots contains:"free nitro"
+    regex:^! attachments links before:<message ID> after:<message ID>`. A message has to match
+    every given filter, and one of the authors if there are several.
+    """
+
+    USER = re.compile(r"<@!?(\d+)>|(\d+)")
+    LINK = re.compile(r"https?://\S+")
+
+    def __init__(self):
+        self.authors: typing.Set[int] = set()
+        self.bots = False
+        self.contains: List[str] = []
+        self.patterns: List[typing.Pattern] = []
+        self.attachments = False
+        self.links = False
+        self.before: Optional[int] = None
+        self.after: Optional[int] = None
+
+    @classmethod
+    async def convert(cls, _ctx: Fuzzy.Context, argument: str) -> "PurgeFilter":
+        purge_filter = cls()
+        try:
+            words = shlex.split(argument)
+        except ValueError as ex:
+            raise commands.BadArgument(f"Could not read the filters: {ex}.")
+        for word in words:
+            name, _, value = word.partition(":")
+            name = name.lower()
+            if name == "from" and cls.USER.fullmatch(value):
+                match = cls.USER.fullmatch(value)
+                purge_filter.authors.add(int(match[1] or match[2]))
+            elif name == "contains" and value:
+                purge_filter.contains.append(value.casefold())
+            elif name == "regex" and value:
+                try:
+                    purge_filter.patterns.append(re.compile(value))
+                except re.error as ex:
+                    raise commands.BadArgument(f"Invalid regex {value}: {ex}.")
+            elif name in ("before", "after") and value.isdigit():
+                setattr(purge_filter, name, int(value))
+            elif name in ("bots", "attachments", "links") and not value:
+                setattr(purge_filter, name, True)
+            else:
+                raise commands.BadArgument(f"Unknown filter {word}.")
+        return purge_filter
+
+    def __bool__(self) -> bool:
+        """Whether it filters by anything besides before and after."""
+        return bool(
+            self.authors
+            or self.bots
+            or self.contains
+            or self.patterns
+            or self.attachments
+            or self.links
+        )
+
+    def matches(self, message: discord.Message) -> bool:
+        content = message.content.casefold()
+        return (
+            (not self.authors or message.author.id in self.authors)
+            and (not self.bots or message.author.bot)
+            and all(text in content for text in self.contains)
+            and all(pattern.search(message.content) for pattern in self.patterns)
+            and (not self.attachments or bool(message.attachments))
+            and (not self.links or bool(self.LINK.search(message.content)))
+        )
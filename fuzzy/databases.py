@@ -1,23 +1,43 @@
+import asyncio
+import calendar
+import contextvars
+import functools
 import logging
 import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import fields
 from pathlib import Path
+from typing import Callable, Optional, Tuple
 
 from fuzzy.interfaces import *
 from fuzzy.models import *
 
+# Timestamps are stored as integer UTC epochs (see migration 002). Rows come back as plain tuples
+# and the repositories decode the epochs of the columns they know to be timestamps, which skips
+# the per-value declared type lookup and bytes round trip of a registered converter.
+sqlite3.register_adapter(datetime, lambda value: calendar.timegm(value.utctimetuple()))
+_from_epoch = datetime.utcfromtimestamp
+
+# The AsyncDatabase transaction the current context belongs to. Tasks copy the context they're
+# created in, so this tells the tasks started inside a transaction apart from unrelated ones.
+_transaction = contextvars.ContextVar("transaction", default=None)
+
 
 class Database:
     def __init__(self, config):
         self.config = config
+        self.settings = config["database"]
         self.log = logging.getLogger("fuzzy")
         self.log.setLevel(logging.INFO)
 
-        self.conn = sqlite3.connect(
-            config["database"]["path"],
-            isolation_level=None,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-        )
-        self.conn.row_factory = sqlite3.Row
+        # Threads that called open_reader() query through their own read-only connection, all
+        # others use the single write connection.
+        self.local = threading.local()
+        self.write_conn = self.connect()
+        # Cache updates of the writes in the open transaction, applied once it commits.
+        self.pending: List[Callable[[], None]] = []
         last_migration_number = 0
         try:
             last_migration_number = self.conn.execute(
@@ -39,719 +59,822 @@ class Database:
                 )
                 self.log.info(f"Applied migration {number}")
 
-        self.infractions = Infractions(self.conn, self)
-        self.pardons = Pardons(self.conn)
-        self.mutes = Mutes(self.conn, self)
-        self.guilds = Guilds(self.conn)
-        self.locks = Locks(self.conn, self)
-        self.published_messages = PublishedMessages(self.conn)
+        self.infractions = Infractions(self)
+        self.pardons = Pardons(self)
+        self.mutes = Mutes(self)
+        self.guilds = Guilds(self)
+        self.locks = Locks(self)
+        self.published_messages = PublishedMessages(self)
+        self.closed_dms = ClosedDirectMessages(self)
+        self.guilds.preload()
+        self.mutes.preload()
+        self.closed_dms.preload()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return getattr(self.local, "conn", self.write_conn)
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """Open a connection to the database, tuned by the [database] section of the config."""
+        path = self.settings["path"]
+        conn = sqlite3.connect(
+            f"file:{path}?mode=ro" if read_only else path,
+            uri=read_only,
+            isolation_level=None,
+        )
 
+        if not read_only:
+            # persistent, only needs to be set by the writer
+            journal_mode = self.settings.get("journal_mode", "WAL")
+            conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        for pragma, default in (
+            ("synchronous", "NORMAL"),
+            ("cache_size", "-16000"),
+            ("mmap_size", "268435456"),
+            ("busy_timeout", "5000"),
+        ):
+            conn.execute(f"PRAGMA {pragma}={self.settings.get(pragma, default)}")
+        return conn
+
+    def read_connections(self) -> int:
+        """How many read-only connections to open, none for in-memory databases."""
+        if self.settings["path"] == ":memory:":
+            return 0
+        return int(self.settings.get("read_connections", 2))
+
+    def open_reader(self) -> None:
+        """Give the calling thread its own read-only connection."""
+        self.local.conn = self.connect(read_only=True)
+
+    def begin(self) -> None:
+        self.conn.execute("BEGIN IMMEDIATE")
+
+    def commit(self) -> None:
+        self.conn.execute("COMMIT")
+        pending, self.pending = self.pending, []
+        for update in pending:
+            update()
+
+    def rollback(self) -> None:
+        self.conn.execute("ROLLBACK")
+        self.pending = []
+
+    def after_commit(self, update: Callable[[], None]) -> None:
+        """
+        Applies a write's cache update once it's committed, right away outside of a transaction.
+        The caches only ever hold committed data and are only changed by the writing thread.
+        """
+        if self.write_conn.in_transaction:
+            self.pending.append(update)
+        else:
+            update()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups all writes made inside into one atomic transaction, committed with a single disk
+        sync. Nested uses join the outermost transaction.
+        """
+        if self.conn.in_transaction:
+            yield self
+            return
+
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
 
-class Infractions(IInfractions):
-    def __init__(self, conn: sqlite3.Connection, db: Database):
-        self.conn = conn
-        self.db = db
 
-    def find_by_id(self, infraction_id: int, guild_id: int) -> Infraction:
-        infraction = None
-        try:
-            infraction = self.conn.execute(
-                "SELECT * FROM infractions WHERE oid=:id AND guild_id=:guild_id",
-                {"id": infraction_id, "guild_id": guild_id},
-            ).fetchone()
-        except sqlite3.DatabaseError:
-            pass
-        finally:
-            return (
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(guild_id),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction_id),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction_id, PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction_id, PublishType.UNBAN
-                    ),
-                )
-                if infraction
-                else None
-            )
+class AsyncRepository:
+    """Exposes every method of a repository as a coroutine that runs on the database thread."""
 
-    def find_by_id_only(self, infraction_id: int):
-        infraction = None
-        try:
-            infraction = self.conn.execute(
-                "SELECT * FROM infractions WHERE oid=:id",
-                {"id": infraction_id},
-            ).fetchone()
-        except sqlite3.DatabaseError:
-            pass
-        finally:
-            return (
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(infraction["guild_id"]),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction_id),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction_id, PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction_id, PublishType.UNBAN
-                    ),
-                )
-                if infraction
-                else None
-            )
+    def __init__(self, repository, database: "AsyncDatabase"):
+        self.repository = repository
+        self.database = database
 
-    def save(self, infraction: Infraction) -> Infraction:
-        if infraction.id:
-            self.conn.execute(
-                "UPDATE infractions SET reason=:reason, "
-                "moderator_id=:moderator_id, "
-                "moderator_name=:moderator_name WHERE oid=:id",
-                {
-                    "reason": infraction.reason,
-                    "moderator_id": infraction.moderator.id,
-                    "moderator_name": infraction.moderator.name,
-                    "id": infraction.id,
-                },
-            )
-            self.conn.commit()
-        else:
-            values = (
-                infraction.user.id,
-                infraction.user.name,
-                infraction.moderator.id,
-                infraction.moderator.name,
-                infraction.guild.id,
-                infraction.reason,
-                infraction.infraction_on,
-                infraction.infraction_type.value,
-            )
-            sql = """INSERT INTO infractions (user_id, user_name, moderator_id, moderator_name, guild_id, reason, 
-            infraction_on, infraction_type) VALUES(?,?,?,?,?,?,?,?)"""
-            try:
-                infraction.id = self.conn.execute(sql, values).lastrowid
-                self.conn.commit()
-            except sqlite3.DatabaseError:
-                pass
-        return self.find_by_id(infraction.id, infraction.guild.id)
+    def __getattr__(self, name: str):
+        method = getattr(self.repository, name)
+        if not callable(method):
+            return method
 
-    def delete(self, infraction_id: int) -> None:
-        self.db.pardons.delete(infraction_id)
-        self.db.published_messages.delete_all_with_id(infraction_id)
-        self.conn.execute(
-            "DELETE FROM infractions WHERE oid=:id", {"id": infraction_id}
+        async def run(*args, **kwargs):
+            if name.startswith("find"):
+                return await self.database.read(method, *args, **kwargs)
+            return await self.database.run(method, *args, **kwargs)
+
+        run.__name__ = name
+        run.__doc__ = method.__doc__
+        return run
+
+
+class AsyncGuilds(AsyncRepository):
+    """Serves cached guild settings straight from memory, without a trip to a database thread."""
+
+    async def find_by_id(self, guild_id: int) -> GuildSettings:
+        guild = self.repository.cached(guild_id)
+        if guild:
+            return guild
+        return await self.database.read(self.repository.find_by_id, guild_id)
+
+
+class AsyncMutes(AsyncRepository):
+    """Answers whether someone is muted from the in-memory index, querying only if they are."""
+
+    def indexed(self, user_id: int, guild_id: int) -> Optional[Tuple[int, datetime]]:
+        return self.repository.indexed(user_id, guild_id)
+
+    async def find_active_mute(self, user_id: int, guild_id: int) -> Optional[Mute]:
+        if not self.repository.indexed(user_id, guild_id):
+            return None
+        return await self.database.read(
+            self.repository.find_active_mute, user_id, guild_id
         )
-        self.conn.commit()
 
-    def find_recent_ban_by_id(self, user_id, guild_id) -> Infraction:
-        infraction = None
-        try:
-            infraction = self.conn.execute(
-                "SELECT * FROM infractions WHERE user_id=:user_id "
-                "AND guild_id=:guild_id ORDER BY DATETIME(infraction_on) DESC Limit 1",
-                {"user_id": user_id, "guild_id": guild_id},
-            ).fetchone()
-        except sqlite3.DatabaseError:
-            pass
 
-        return (
-            Infraction(
-                infraction["oid"],
-                DBUser(infraction["user_id"], infraction["user_name"]),
-                DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                self.db.guilds.find_by_id(guild_id),
-                infraction["reason"],
-                infraction["infraction_on"],
-                InfractionType(infraction["infraction_type"]),
-                self.db.pardons.find_by_id(infraction["oid"]),
-                self.db.published_messages.find_by_id_and_type(
-                    infraction["oid"], PublishType.BAN
-                ),
-                self.db.published_messages.find_by_id_and_type(
-                    infraction["oid"], PublishType.UNBAN
-                ),
+class AsyncDatabase:
+    """
+    The async front of the Database. Every repository call is queued to a dedicated database
+    thread and awaited, so a slow query or disk sync never blocks the event loop.
+    """
+
+    def __init__(self, config):
+        # A single worker: the executor's queue is the request queue and the sqlite connection is
+        # created on, and only ever used from, that one thread.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fuzzy-db")
+        self.sync: Database = self.executor.submit(Database, config).result()
+
+        # Pool of read-only connections, so log queries and the expiry checks run concurrently
+        # with command writes.
+        self.readers: Optional[ThreadPoolExecutor] = None
+        if self.sync.read_connections():
+            self.readers = ThreadPoolExecutor(
+                max_workers=self.sync.read_connections(),
+                thread_name_prefix="fuzzy-db-read",
+                initializer=self.sync.open_reader,
             )
-            if infraction
-            else None
+
+        # Held by an open transaction; everyone else waits for it so their statements don't end
+        # up inside (or get rolled back with) someone else's transaction.
+        self.lock = asyncio.Lock()
+        self.transaction_owner: Optional[asyncio.Task] = None
+        self.transaction_token: Optional[object] = None
+
+        self.infractions = AsyncRepository(self.sync.infractions, self)
+        self.pardons = AsyncRepository(self.sync.pardons, self)
+        self.mutes = AsyncMutes(self.sync.mutes, self)
+        self.guilds = AsyncGuilds(self.sync.guilds, self)
+        self.locks = AsyncRepository(self.sync.locks, self)
+        self.published_messages = AsyncRepository(self.sync.published_messages, self)
+        self.closed_dms = AsyncRepository(self.sync.closed_dms, self)
+
+    async def run(self, function: Callable, *args, **kwargs):
+        """Run a function on the database thread, e.g. one using several repositories of db.sync."""
+        call = functools.partial(function, *args, **kwargs)
+        self.check_spawned()
+        if self.in_transaction():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def read(self, function: Callable, *args, **kwargs):
+        """Run a read-only function on one of the read connections, if there are any."""
+        self.check_spawned()
+        if not self.readers or self.in_transaction():
+            # the transaction's own writes are only visible through the write connection
+            return await self.run(function, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, functools.partial(function, *args, **kwargs)
         )
 
-    def find_recent_ban_by_id_time_limited(self, user_id, guild_id) -> Infraction:
-        infraction = None
-        infraction_on = datetime.utcnow() - timedelta(minutes=1)
-        try:
-            infraction = self.conn.execute(
-                "SELECT * FROM infractions WHERE user_id=:user_id "
-                "AND guild_id=:guild_id AND DATETIME(infraction_on) > :infraction_on",
-                {"user_id": user_id, "guild_id": guild_id, "infraction_on": infraction_on},
-            ).fetchone()
-        except sqlite3.DatabaseError:
-            pass
-        return (
-            Infraction(
-                infraction["oid"],
-                DBUser(infraction["user_id"], infraction["user_name"]),
-                DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                self.db.guilds.find_by_id(guild_id),
-                infraction["reason"],
-                infraction["infraction_on"],
-                InfractionType(infraction["infraction_type"]),
-                self.db.pardons.find_by_id(infraction["oid"]),
-                self.db.published_messages.find_by_id_and_type(
-                    infraction["oid"], PublishType.BAN
-                ),
-                self.db.published_messages.find_by_id_and_type(
-                    infraction["oid"], PublishType.UNBAN
-                ),
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Wraps a command's database writes into one atomic transaction, see Database.transaction.
+        Keep Discord calls outside of it, other database users wait until it's done.
+        The transaction belongs to the task that opened it. Tasks started inside it, e.g. with
+        asyncio.gather, can't use the database until it's done and raise a RuntimeError instead
+        of waiting for it forever, so await the calls one by one.
+        """
+        self.check_spawned()
+        if self.in_transaction():
+            yield self
+            return
+
+        async with self.lock:
+            self.transaction_owner = asyncio.current_task()
+            self.transaction_token = object()
+            context = _transaction.set(self.transaction_token)
+            try:
+                await self.run(self.sync.begin)
+                try:
+                    yield self
+                except BaseException:
+                    await self.run(self.sync.rollback)
+                    raise
+                await self.run(self.sync.commit)
+            finally:
+                _transaction.reset(context)
+                self.transaction_owner = None
+                self.transaction_token = None
+
+    def in_transaction(self) -> bool:
+        """Whether the current task is the one holding the open transaction."""
+        return self.transaction_owner is asyncio.current_task()
+
+    def check_spawned(self) -> None:
+        """Raises if the current task was started inside the open transaction by its owner, it
+        would wait for the transaction while the owner waits for it."""
+        if (
+            self.transaction_token
+            and _transaction.get() is self.transaction_token
+            and not self.in_transaction()
+        ):
+            raise RuntimeError(
+                "A task started inside a database transaction can't use the database "
+                "before the transaction is done"
             )
-            if infraction
-            else None
+
+    def close(self):
+        """Finish the queued requests and close the connections."""
+        if self.readers:
+            self.readers.shutdown()
+        self.executor.submit(self.sync.write_conn.close).result()
+        self.executor.shutdown()
+
+
+class Repository:
+    """Base of the repositories. Queries run on the connection of the calling thread."""
+
+    def __init__(self, db: Database):
+        self.db = db
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.db.conn
+
+
+class Infractions(Repository, IInfractions):
+    # Loads infractions together with their pardon and both published messages, so hydrating a
+    # result set costs one query instead of four per row. Guild settings come from the cache.
+    # The column order is what _from_row indexes into.
+    HYDRATED_SELECT = (
+        "SELECT i.oid, i.user_id, i.user_name, i.moderator_id, i.moderator_name, "
+        "i.guild_id, i.reason, i.infraction_on, i.infraction_type, "
+        "p.infraction_id, p.moderator_id, p.moderator_name, p.pardon_on, p.reason, "
+        "pb.message_id, pu.message_id "
+        "FROM infractions i "
+        "LEFT JOIN pardons p ON p.infraction_id = i.oid "
+        "LEFT JOIN published_messages pb "
+        f"ON pb.infraction_id = i.oid AND pb.publish_type = {PublishType.BAN.value} "
+        "LEFT JOIN published_messages pu "
+        f"ON pu.infraction_id = i.oid AND pu.publish_type = {PublishType.UNBAN.value} "
+    )
+
+    def find_by_id(self, infraction_id: int, guild_id: int) -> Infraction:
+        infractions = self.find_hydrated(
+            "WHERE i.oid=:id AND i.guild_id=:guild_id",
+            {"id": infraction_id, "guild_id": guild_id},
         )
+        return infractions[0] if infractions else None
 
-    def find_all_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
-        expired_time = self.db.guilds.find_by_id(guild_id).infraction_expired_time()
+    def find_by_id_only(self, infraction_id: int):
+        infractions = self.find_hydrated("WHERE i.oid=:id", {"id": infraction_id})
+        return infractions[0] if infractions else None
 
-        infractions = []
+    def find_hydrated(self, clauses: str, parameters: Dict) -> List[Infraction]:
+        """Runs the hydrating select with the given WHERE/ORDER BY clauses and builds
+        the resulting infractions from the joined rows."""
+        rows = []
         try:
-            infractions = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE user_id=:user_id AND guild_id=:guild_id "
-                "AND DATETIME(infraction_on) > :expired_time "
-                "ORDER BY datetime(infraction_on) ASC",
-                {
-                    "user_id": user_id,
-                    "guild_id": guild_id,
-                    "expired_time": expired_time,
-                },
+            rows = self.conn.execute(
+                self.HYDRATED_SELECT + clauses, parameters
             ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        objectified_infractions = []
-        for infraction in infractions:
-            objectified_infractions.append(
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(guild_id),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction["oid"]),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.UNBAN
-                    ),
-                )
-            )
-        return objectified_infractions
 
-    def find_warns_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
-        expired_time = self.db.guilds.find_by_id(guild_id).infraction_expired_time()
+        return [self._from_row(row) for row in rows]
+
+    def _from_row(self, row: tuple) -> Infraction:
+        return Infraction(
+            row[0],
+            DBUser(row[1], row[2]),
+            DBUser(row[3], row[4]),
+            self.db.guilds.find_by_id(row[5]),
+            row[6],
+            _from_epoch(row[7]),
+            InfractionType(row[8]),
+            (
+                Pardon(row[9], DBUser(row[10], row[11]), _from_epoch(row[12]), row[13])
+                if row[9]
+                else None
+            ),
+            PublishedMessage(row[0], row[14], PublishType.BAN) if row[14] else None,
+            PublishedMessage(row[0], row[15], PublishType.UNBAN) if row[15] else None,
+        )
 
-        infractions = []
+    def save(self, infraction: Infraction) -> Infraction:
+        stored = None
         try:
-            infractions = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE user_id=:user_id AND guild_id=:guild_id "
-                "AND DATETIME(infraction_on) > :expired_time "
-                "AND infraction_type=:infraction_type "
-                "ORDER BY DATETIME(infraction_on) ASC",
-                {
-                    "user_id": user_id,
-                    "guild_id": guild_id,
-                    "expired_time": expired_time,
-                    "infraction_type": InfractionType.WARN.value,
-                },
-            ).fetchall()
+            if infraction.id:
+                stored = self.conn.execute(
+                    "UPDATE infractions SET reason=:reason, "
+                    "moderator_id=:moderator_id, "
+                    "moderator_name=:moderator_name, user_name=:user_name WHERE oid=:id "
+                    "RETURNING oid, infraction_on",
+                    {
+                        "reason": infraction.reason,
+                        "user_name": infraction.user.name,
+                        "moderator_id": infraction.moderator.id,
+                        "moderator_name": infraction.moderator.name,
+                        "id": infraction.id,
+                    },
+                ).fetchall()
+            else:
+                values = (
+                    infraction.user.id,
+                    infraction.user.name,
+                    infraction.moderator.id,
+                    infraction.moderator.name,
+                    infraction.guild.id,
+                    infraction.reason,
+                    infraction.infraction_on,
+                    infraction.infraction_type.value,
+                )
+                sql = """INSERT INTO infractions (user_id, user_name, moderator_id, moderator_name, guild_id, reason,
+                infraction_on, infraction_type) VALUES(?,?,?,?,?,?,?,?) RETURNING oid, infraction_on"""
+                stored = self.conn.execute(sql, values).fetchall()
         except sqlite3.DatabaseError:
             pass
-        objectified_infractions = []
-        for infraction in infractions:
-            objectified_infractions.append(
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(guild_id),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction["oid"]),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.UNBAN
-                    ),
-                )
+        if not stored:
+            return None
+
+        # Everything else of the infraction is as given: updates only touch the reason, moderator
+        # and user name, and a new infraction has no pardon or published messages yet.
+        infraction.id = stored[0][0]
+        infraction.infraction_on = _from_epoch(stored[0][1])
+        return infraction
+
+    def save_all(self, infractions: List[Infraction]) -> List[Infraction]:
+        with self.db.transaction():
+            return [self.save(infraction) for infraction in infractions]
+
+    def delete(self, infraction_id: int) -> None:
+        with self.db.transaction():
+            self.db.pardons.delete(infraction_id)
+            self.db.published_messages.delete_all_with_id(infraction_id)
+            self.conn.execute(
+                "DELETE FROM infractions WHERE oid=:id", {"id": infraction_id}
             )
-        return objectified_infractions
 
-    def find_mutes_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
+    def find_recent_ban_by_id(self, user_id, guild_id) -> Infraction:
+        infractions = self.find_hydrated(
+            "WHERE i.user_id=:user_id AND i.guild_id=:guild_id "
+            "ORDER BY i.infraction_on DESC, i.oid DESC LIMIT 1",
+            {"user_id": user_id, "guild_id": guild_id},
+        )
+        return infractions[0] if infractions else None
+
+    def find_all_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
         expired_time = self.db.guilds.find_by_id(guild_id).infraction_expired_time()
+        return self.find_hydrated(
+            "WHERE i.user_id=:user_id AND i.guild_id=:guild_id "
+            "AND i.infraction_on > :expired_time "
+            "ORDER BY i.infraction_on ASC, i.oid ASC",
+            {
+                "user_id": user_id,
+                "guild_id": guild_id,
+                "expired_time": expired_time,
+            },
+        )
 
-        infractions = []
-        try:
-            infractions = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE user_id=:user_id AND guild_id=:guild_id "
-                "AND DATETIME(infraction_on) > :expired_time "
-                "AND infraction_type=:infraction_type "
-                "ORDER BY DATETIME(infraction_on) ASC",
-                {
-                    "user_id": user_id,
-                    "guild_id": guild_id,
-                    "expired_time": expired_time,
-                    "infraction_type": InfractionType.MUTE.value,
-                },
-            ).fetchall()
-        except sqlite3.DatabaseError:
-            pass
-        objectified_infractions = []
-        for infraction in infractions:
-            objectified_infractions.append(
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(guild_id),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction["oid"]),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.UNBAN
-                    ),
-                )
-            )
-        return objectified_infractions
+    def find_warns_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
+        return self._find_type_for_user(user_id, guild_id, InfractionType.WARN)
+
+    def find_mutes_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
+        return self._find_type_for_user(user_id, guild_id, InfractionType.MUTE)
 
     def find_bans_for_user(self, user_id: int, guild_id: int) -> List[Infraction]:
+        return self._find_type_for_user(user_id, guild_id, InfractionType.BAN)
+
+    def _find_type_for_user(
+        self, user_id: int, guild_id: int, infraction_type: InfractionType
+    ) -> List[Infraction]:
         expired_time = self.db.guilds.find_by_id(guild_id).infraction_expired_time()
+        return self.find_hydrated(
+            "WHERE i.user_id=:user_id AND i.guild_id=:guild_id "
+            "AND i.infraction_on > :expired_time "
+            "AND i.infraction_type=:infraction_type "
+            "ORDER BY i.infraction_on ASC, i.oid ASC",
+            {
+                "user_id": user_id,
+                "guild_id": guild_id,
+                "expired_time": expired_time,
+                "infraction_type": infraction_type.value,
+            },
+        )
 
-        infractions = []
-        try:
-            infractions = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE user_id=:user_id AND guild_id=:guild_id "
-                "AND DATETIME(infraction_on) > :expired_time "
-                "AND infraction_type=:infraction_type "
-                "ORDER BY DATETIME(infraction_on) ASC",
-                {
-                    "user_id": user_id,
-                    "guild_id": guild_id,
-                    "expired_time": expired_time,
-                    "infraction_type": InfractionType.BAN.value,
-                },
-            ).fetchall()
-        except sqlite3.DatabaseError:
-            pass
-        objectified_infractions = []
-        for infraction in infractions:
-            objectified_infractions.append(
-                Infraction(
-                    infraction["oid"],
-                    DBUser(infraction["user_id"], infraction["user_name"]),
-                    DBUser(infraction["moderator_id"], infraction["moderator_name"]),
-                    self.db.guilds.find_by_id(guild_id),
-                    infraction["reason"],
-                    infraction["infraction_on"],
-                    InfractionType(infraction["infraction_type"]),
-                    self.db.pardons.find_by_id(infraction["oid"]),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.BAN
-                    ),
-                    self.db.published_messages.find_by_id_and_type(
-                        infraction["oid"], PublishType.UNBAN
-                    ),
-                )
-            )
-        return objectified_infractions
+    # Time windows (in days) the moderator statistics are broken down by.
+    MOD_ACTION_WINDOWS = (7, 30, 365)
 
     def find_mod_actions(self, moderator_id, guild_id) -> Dict:
-        warns = []
-        mutes = []
-        bans = []
+        """Counts the infractions a moderator handed out per type, keyed by "warns", "mutes"
+        and "bans". Each entry has the total, how many were pardoned, how many are still active
+        (neither pardoned nor expired) and the counts of the last MOD_ACTION_WINDOWS days."""
+        now = datetime.utcnow()
+        parameters = {
+            "moderator_id": moderator_id,
+            "guild_id": guild_id,
+            "expired_time": self.db.guilds.find_by_id(
+                guild_id
+            ).infraction_expired_time(),
+        }
+        windows = ""
+        for days in self.MOD_ACTION_WINDOWS:
+            parameters[f"since_{days}"] = now - timedelta(days=days)
+            windows += f", SUM(i.infraction_on > :since_{days})"
+
+        rows = []
         try:
-            warns = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE moderator_id=:moderator_id AND guild_id=:guild_id "
-                "AND infraction_type=:infraction_type",
-                {
-                    "moderator_id": moderator_id,
-                    "guild_id": guild_id,
-                    "infraction_type": InfractionType.WARN.value,
-                },
-            ).fetchall()
-            mutes = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE moderator_id=:moderator_id AND guild_id=:guild_id "
-                "AND infraction_type=:infraction_type",
-                {
-                    "moderator_id": moderator_id,
-                    "guild_id": guild_id,
-                    "infraction_type": InfractionType.MUTE.value,
-                },
-            ).fetchall()
-            bans = self.conn.execute(
-                "SELECT * FROM infractions "
-                "WHERE moderator_id=:moderator_id AND guild_id=:guild_id "
-                "AND infraction_type=:infraction_type",
-                {
-                    "moderator_id": moderator_id,
-                    "guild_id": guild_id,
-                    "infraction_type": InfractionType.BAN.value,
-                },
+            rows = self.conn.execute(
+                "SELECT i.infraction_type, COUNT(*), COUNT(p.infraction_id), "
+                "SUM(p.infraction_id IS NULL AND i.infraction_on > :expired_time)"
+                f"{windows} "
+                "FROM infractions i "
+                "LEFT JOIN pardons p ON p.infraction_id = i.oid "
+                "WHERE i.guild_id=:guild_id AND i.moderator_id=:moderator_id "
+                "GROUP BY i.infraction_type",
+                parameters,
             ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        return {"warns": len(warns), "mutes": len(mutes), "bans": len(bans)}
 
-
-class Pardons(IPardons):
-    def __init__(self, conn: sqlite3.Connection):
-        self.conn = conn
+        counts = {row[0]: row for row in rows}
+        no_actions = (None,) + (0,) * (3 + len(self.MOD_ACTION_WINDOWS))
+        actions = {}
+        for key, infraction_type in (
+            ("warns", InfractionType.WARN),
+            ("mutes", InfractionType.MUTE),
+            ("bans", InfractionType.BAN),
+        ):
+            row = counts.get(infraction_type.value, no_actions)
+            actions[key] = {
+                "total": row[1],
+                "pardoned": row[2],
+                "active": row[3],
+                "days": dict(zip(self.MOD_ACTION_WINDOWS, row[4:])),
+            }
+        return actions
+
+
+class Pardons(Repository, IPardons):
+    COLUMNS = "infraction_id, moderator_id, moderator_name, pardon_on, reason"
 
     def find_by_id(self, infraction_id: int) -> Pardon:
         pardon = None
         try:
             pardon = self.conn.execute(
-                "SELECT * FROM pardons WHERE infraction_id=:infraction_id",
+                f"SELECT {self.COLUMNS} FROM pardons WHERE infraction_id=:infraction_id",
                 {"infraction_id": infraction_id},
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return (
-                Pardon(
-                    pardon["infraction_id"],
-                    DBUser(pardon["moderator_id"], pardon["moderator_name"]),
-                    pardon["pardon_on"],
-                    pardon["reason"],
-                )
-                if pardon
-                else None
-            )
+        return self._from_row(pardon) if pardon else None
 
     def save(self, pardon: Pardon) -> Pardon:
-        retrieved_pardon = None
+        stored = []
         try:
-            retrieved_pardon = self.conn.execute(
-                "SELECT * FROM pardons WHERE infraction_id=:infraction_id",
-                {"infraction_id": pardon.infraction_id},
-            ).fetchone()
+            stored = self.conn.execute(
+                f"INSERT INTO pardons ({self.COLUMNS}) "
+                "VALUES(:infraction_id, :moderator_id, :moderator_name, :pardon_on, :reason) "
+                "ON CONFLICT(infraction_id) DO UPDATE SET reason=excluded.reason "
+                f"RETURNING {self.COLUMNS}",
+                {
+                    "infraction_id": pardon.infraction_id,
+                    "moderator_id": pardon.moderator.id,
+                    "moderator_name": pardon.moderator.name,
+                    "pardon_on": pardon.pardon_on,
+                    "reason": pardon.reason,
+                },
+            ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        if retrieved_pardon:
-            self.conn.execute(
-                "UPDATE pardons SET reason=:reason WHERE infraction_id=:infraction_id",
-                {"reason": pardon.reason, "infraction_id": pardon.infraction_id},
-            )
-            self.conn.commit()
-        else:
-            values = (
-                pardon.infraction_id,
-                pardon.moderator.id,
-                pardon.moderator.name,
-                pardon.pardon_on,
-                pardon.reason,
-            )
-            sql = """INSERT INTO pardons (infraction_id, moderator_id, moderator_name, pardon_on, reason)
-            Values(?,?,?,?,?)"""
-            self.conn.execute(sql, values)
-            self.conn.commit()
-
-        return self.find_by_id(pardon.infraction_id)
+        return self._from_row(stored[0]) if stored else None
 
     def delete(self, infraction_id: int) -> None:
         self.conn.execute(
             "DELETE FROM pardons WHERE infraction_id=:id", {"id": infraction_id}
         )
-        self.conn.commit()
 
+    @staticmethod
+    def _from_row(pardon: tuple) -> Pardon:
+        return Pardon(
+            pardon[0], DBUser(pardon[1], pardon[2]), _from_epoch(pardon[3]), pardon[4]
+        )
 
-class Mutes(IMutes):
-    def __init__(self, conn: sqlite3.Connection, db: Database):
-        self.conn = conn
-        self.db = db
+
+class Mutes(Repository, IMutes):
+    COLUMNS = "infraction_id, end_time, user_id, user_name"
+
+    def __init__(self, db: Database):
+        super().__init__(db)
+        # Index of the stored mutes by (guild ID, user ID), with their infraction ID and end time,
+        # so checking a member for a mute needs no query. Kept in sync by save and delete once
+        # they're committed.
+        self.index: Dict[Tuple[int, int], Tuple[int, datetime]] = {}
+        self.index_keys: Dict[int, Tuple[int, int]] = {}
+
+    def preload(self) -> None:
+        """(Re)builds the index from the stored mutes."""
+        rows = []
+        try:
+            rows = self.conn.execute(
+                "SELECT m.infraction_id, m.end_time, i.guild_id, m.user_id FROM mutes m "
+                "JOIN infractions i ON i.oid = m.infraction_id"
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            pass
+        self.index = {}
+        self.index_keys = {}
+        for infraction_id, end_time, guild_id, user_id in rows:
+            self._index(infraction_id, _from_epoch(end_time), guild_id, user_id)
+
+    def indexed(self, user_id: int, guild_id: int) -> Optional[Tuple[int, datetime]]:
+        entry = self.index.get((guild_id, user_id))
+        if entry and entry[1] > datetime.utcnow():
+            return entry
+        return None
+
+    def _index(
+        self, infraction_id: int, end_time: datetime, guild_id: int, user_id: int
+    ) -> None:
+        # Commands replace a member's mute, should there be several the longest one counts.
+        key = (guild_id, user_id)
+        if key not in self.index or self.index[key][1] <= end_time:
+            self.index[key] = (infraction_id, end_time)
+        self.index_keys[infraction_id] = key
 
     def find_by_id(self, infraction_id: int) -> Mute:
         mute = None
         try:
             mute = self.conn.execute(
-                "SELECT * FROM mutes WHERE infraction_id=:infraction_id",
+                f"SELECT {self.COLUMNS} FROM mutes WHERE infraction_id=:infraction_id",
                 {"infraction_id": infraction_id},
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return (
-                Mute(
-                    self.db.infractions.find_by_id_only(mute["infraction_id"]),
-                    mute["end_time"],
-                    DBUser(mute["user_id"], mute["user_name"]),
-                )
-                if mute
-                else None
-            )
+        return self._from_row(mute) if mute else None
 
-    def find_expired_mutes(self) -> List[Mute]:
-        mutes = []
+    def find_end_times(self) -> Dict[int, Tuple[datetime, int]]:
+        rows = []
         try:
-            mutes = self.conn.execute(
-                "SELECT * FROM mutes WHERE DATETIME(end_time) < :time",
-                {"time": datetime.utcnow()},
+            rows = self.conn.execute(
+                "SELECT m.infraction_id, m.end_time, i.guild_id FROM mutes m "
+                "JOIN infractions i ON i.oid = m.infraction_id"
             ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            objectified_mutes = []
-            for mute in mutes:
-                objectified_mutes.append(
-                    Mute(
-                        self.db.infractions.find_by_id_only(mute["infraction_id"]),
-                        mute["end_time"],
-                        DBUser(mute["user_id"], mute["user_name"]),
-                    )
-                )
-            return objectified_mutes
+        return {row[0]: (_from_epoch(row[1]), row[2]) for row in rows}
 
     def save(self, mute: Mute) -> Mute:
         values = (mute.infraction.id, mute.end_time, mute.user.id, mute.user.name)
-        sql = """INSERT INTO mutes (infraction_id, end_time, user_id, user_name) VALUES(?,?,?,?)"""
+        sql = f"""INSERT INTO mutes ({self.COLUMNS}) VALUES(?,?,?,?)
+        RETURNING end_time"""
+        stored = []
         try:
-            self.conn.execute(sql, values)
-            self.conn.commit()
+            stored = self.conn.execute(sql, values).fetchall()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return self.find_by_id(mute.infraction.id)
+        if not stored:
+            return None
+        end_time = _from_epoch(stored[0][0])
+        self.db.after_commit(
+            functools.partial(
+                self._index,
+                mute.infraction.id,
+                end_time,
+                mute.infraction.guild.id,
+                mute.user.id,
+            )
+        )
+        return Mute(mute.infraction, end_time, mute.user)
 
     def delete(self, infraction_id: int) -> None:
         self.conn.execute(
             "DELETE FROM mutes WHERE infraction_id=:id", {"id": infraction_id}
         )
-        self.conn.commit()
+        self.db.after_commit(functools.partial(self._unindex, infraction_id))
+
+    def _unindex(self, infraction_id: int) -> None:
+        key = self.index_keys.pop(infraction_id, None)
+        if key and self.index.get(key, (None,))[0] == infraction_id:
+            del self.index[key]
 
     def find_active_mute(self, user_id, guild_id) -> Mute:
         mute = None
         try:
             mute = self.conn.execute(
-                "SELECT * FROM mutes WHERE DATETIME(end_time) > :time AND user_id=:user_id",
-                {"time": datetime.utcnow(), "user_id": user_id},
+                "SELECT m.infraction_id, m.end_time, m.user_id, m.user_name FROM mutes m "
+                "JOIN infractions i ON i.oid = m.infraction_id "
+                "WHERE m.end_time > :time AND m.user_id=:user_id AND i.guild_id=:guild_id",
+                {"time": datetime.utcnow(), "user_id": user_id, "guild_id": guild_id},
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return (
-                Mute(
-                    self.db.infractions.find_by_id_only(mute["infraction_id"]),
-                    mute["end_time"],
-                    DBUser(mute["user_id"], mute["user_name"]),
-                )
-                if mute
-                else None
-            )
+        return self._from_row(mute) if mute else None
 
+    def _from_row(self, mute: tuple) -> Mute:
+        return Mute(
+            self.db.infractions.find_by_id_only(mute[0]),
+            _from_epoch(mute[1]),
+            DBUser(mute[2], mute[3]),
+        )
+
+
+class Guilds(Repository, IGuilds):
+    COLUMNS = "id, mod_log, public_log, duration_type, duration, mute_role, log_sinks"
+
+    def __init__(self, db: Database):
+        super().__init__(db)
+        # Guild settings only change through save and delete, so the settings of every guild are
+        # kept in memory and all callers share the one instance per guild. Only the writing
+        # thread changes the cache, once the change is committed, so callers must not change the
+        # shared instances: save a changed copy instead, i.e. made with dataclasses.replace.
+        self.cache: Dict[int, GuildSettings] = {}
+        self.hits = 0
+        self.misses = 0
 
-class Guilds(IGuilds):
-    def __init__(self, conn: sqlite3.Connection):
-        self.conn = conn
+    def preload(self) -> None:
+        """(Re)loads the settings of all guilds into the cache, keeping the shared instances."""
+        rows = []
+        try:
+            rows = self.conn.execute(f"SELECT {self.COLUMNS} FROM guilds").fetchall()
+        except sqlite3.DatabaseError:
+            pass
+        stored = {row[0]: self._from_row(row) for row in rows}
+        for guild_id in self.cache.keys() - stored.keys():
+            del self.cache[guild_id]
+        for guild in stored.values():
+            self._remember(guild)
+
+    def cached(self, guild_id: int) -> Optional[GuildSettings]:
+        """Returns the settings if they're cached, without touching the database."""
+        guild = self.cache.get(guild_id)
+        if guild:
+            self.hits += 1
+        return guild
 
     def find_by_id(self, guild_id: int) -> GuildSettings:
+        guild = self.cached(guild_id)
+        if guild:
+            return guild
+        self.misses += 1
+        return self._find_stored(guild_id)
+
+    def _find_stored(self, guild_id: int) -> Optional[GuildSettings]:
+        # Every committed guild is cached, so this only finds guilds saved by the open
+        # transaction. They're cached when it commits, not here: this may run on a reader.
         guild = None
         try:
             guild = self.conn.execute(
-                "SELECT * FROM guilds WHERE id=:id", {"id": guild_id}
+                f"SELECT {self.COLUMNS} FROM guilds WHERE id=:id", {"id": guild_id}
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return (
-                GuildSettings(
-                    guild["id"],
-                    guild["mod_log"],
-                    guild["public_log"],
-                    DurationType(guild["duration_type"])
-                    if guild["duration_type"]
-                    else None,
-                    guild["duration"],
-                    guild["mute_role"],
-                )
-                if guild
-                else None
-            )
+        return self._from_row(guild) if guild else None
+
+    def _remember(self, guild: GuildSettings) -> GuildSettings:
+        cached = self.cache.setdefault(guild.id, guild)
+        if cached is not guild:
+            for field in fields(GuildSettings):
+                setattr(cached, field.name, getattr(guild, field.name))
+        return cached
+
+    @staticmethod
+    def _from_row(guild: tuple) -> GuildSettings:
+        return GuildSettings(
+            guild[0],
+            guild[1],
+            guild[2],
+            DurationType(guild[3]) if guild[3] else None,
+            guild[4],
+            guild[5],
+            LogSinks(guild[6]) if guild[6] is not None else LogSinks.CHANNEL,
+        )
 
     def save(self, guild: GuildSettings) -> GuildSettings:
-        retrieved_guild = self.find_by_id(guild.id)
-        if retrieved_guild:
-            try:
-                self.conn.execute(
-                    "UPDATE guilds "
-                    "SET mod_log=:mod_log,"
-                    "public_log=:public_log,"
-                    "duration_type=:duration_type,"
-                    "duration=:duration,"
-                    "mute_role=:mute_role "
-                    "WHERE id=:id",
-                    {
-                        "mod_log": guild.mod_log,
-                        "public_log": guild.public_log,
-                        "duration_type": guild.duration_type.value,
-                        "duration": guild.duration,
-                        "mute_role": guild.mute_role,
-                        "id": guild.id,
-                    },
-                )
-                self.conn.commit()
-            except sqlite3.DatabaseError:
-                pass
-        else:
-            try:
-                values = (
-                    guild.id,
-                    guild.mod_log,
-                    guild.public_log,
-                    guild.duration_type.value,
-                    guild.duration,
-                    guild.mute_role,
-                )
-                sql = (
-                    "INSERT INTO guilds (id, mod_log, public_log, duration_type, duration, mute_role) "
-                    "VALUES(?,?,?,?,?,?)"
-                )
-                self.conn.execute(sql, values)
-                self.conn.commit()
-            except sqlite3.DatabaseError:
-                pass
-        return self.find_by_id(guild.id)
+        stored = []
+        try:
+            stored = self.conn.execute(
+                f"INSERT INTO guilds ({self.COLUMNS}) "
+                "VALUES(:id, :mod_log, :public_log, :duration_type, :duration, :mute_role, "
+                ":log_sinks) "
+                "ON CONFLICT(id) DO UPDATE SET "
+                "mod_log=excluded.mod_log,"
+                "public_log=excluded.public_log,"
+                "duration_type=excluded.duration_type,"
+                "duration=excluded.duration,"
+                "mute_role=excluded.mute_role,"
+                "log_sinks=excluded.log_sinks "
+                f"RETURNING {self.COLUMNS}",
+                {
+                    "id": guild.id,
+                    "mod_log": guild.mod_log,
+                    "public_log": guild.public_log,
+                    "duration_type": guild.duration_type.value,
+                    "duration": guild.duration,
+                    "mute_role": guild.mute_role,
+                    "log_sinks": guild.log_sinks.value,
+                },
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            pass
+        if not stored:
+            return None
+        saved = self._from_row(stored[0])
+        if self.db.write_conn.in_transaction:
+            # only shared once committed, until then the cache keeps the previous settings
+            self.db.after_commit(functools.partial(self._remember, saved))
+            return saved
+        return self._remember(saved)
 
     def delete(self, guild_id: int) -> None:
         self.conn.execute("DELETE FROM guilds WHERE id=:id", {"id": guild_id})
-        self.conn.commit()
+        self.db.after_commit(functools.partial(self.cache.pop, guild_id, None))
 
 
-class Locks(ILocks):
-    def __init__(self, conn: sqlite3.Connection, db: Database):
-        self.conn = conn
-        self.db = db
+class Locks(Repository, ILocks):
+    COLUMNS = (
+        "channel_id, previous_value, moderator_id, moderator_name, "
+        "guild_id, reason, end_time"
+    )
 
     def find_by_id(self, channel_id: int) -> Lock:
         lock = None
         try:
             lock = self.conn.execute(
-                "SELECT * FROM locks WHERE channel_id=:id", {"id": channel_id}
+                f"SELECT {self.COLUMNS} FROM locks WHERE channel_id=:id",
+                {"id": channel_id},
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            return (
-                Lock(
-                    lock["channel_id"],
-                    lock["previous_value"],
-                    DBUser(lock["moderator_id"], lock["moderator_name"]),
-                    self.db.guilds.find_by_id(lock["guild_id"]),
-                    lock["reason"],
-                    lock["end_time"],
-                )
-                if lock
-                else None
-            )
+        return self._from_row(lock) if lock else None
 
-    def find_expired_locks(self) -> List[Lock]:
-        locks = []
+    def find_end_times(self) -> Dict[int, Tuple[datetime, int]]:
+        rows = []
         try:
-            locks = self.conn.execute(
-                "SELECT * FROM locks WHERE DATETIME(end_time) < :time",
-                {"time": datetime.utcnow()},
+            rows = self.conn.execute(
+                "SELECT channel_id, end_time, guild_id FROM locks"
             ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        finally:
-            objectified_locks = []
-            for lock in locks:
-                objectified_locks.append(
-                    Lock(
-                        lock["channel_id"],
-                        lock["previous_value"],
-                        DBUser(lock["moderator_id"], lock["moderator_name"]),
-                        self.db.guilds.find_by_id(lock["guild_id"]),
-                        lock["reason"],
-                        lock["end_time"],
-                    )
-                )
-            return objectified_locks
+        return {row[0]: (_from_epoch(row[1]), row[2]) for row in rows}
 
     def save(self, lock: Lock) -> Lock:
-        retrieved_lock = self.find_by_id(lock.channel_id)
-        if retrieved_lock:
-            try:
-                self.conn.execute(
-                    "UPDATE locks SET "
-                    "moderator_id=:moderator_id,"
-                    "moderator_name=:moderator_name,"
-                    "reason=:reason,"
-                    "end_time=:end_time "
-                    "WHERE channel_id=channel_id",
-                    {
-                        "moderator_id": lock.moderator.id,
-                        "moderator_name": lock.moderator.name,
-                        "reason": lock.reason,
-                        "end_time": lock.end_time,
-                        "channel_id": lock.channel_id,
-                    },
-                )
-                self.conn.commit()
-            except sqlite3.DatabaseError:
-                pass
-        else:
-            try:
-                values = (
-                    lock.channel_id,
-                    lock.previous_value,
-                    lock.moderator.id,
-                    lock.moderator.name,
-                    lock.guild.id,
-                    lock.reason,
-                    lock.end_time,
-                )
-                sql = (
-                    "INSERT INTO locks (channel_id, previous_value, moderator_id, moderator_name, "
-                    "guild_id, reason, end_time) "
-                    "VALUES(?,?,?,?,?,?,?)"
-                )
-                self.conn.execute(sql, values)
-                self.conn.commit()
-            except sqlite3.DatabaseError:
-                pass
-        return self.find_by_id(lock.channel_id)
+        stored = []
+        try:
+            stored = self.conn.execute(
+                f"INSERT INTO locks ({self.COLUMNS}) "
+                "VALUES(:channel_id, :previous_value, :moderator_id, :moderator_name, "
+                ":guild_id, :reason, :end_time) "
+                "ON CONFLICT(channel_id) DO UPDATE SET "
+                "moderator_id=excluded.moderator_id,"
+                "moderator_name=excluded.moderator_name,"
+                "reason=excluded.reason,"
+                "end_time=excluded.end_time "
+                f"RETURNING {self.COLUMNS}",
+                {
+                    "channel_id": lock.channel_id,
+                    "previous_value": lock.previous_value,
+                    "moderator_id": lock.moderator.id,
+                    "moderator_name": lock.moderator.name,
+                    "guild_id": lock.guild.id,
+                    "reason": lock.reason,
+                    "end_time": lock.end_time,
+                },
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            pass
+        return self._from_row(stored[0]) if stored else None
 
     def delete(self, channel_id: int) -> None:
         self.conn.execute("DELETE FROM locks WHERE channel_id=:id", {"id": channel_id})
-        self.conn.commit()
+
+    def _from_row(self, lock: tuple) -> Lock:
+        return Lock(
+            lock[0],
+            lock[1],
+            DBUser(lock[2], lock[3]),
+            self.db.guilds.find_by_id(lock[4]),
+            lock[5],
+            _from_epoch(lock[6]),
+        )
 
 
-class PublishedMessages(IPublishedMessages):
-    def __init__(self, conn: sqlite3.Connection):
-        self.conn = conn
+class PublishedMessages(Repository, IPublishedMessages):
+    COLUMNS = "infraction_id, message_id, publish_type"
 
     def find_by_id_and_type(
         self, infraction_id: int, publish_type: PublishType
@@ -759,52 +882,98 @@ class PublishedMessages(IPublishedMessages):
         publish = None
         try:
             publish = self.conn.execute(
-                "SELECT * FROM published_messages WHERE infraction_id=:infraction_id "
-                "AND publish_type=:publish_type",
+                f"SELECT {self.COLUMNS} FROM published_messages "
+                "WHERE infraction_id=:infraction_id AND publish_type=:publish_type",
                 {"infraction_id": infraction_id, "publish_type": publish_type.value},
             ).fetchone()
         except sqlite3.DatabaseError:
             pass
-        return (
-            PublishedMessage(
-                publish["infraction_id"],
-                publish["message_id"],
-                PublishType(publish["publish_type"]),
-            )
-            if publish
-            else None
-        )
+        return self._from_row(publish) if publish else None
 
     def save(self, published_ban: PublishedMessage) -> PublishedMessage:
-        self.delete_with_type(published_ban.infraction_id, published_ban.publish_type)
+        stored = []
         try:
-            values = (
-                published_ban.infraction_id,
-                published_ban.message_id,
-                published_ban.publish_type.value,
-            )
-            sql = (
-                "INSERT INTO published_messages (infraction_id, message_id, publish_type) "
-                "VALUES(?,?,?)"
-            )
-            self.conn.execute(sql, values)
-            self.conn.commit()
+            stored = self.conn.execute(
+                f"INSERT INTO published_messages ({self.COLUMNS}) "
+                "VALUES(?,?,?) "
+                "ON CONFLICT(infraction_id, publish_type) DO UPDATE SET "
+                "message_id=excluded.message_id "
+                f"RETURNING {self.COLUMNS}",
+                (
+                    published_ban.infraction_id,
+                    published_ban.message_id,
+                    published_ban.publish_type.value,
+                ),
+            ).fetchall()
         except sqlite3.DatabaseError:
             pass
-        return self.find_by_id_and_type(
-            published_ban.infraction_id, published_ban.publish_type
-        )
+        return self._from_row(stored[0]) if stored else None
 
     def delete_with_type(self, infraction_id: int, publish_type: PublishType) -> None:
         self.conn.execute(
             "DELETE FROM published_messages WHERE infraction_id=:infraction_id AND publish_type=:publish_type",
             {"infraction_id": infraction_id, "publish_type": publish_type.value},
         )
-        self.conn.commit()
 
     def delete_all_with_id(self, infraction_id: int) -> None:
         self.conn.execute(
             "DELETE FROM published_messages WHERE infraction_id=:infraction_id",
             {"infraction_id": infraction_id},
         )
-        self.conn.commit()
+
+    @staticmethod
+    def _from_row(publish: tuple) -> PublishedMessage:
+        return PublishedMessage(publish[0], publish[1], PublishType(publish[2]))
+
+
+class ClosedDirectMessages(Repository, IClosedDirectMessages):
+    def __init__(self, db: Database):
+        super().__init__(db)
+        # Looked up before every direct message, so all of them are kept in memory.
+        self.cache: Dict[int, datetime] = {}
+
+    def preload(self) -> None:
+        self.cache = self.find_all()
+
+    def cached(self, user_id: int) -> Optional[datetime]:
+        return self.cache.get(user_id)
+
+    def find_all(self) -> Dict[int, datetime]:
+        rows = []
+        try:
+            rows = self.conn.execute(
+                "SELECT user_id, failed_on FROM closed_dms"
+            ).fetchall()
+        except sqlite3.DatabaseError:
+            pass
+        return {row[0]: _from_epoch(row[1]) for row in rows}
+
+    def save(self, user_id: int, failed_on: datetime) -> None:
+        self.conn.execute(
+            "INSERT INTO closed_dms (user_id, failed_on) VALUES(:user_id, :failed_on) "
+            "ON CONFLICT(user_id) DO UPDATE SET failed_on=excluded.failed_on",
+            {"user_id": user_id, "failed_on": failed_on},
+        )
+        self.db.after_commit(
+            functools.partial(self.cache.__setitem__, user_id, failed_on)
+        )
+
+    def delete(self, user_id: int) -> None:
+        self.conn.execute(
+            "DELETE FROM closed_dms WHERE user_id=:user_id", {"user_id": user_id}
+        )
+        self.db.after_commit(functools.partial(self.cache.pop, user_id, None))
+
+    def delete_before(self, time: datetime) -> int:
+        deleted = self.conn.execute(
+            "DELETE FROM closed_dms WHERE failed_on < :time", {"time": time}
+        ).rowcount
+        self.db.after_commit(functools.partial(self._forget_before, time))
+        return deleted
+
+    def _forget_before(self, time: datetime) -> None:
+        self.cache = {
+            user_id: failed_on
+            for user_id, failed_on in self.cache.items()
+            if failed_on >= time
+        }
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 from fuzzy.models import *
 
@@ -17,6 +17,11 @@ class IInfractions(ABC):
         """Saves an infraction into the database. If infraction already exists then updates the saved instance."""
         pass
 
+    @abstractmethod
+    def save_all(self, infractions: List[Infraction]) -> List[Infraction]:
+        """Saves several infractions in one transaction."""
+        pass
+
     @abstractmethod
     def delete(self, infraction_id: int) -> None:
         """Deletes an infraction from the database."""
@@ -67,7 +72,8 @@ class IMutes(ABC):
         pass
 
     @abstractmethod
-    def find_expired_mutes(self) -> List[Mute]:
+    def find_end_times(self) -> Dict[int, Tuple[datetime, int]]:
+        """Finds the end time and guild ID of every stored mute, keyed by infraction ID."""
         pass
 
     @abstractmethod
@@ -82,6 +88,10 @@ class IMutes(ABC):
     def find_active_mute(self, user_id, guild_id) -> Mute:
         pass
 
+    @abstractmethod
+    def indexed(self, user_id: int, guild_id: int) -> Optional[Tuple[int, datetime]]:
+        """The infraction ID and end time of the user's active mute in the guild, from memory."""
+
 
 class IGuilds(ABC):
     @abstractmethod
@@ -103,7 +113,8 @@ class ILocks(ABC):
         pass
 
     @abstractmethod
-    def find_expired_locks(self) -> List[Lock]:
+    def find_end_times(self) -> Dict[int, Tuple[datetime, int]]:
+        """Finds the end time and guild ID of every stored lock, keyed by channel ID."""
         pass
 
     @abstractmethod
@@ -133,3 +144,27 @@ class IPublishedMessages(ABC):
     @abstractmethod
     def delete_all_with_id(self, infraction_id: int):
         pass
+
+
+class IClosedDirectMessages(ABC):
+    """Manages the users whose direct messages recently failed."""
+
+    @abstractmethod
+    def cached(self, user_id: int) -> Optional[datetime]:
+        """When a direct message to the user last failed, from memory."""
+
+    @abstractmethod
+    def find_all(self) -> Dict[int, datetime]:
+        pass
+
+    @abstractmethod
+    def save(self, user_id: int, failed_on: datetime) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, user_id: int) -> None:
+        pass
+
+    @abstractmethod
+    def delete_before(self, time: datetime) -> int:
+        """Forgets the failures before the given time, returns how many there were."""
@@ -0,0 +1,86 @@
+-- Schema Version 2
+
+-- Timestamps are stored as integer seconds since the Unix epoch (UTC) so that they sort and compare
+-- natively and the time-filtered queries can be answered from an index. The repositories in
+-- databases.py turn the columns they know to be timestamps back into datetimes.
+
+-- Saved Infractions
+CREATE TABLE infractions_v2 (
+    oid             INTEGER         PRIMARY KEY,
+    user_id         INTEGER         NOT NULL,
+    user_name       TEXT            NOT NULL,
+    moderator_id    INTEGER         NOT NULL,
+    moderator_name  TEXT            NOT NULL,
+    guild_id        INTEGER         NOT NULL,
+    reason          TEXT,
+    infraction_on   INTEGER         NOT NULL,
+    infraction_type TEXT            NOT NULL,
+
+    FOREIGN KEY(guild_id) REFERENCES guilds(id)
+);
+INSERT INTO infractions_v2
+    SELECT oid, user_id, user_name, moderator_id, moderator_name, guild_id, reason,
+           CAST(strftime('%s', infraction_on) AS INTEGER), infraction_type
+    FROM infractions;
+DROP TABLE infractions;
+ALTER TABLE infractions_v2 RENAME TO infractions;
+
+-- Saved Pardons
+CREATE TABLE pardons_v2 (
+    infraction_id   INTEGER         NOT NULL,
+    moderator_id    INTEGER         NOT NULL,
+    moderator_name  TEXT            NOT NULL,
+    pardon_on       INTEGER         NOT NULL,
+    reason          TEXT,
+
+    FOREIGN KEY(infraction_id) REFERENCES infractions(oid)
+);
+INSERT INTO pardons_v2
+    SELECT infraction_id, moderator_id, moderator_name,
+           CAST(strftime('%s', pardon_on) AS INTEGER), reason
+    FROM pardons;
+DROP TABLE pardons;
+ALTER TABLE pardons_v2 RENAME TO pardons;
+
+-- SAVED MUTES
+CREATE TABLE mutes_v2 (
+    infraction_id   INTEGER         NOT NULL,
+    end_time        INTEGER         NOT NULL,
+    user_id         INTEGER         NOT NULL,
+    user_name       TEXT            NOT NULL,
+
+    FOREIGN KEY(infraction_id) REFERENCES infractions(oid)
+);
+INSERT INTO mutes_v2
+    SELECT infraction_id, CAST(strftime('%s', end_time) AS INTEGER), user_id, user_name
+    FROM mutes;
+DROP TABLE mutes;
+ALTER TABLE mutes_v2 RENAME TO mutes;
+
+-- Locked Channels
+CREATE TABLE locks_v2 (
+    channel_id      INTEGER         PRIMARY KEY,
+    previous_value  INTEGER         CHECK(previous_value == 1 OR previous_value == 0) ,--Bool + Null
+    moderator_id    INTEGER         NOT NULL,
+    moderator_name  TEXT            NOT NULL,
+    guild_id        INTEGER         NOT NULL,
+    reason          TEXT,
+    end_time        INTEGER         NOT NULL,
+
+    FOREIGN KEY(guild_id) REFERENCES guilds(id)
+);
+INSERT INTO locks_v2
+    SELECT channel_id, previous_value, moderator_id, moderator_name, guild_id, reason,
+           CAST(strftime('%s', end_time) AS INTEGER)
+    FROM locks;
+DROP TABLE locks;
+ALTER TABLE locks_v2 RENAME TO locks;
+
+-- Indexes
+CREATE INDEX infractions_guild_user_time ON infractions(guild_id, user_id, infraction_on);
+CREATE INDEX infractions_guild_moderator_type ON infractions(guild_id, moderator_id, infraction_type);
+CREATE INDEX pardons_infraction ON pardons(infraction_id);
+CREATE INDEX mutes_end_time ON mutes(end_time);
+CREATE INDEX mutes_user_end_time ON mutes(user_id, end_time);
+CREATE INDEX published_messages_infraction ON published_messages(infraction_id, publish_type);
+CREATE INDEX locks_end_time ON locks(end_time);
@@ -0,0 +1,15 @@
+-- Schema Version 3
+
+-- Pardons and published messages are unique per infraction (and publish type), which lets the
+-- repositories save them with a single upsert.
+DELETE FROM pardons
+    WHERE rowid NOT IN (SELECT MIN(rowid) FROM pardons GROUP BY infraction_id);
+DROP INDEX pardons_infraction;
+CREATE UNIQUE INDEX pardons_infraction ON pardons(infraction_id);
+
+DELETE FROM published_messages
+    WHERE rowid NOT IN (
+        SELECT MAX(rowid) FROM published_messages GROUP BY infraction_id, publish_type
+    );
+DROP INDEX published_messages_infraction;
+CREATE UNIQUE INDEX published_messages_infraction ON published_messages(infraction_id, publish_type);
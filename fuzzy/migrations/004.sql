@@ -0,0 +1,5 @@
+-- Schema Version 4
+
+-- Where the logs of a guild are written to, a combination of the LogSinks flags in models.py.
+-- NULL posts them to the mod log channel only.
+ALTER TABLE guilds ADD COLUMN log_sinks INTEGER;
@@ -0,0 +1,8 @@
+-- Schema Version 5
+
+-- Users whose direct messages recently failed because they don't accept any from the bot, so
+-- they're not tried again until the [discord] closed_dm_ttl has passed.
+CREATE TABLE closed_dms (
+    user_id         INTEGER         PRIMARY KEY,
+    failed_on       INTEGER         NOT NULL
+);
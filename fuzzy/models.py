@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from enum import Enum
+from enum import Enum, Flag
 
 import discord
 
@@ -22,14 +22,33 @@ class PublishType(Enum):
     UNBAN = 2
 
 
+class LogSinks(Flag):
+    """Where the logs of a guild are written to, any combination of these."""
+
+    CHANNEL = 1
+    WEBHOOK = 2
+    FILE = 4
+
+
 @dataclass
 class GuildSettings(object):
+    __slots__ = (
+        "id",
+        "mod_log",
+        "public_log",
+        "duration_type",
+        "duration",
+        "mute_role",
+        "log_sinks",
+    )
+
     id: int
     mod_log: int
     public_log: int
     duration_type: DurationType
     duration: int
     mute_role: int
+    log_sinks: LogSinks
 
     def infraction_expired_time(self) -> datetime:
         if self.duration_type.value == DurationType.DAYS.value:
@@ -42,20 +61,26 @@ class GuildSettings(object):
 
 @dataclass()
 class DBUser(object):
+    __slots__ = ("id", "name")
+
     id: int
     name: str
 
 
 @dataclass()
 class Pardon(object):
+    __slots__ = ("infraction_id", "moderator", "pardon_on", "reason")
+
     infraction_id: int
     moderator: DBUser
     pardon_on: datetime
     reason: str
 
 
-@dataclass()
+@dataclass(frozen=True)
 class PublishedMessage(object):
+    __slots__ = ("infraction_id", "message_id", "publish_type")
+
     infraction_id: int
     message_id: int
     publish_type: PublishType
@@ -63,6 +88,19 @@ class PublishedMessage(object):
 
 @dataclass()
 class Infraction(object):
+    __slots__ = (
+        "id",
+        "user",
+        "moderator",
+        "guild",
+        "reason",
+        "infraction_on",
+        "infraction_type",
+        "pardon",
+        "published_ban",
+        "published_unban",
+    )
+
     id: int
     user: DBUser
     moderator: DBUser
@@ -78,18 +116,25 @@ class Infraction(object):
     def create(
         cls,
         ctx,
-        who: discord.User,
+        who: discord.abc.Snowflake,
         reason: str,
         infraction_type: InfractionType,
+        guild: GuildSettings,
     ):
         """Creates a new Infraction ready to be stored in DB.
-        This will not have id pardon or published_ban attributes. Use normal constructor if those are required"""
+        This will not have id pardon or published_ban attributes. Use normal constructor if those are required.
+        `who` may be a discord.Object of a user only known by ID, their name is stored as unknown."""
         # noinspection PyTypeChecker
         return cls(
             None,
-            DBUser(who.id, f"{who.name}#{who.discriminator}"),
+            DBUser(
+                who.id,
+                "Unknown#????"
+                if isinstance(who, discord.Object)
+                else f"{who.name}#{who.discriminator}",
+            ),
             DBUser(ctx.author.id, f"{ctx.author.name}#{ctx.author.discriminator}"),
-            ctx.db.guilds.find_by_id(ctx.guild.id),
+            guild,
             reason,
             datetime.utcnow(),
             infraction_type,
@@ -101,6 +146,8 @@ class Infraction(object):
 
 @dataclass()
 class Mute(object):
+    __slots__ = ("infraction", "end_time", "user")
+
     infraction: Infraction
     end_time: datetime
     user: DBUser
@@ -108,6 +155,15 @@ class Mute(object):
 
 @dataclass()
 class Lock(object):
+    __slots__ = (
+        "channel_id",
+        "previous_value",
+        "moderator",
+        "guild",
+        "reason",
+        "end_time",
+    )
+
     channel_id: int
     previous_value: bool
     moderator: DBUser
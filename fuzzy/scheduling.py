@@ -0,0 +1,515 @@
+import asyncio
+import enum
+import functools
+import heapq
+import itertools
+import logging
+import typing
+from collections import Counter, deque
+from datetime import datetime
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+class FairWorkerPool:
+    """
+    Runs jobs of many groups (guilds) with at most `size` of them at a time and at most
+    `per_group` of one group. Groups with waiting jobs take turns, so a guild with a large backlog
+    can't hold up the others. The jobs of one group start in submission order.
+    """
+
+    def __init__(self, log: logging.Logger, size: int, per_group: int = 1):
+        self.log = log
+        self.size = size
+        self.per_group = per_group
+        self.queues: Dict[
+            Hashable, Deque[Tuple[Callable[[], Awaitable], asyncio.Future]]
+        ] = {}
+        # groups with waiting jobs, in the order they get their next turn
+        self.turns: Deque[Hashable] = deque()
+        self.running = Counter()
+        self.active = 0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def backlog(self) -> typing.Counter[Hashable]:
+        """Waiting and running jobs by group."""
+        backlog = Counter({group: len(queue) for group, queue in self.queues.items()})
+        backlog.update(self.running)
+        return backlog
+
+    def submit(self, group: Hashable, job: Callable[[], Awaitable]) -> asyncio.Future:
+        """Queues job, the returned future is done once it ran (failed jobs are logged)."""
+        done = asyncio.get_event_loop().create_future()
+        if group not in self.queues:
+            self.queues[group] = deque()
+            self.turns.append(group)
+        self.queues[group].append((job, done))
+        self.dispatch()
+        return done
+
+    def dispatch(self) -> None:
+        """Starts waiting jobs, one per group in turn, while there are free workers."""
+        passed = 0
+        while self.active < self.size and passed < len(self.turns):
+            group = self.turns.popleft()
+            if self.running[group] >= self.per_group:
+                self.turns.append(group)
+                passed += 1
+                continue
+
+            job, done = self.queues[group].popleft()
+            if self.queues[group]:
+                self.turns.append(group)
+            else:
+                del self.queues[group]
+            self.running[group] += 1
+            self.active += 1
+            asyncio.get_event_loop().create_task(self.run(group, job, done))
+            passed = 0
+
+    async def run(self, group: Hashable, job: Callable[[], Awaitable], done) -> None:
+        try:
+            await job()
+        except Exception:  # pylint: disable=broad-except
+            self.log.exception(f"Job of {group} failed")
+        finally:
+            done.set_result(None)
+            self.running[group] -= 1
+            if not self.running[group]:
+                del self.running[group]
+            self.active -= 1
+            self.dispatch()
+
+
+class ExpiryScheduler:
+    """
+    Runs a callback once the deadline of a scheduled key (a mute's infraction ID, a locked
+    channel's ID, ...) has passed. Deadlines are kept in a min-heap and the scheduler sleeps until
+    the earliest one, or until schedule/cancel change what the earliest one is, so nothing runs
+    while nothing is due. Due callbacks go through a FairWorkerPool grouped by guild.
+    """
+
+    def __init__(
+        self,
+        log: logging.Logger,
+        load: Callable[[], Awaitable[Dict[Hashable, Tuple[datetime, int]]]],
+        expire: Callable[[Hashable], Awaitable[None]],
+        workers: int = 8,
+        report: Callable[[int, int, int], Awaitable[None]] = None,
+        catch_up_rate: float = 5.0,
+        catch_up_chunk: int = 50,
+        guild_workers: int = 1,
+    ):
+        self.log = log
+        self.load = load
+        self.expire = expire
+        self.pool = FairWorkerPool(log, workers, guild_workers)
+
+        # Deadlines that passed while the bot was offline are caught up on separately, at most
+        # catch_up_rate per second in chunks of catch_up_chunk, instead of all at once. report is
+        # called with (guild ID, done, total) when a guild's catch-up starts and after every chunk
+        # with some of its deadlines, the last time with done == total.
+        self.report = report
+        self.catch_up_rate = catch_up_rate
+        self.catch_up_chunk = catch_up_chunk
+        self.catch_up_task: Optional[asyncio.Task] = None
+        self.overdue = 0
+
+        # The heap may hold outdated entries of rescheduled or cancelled keys, only the entry
+        # matching the key's current deadline counts. Those are skipped once they come up.
+        self.heap: List[Tuple[datetime, Hashable]] = []
+        self.deadlines: Dict[Hashable, datetime] = {}
+        self.guilds: Dict[Hashable, int] = {}
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+        self.wakeups = 0
+        self.expired = 0
+        # seconds between a deadline and its callback finishing
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def start(self) -> None:
+        """Loads the pending deadlines and starts waiting for them."""
+        self.task = asyncio.get_event_loop().create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.catch_up_task:
+            self.catch_up_task.cancel()
+            self.catch_up_task = None
+
+    def schedule(self, key: Hashable, deadline: datetime, guild_id: int) -> None:
+        """Expires key at deadline (naive UTC), replacing a deadline it already had."""
+        self.deadlines[key] = deadline
+        self.guilds[key] = guild_id
+        heapq.heappush(self.heap, (deadline, key))
+        self.changed.set()
+
+    def cancel(self, key: Hashable) -> None:
+        """Forgets the deadline of key, if it has one."""
+        if self.deadlines.pop(key, None):
+            del self.guilds[key]
+            self.changed.set()
+
+    def next_deadline(self) -> Optional[datetime]:
+        while self.heap and self.deadlines.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def mean_lag(self) -> float:
+        return self.total_lag / self.expired if self.expired else 0.0
+
+    async def run(self) -> None:
+        now = datetime.utcnow()
+        overdue = []
+        for key, (deadline, guild_id) in (await self.load()).items():
+            # a command may have (re)scheduled the key while loading
+            if key in self.deadlines:
+                continue
+            if deadline <= now:
+                overdue.append((deadline, key, guild_id))
+            else:
+                self.schedule(key, deadline, guild_id)
+        if overdue:
+            self.catch_up_task = asyncio.get_event_loop().create_task(
+                self.catch_up(sorted(overdue))
+            )
+
+        while True:
+            self.changed.clear()
+            deadline = self.next_deadline()
+            if not deadline:
+                await self.changed.wait()
+                self.wakeups += 1
+                continue
+
+            delay = (deadline - datetime.utcnow()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeups += 1
+                continue
+
+            _, key = heapq.heappop(self.heap)
+            del self.deadlines[key]
+            self.pool.submit(self.guilds.pop(key), self.job(key, deadline))
+
+    def job(self, key: Hashable, deadline: datetime) -> Callable[[], Awaitable]:
+        async def expire():
+            try:
+                await self.expire(key)
+            finally:
+                lag = (datetime.utcnow() - deadline).total_seconds()
+                self.expired += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+
+        return expire
+
+    async def catch_up(self, overdue: List[Tuple[datetime, Hashable, int]]) -> None:
+        loop = asyncio.get_event_loop()
+        self.overdue = len(overdue)
+        totals = Counter(guild_id for _, _, guild_id in overdue)
+        done = Counter()
+        self.log.info(f"Catching up on {len(overdue)} expirations")
+        await self.report_progress(totals, done)
+
+        for start in range(0, len(overdue), self.catch_up_chunk):
+            chunk = overdue[start : start + self.catch_up_chunk]
+            started = loop.time()
+            await asyncio.gather(
+                *(
+                    self.pool.submit(guild_id, functools.partial(self.expire, key))
+                    for _, key, guild_id in chunk
+                    # rescheduled since, e.g. a channel that was locked again
+                    if key not in self.deadlines
+                )
+            )
+            done.update(guild_id for _, _, guild_id in chunk)
+            self.overdue -= len(chunk)
+            self.log.info(f"Caught up on {start + len(chunk)}/{len(overdue)}")
+            await self.report_progress(
+                {guild_id: totals[guild_id] for _, _, guild_id in chunk}, done
+            )
+            await asyncio.sleep(
+                len(chunk) / self.catch_up_rate - (loop.time() - started)
+            )
+        self.catch_up_task = None
+
+    async def report_progress(self, totals: Dict[int, int], done: Dict[int, int]):
+        """Reports how far along catching up the guilds are."""
+        if not self.report:
+            return
+        for guild_id, total in totals.items():
+            try:
+                await self.report(guild_id, done.get(guild_id, 0), total)
+            except Exception:  # pylint: disable=broad-except
+                self.log.exception(f"Failed to report catch-up of {guild_id}")
+
+
+class ActionPriority(enum.IntEnum):
+    """What goes first when actions compete for the ActionQueue's workers, lowest first."""
+
+    MODERATION = 0
+    LOG = 1
+    DM = 2
+    # bulk work like purges, which may take long and shouldn't hold up anything else
+    CLEANUP = 3
+
+
+class ActionQueue:
+    """
+    The queue Discord side effects (role edits, bans, permission changes, log posts, DMs) are
+    submitted to. Each action names the guild it's done for and its rate limit route, Discord's
+    bucket of the endpoint and its major parameter, e.g. ("member_role", guild.id) or
+    ("messages", channel.id). Actions of one route run one after another, so a route's exhausted
+    bucket only stalls its own actions, and of the actions whose route is free the one with the
+    best priority runs next. Within a priority guilds take turns (fair queuing on a virtual clock)
+    and each guild has at most `per_guild` actions running, so one guild's mass action can't
+    delay everyone else's.
+    """
+
+    def __init__(self, log: logging.Logger, workers: int = 10, per_guild: int = 3):
+        self.log = log
+        self.workers = workers
+        self.per_guild = per_guild
+        self.tasks: List[asyncio.Task] = []
+        # The pending actions of each route, a heap of
+        # (priority, virtual finish, sequence, guild, route, action, future, enqueued at).
+        self.routes: Dict[Hashable, List[Tuple]] = {}
+        # The heads of the routes that aren't busy, the candidates to run next. Heads that were
+        # overtaken by a better action of their route, or whose route became busy, are outdated
+        # and dropped once they come up; a route's head is pushed again when it's free.
+        self.ready: List[Tuple] = []
+        # Heads that came up while their guild had per_guild actions running, until one finishes
+        self.parked: Dict[Optional[int], List[Tuple]] = {}
+        self.queued = 0
+        self.sequence = itertools.count()
+        # A guild's next action finishes one tick after its previous one, or after the current
+        # virtual time if it has nothing queued; a guild with a backlog queues behind itself only.
+        self.virtual_time = 0
+        self.last_finish: Dict[Optional[int], int] = {}
+        self.busy: Set[Hashable] = set()
+        self.running = Counter()
+        self.changed: Optional[asyncio.Event] = None
+
+        # seconds actions waited in the queue before they started, by priority
+        self.started = Counter()
+        self.total_wait = Counter()
+        self.max_wait = Counter()
+
+    def __len__(self) -> int:
+        return self.queued
+
+    def entries(self):
+        for pending in self.routes.values():
+            yield from pending
+
+    def depth(self, priority: ActionPriority) -> int:
+        return sum(1 for entry in self.entries() if entry[0] == priority)
+
+    def backlog(self) -> typing.Counter[Optional[int]]:
+        """Waiting and running actions by guild."""
+        backlog = Counter(entry[3] for entry in self.entries())
+        backlog.update(self.running)
+        return backlog
+
+    def mean_wait(self, priority: ActionPriority) -> float:
+        started = self.started[priority]
+        return self.total_wait[priority] / started if started else 0.0
+
+    def submit(
+        self,
+        priority: ActionPriority,
+        guild_id: Optional[int],
+        route: Hashable,
+        function: Callable[..., Awaitable],
+        *args,
+        **kwargs,
+    ) -> asyncio.Future:
+        """Queues function(*args, **kwargs), the future resolves to its result or exception."""
+        loop = asyncio.get_event_loop()
+        if not self.tasks:
+            self.changed = asyncio.Event()
+            self.tasks = [loop.create_task(self.work()) for _ in range(self.workers)]
+
+        finish = max(self.virtual_time, self.last_finish.get(guild_id, 0)) + 1
+        self.last_finish[guild_id] = finish
+        future = loop.create_future()
+        entry = (
+            priority,
+            finish,
+            next(self.sequence),
+            guild_id,
+            route,
+            functools.partial(function, *args, **kwargs),
+            future,
+            loop.time(),
+        )
+        pending = self.routes.setdefault(route, [])
+        heapq.heappush(pending, entry)
+        self.queued += 1
+        if route not in self.busy and pending[0] is entry:
+            heapq.heappush(self.ready, entry)
+            self.changed.set()
+        return future
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def take(self):
+        """Removes and returns the best pending action that may run now, if there is one, and
+        marks its route and guild busy until release."""
+        while self.ready:
+            entry = heapq.heappop(self.ready)
+            guild_id, route = entry[3], entry[4]
+            pending = self.routes.get(route)
+            if route in self.busy or not pending or pending[0] is not entry:
+                continue
+            if self.running[guild_id] >= self.per_guild:
+                self.parked.setdefault(guild_id, []).append(entry)
+                continue
+
+            heapq.heappop(pending)
+            if not pending:
+                del self.routes[route]
+            self.queued -= 1
+            self.busy.add(route)
+            self.running[guild_id] += 1
+            return entry
+        return None
+
+    def release(self, guild_id: Optional[int], route: Hashable) -> None:
+        """Frees the route and guild of a taken action, their waiting actions may run again."""
+        self.busy.discard(route)
+        if route in self.routes:
+            heapq.heappush(self.ready, self.routes[route][0])
+        self.running[guild_id] -= 1
+        if not self.running[guild_id]:
+            del self.running[guild_id]
+        for entry in self.parked.pop(guild_id, ()):
+            heapq.heappush(self.ready, entry)
+        self.changed.set()
+
+    async def work(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            entry = self.take()
+            if not entry:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+
+            priority, finish, _, guild_id, route, action, future, enqueued = entry
+            self.virtual_time = max(self.virtual_time, finish)
+            if self.last_finish.get(guild_id, 0) <= self.virtual_time:
+                self.last_finish.pop(guild_id, None)
+            wait = loop.time() - enqueued
+            self.started[priority] += 1
+            self.total_wait[priority] += wait
+            self.max_wait[priority] = max(self.max_wait[priority], wait)
+
+            try:
+                if future.cancelled():
+                    continue
+                result: Any = await action()
+            except Exception as ex:  # pylint: disable=broad-except
+                if not future.done():
+                    future.set_exception(ex)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.release(guild_id, route)
+
+
+class RetryingDispatcher:
+    """
+    Runs jobs in the background, at most `workers` at a time, so nobody has to wait for them. A
+    job failing with an error that `retryable` accepts is tried again up to `retries` times, after
+    `backoff`, 2 * `backoff`, ... seconds. The future of a job resolves to whether it succeeded
+    and never raises, failures are logged.
+    """
+
+    def __init__(
+        self,
+        log: logging.Logger,
+        retryable: Callable[[Exception], bool],
+        workers: int = 4,
+        retries: int = 3,
+        backoff: float = 2.0,
+    ):
+        self.log = log
+        self.retryable = retryable
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.active = 0
+
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    def __len__(self) -> int:
+        """Jobs that haven't finished yet."""
+        return len(self.tasks)
+
+    def submit(self, job: Callable[[], Awaitable]) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        if not self.slots:
+            self.slots = asyncio.Semaphore(self.workers)
+        future = loop.create_future()
+        task = loop.create_task(self.run(job, future))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return future
+
+    async def run(self, job: Callable[[], Awaitable], future: asyncio.Future) -> None:
+        for attempt in range(self.retries + 1):
+            async with self.slots:
+                self.active += 1
+                try:
+                    await job()
+                except Exception as ex:  # pylint: disable=broad-except
+                    error = ex
+                else:
+                    self.succeeded += 1
+                    future.set_result(True)
+                    return
+                finally:
+                    self.active -= 1
+            if attempt == self.retries or not self.retryable(error):
+                break
+            self.retried += 1
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.failed += 1
+        self.log.info(f"Gave up on {job}: {error}")
+        future.set_result(False)
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
@@ -1 +1,1227 @@
+import asyncio
+import calendar
+import configparser
+import dataclasses
+import json
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
 
+import discord
+import pytest
+from discord.ext import commands
+
+from fuzzy.cogs import Admin, Bans, Locks, Mutes, Purges
+from fuzzy.customizations import (
+    CatchUpLog,
+    FileSink,
+    Fuzzy,
+    HierarchyCache,
+    LogBuffer,
+    LogRouter,
+    PurgeFilter,
+)
+from fuzzy.databases import AsyncDatabase, Database
+from fuzzy.models import *
+from fuzzy.scheduling import (
+    ActionPriority,
+    ActionQueue,
+    ExpiryScheduler,
+    FairWorkerPool,
+    RetryingDispatcher,
+)
+
+MIGRATIONS = Path(__file__).parent.parent / "fuzzy" / "migrations"
+
+
+class PlanRecorder:
+    """Stands in for a connection and records the query plan of every SELECT it runs."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans = []
+
+    def execute(self, sql, parameters=()):
+        if sql.lstrip().upper().startswith("SELECT"):
+            plan = self.conn.execute("EXPLAIN QUERY PLAN " + sql, parameters)
+            self.plans.append((sql, [row[3] for row in plan.fetchall()]))
+        return self.conn.execute(sql, parameters)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+@pytest.fixture
+def db():
+    database = Database(
+        {"database": {"path": ":memory:", "migrations": str(MIGRATIONS)}}
+    )
+    database.guilds.save(
+        GuildSettings(1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL)
+    )
+    return database
+
+
+@pytest.fixture
+def plans(db):
+    db.write_conn = PlanRecorder(db.write_conn)
+    return db.write_conn.plans
+
+
+def assert_index_backed(plans):
+    assert plans
+    for sql, details in plans:
+        scans = [detail for detail in details if detail.startswith("SCAN")]
+        assert not scans, f"{sql} does a full scan: {scans}"
+        assert not any("TEMP B-TREE" in detail for detail in details), sql
+
+
+def test_user_finders_use_indexes(db, plans):
+    db.infractions.find_all_for_user(2, 1)
+    db.infractions.find_warns_for_user(2, 1)
+    db.infractions.find_mutes_for_user(2, 1)
+    db.infractions.find_bans_for_user(2, 1)
+    db.infractions.find_recent_ban_by_id(2, 1)
+    db.infractions.find_by_id(1, 1)
+    assert_index_backed(plans)
+
+
+def test_mod_actions_use_indexes(db, plans):
+    db.infractions.find_mod_actions(3, 1)
+    assert_index_backed(plans)
+
+
+def test_active_mute_query_uses_indexes(db, plans):
+    db.mutes.find_active_mute(2, 1)
+    assert_index_backed(plans)
+
+
+def test_timestamps_are_stored_as_epochs(db):
+    infraction_on = datetime(2021, 2, 3, 4, 5, 6)
+    infraction = db.infractions.save(
+        Infraction(
+            None,
+            DBUser(2, "user#0001"),
+            DBUser(3, "mod#0001"),
+            db.guilds.find_by_id(1),
+            "reason",
+            infraction_on,
+            InfractionType.WARN,
+            None,
+            None,
+            None,
+        )
+    )
+    db.mutes.save(
+        Mute(infraction, infraction_on + timedelta(hours=1), DBUser(2, "user#0001"))
+    )
+
+    stored = db.conn.execute(
+        "SELECT infraction_on, typeof(infraction_on) FROM infractions"
+    ).fetchone()
+    assert stored[0] == calendar.timegm(infraction_on.utctimetuple())
+    assert stored[1] == "integer"
+    assert db.mutes.find_by_id(infraction.id).end_time == infraction_on + timedelta(
+        hours=1
+    )
+    assert db.mutes.find_end_times() == {
+        infraction.id: (infraction_on + timedelta(hours=1), 1)
+    }
+
+
+def test_transaction_rolls_back_on_error(db):
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.guilds.save(
+                GuildSettings(
+                    2, None, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL
+                )
+            )
+            with db.transaction():
+                db.guilds.save(
+                    GuildSettings(
+                        3, None, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL
+                    )
+                )
+            raise RuntimeError()
+
+    assert db.guilds.find_by_id(2) is None
+    assert db.guilds.find_by_id(3) is None
+
+    with db.transaction():
+        db.guilds.save(
+            GuildSettings(2, None, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL)
+        )
+    assert db.guilds.find_by_id(2)
+
+
+def test_guild_settings_are_shared_and_counted(db):
+    guild = db.guilds.find_by_id(1)
+    assert db.guilds.find_by_id(1) is guild
+    assert db.guilds.find_by_id(2) is None
+    assert (db.guilds.hits, db.guilds.misses) == (2, 1)
+
+    saved = db.guilds.save(
+        GuildSettings(1, 5, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL)
+    )
+    assert saved is guild and guild.mod_log == 5
+    db.guilds.delete(1)
+    assert db.guilds.find_by_id(1) is None and 1 not in db.guilds.cache
+
+
+def test_caches_change_only_once_committed(db):
+    guild = db.guilds.find_by_id(1)
+    infraction = db.infractions.save(ban(2, guild))
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.guilds.save(
+                GuildSettings(1, 5, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL)
+            )
+            db.mutes.save(
+                Mute(infraction, datetime.utcnow() + timedelta(1), infraction.user)
+            )
+            db.closed_dms.save(2, datetime.utcnow())
+            assert guild.mod_log is None and not db.mutes.indexed(2, 1)
+            raise RuntimeError()
+    assert guild.mod_log is None and db.closed_dms.cached(2) is None
+    assert not db.mutes.indexed(2, 1)
+
+    with db.transaction():
+        db.guilds.save(
+            GuildSettings(1, 5, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL)
+        )
+        db.closed_dms.save(2, datetime.utcnow())
+        assert guild.mod_log is None and db.closed_dms.cached(2) is None
+    assert db.guilds.find_by_id(1) is guild and guild.mod_log == 5
+    assert db.closed_dms.cached(2)
+
+
+def test_failed_guild_settings_changes_leave_the_cache_alone(db):
+    guild = db.guilds.find_by_id(1)
+    with pytest.raises(AttributeError):
+        db.guilds.save(dataclasses.replace(guild, duration_type=None))
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.guilds.save(dataclasses.replace(guild, mod_log=5))
+            raise RuntimeError()
+    assert db.guilds.find_by_id(1) is guild
+    assert guild == GuildSettings(
+        1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL
+    )
+    assert db.infractions.find_all_for_user(2, 1) == []
+
+
+def test_admin_commands_change_guild_settings_only_by_saving_them():
+    async def post_log(*_, **__):
+        pass
+
+    async def reply(*_, **__):
+        pass
+
+    async def scenario():
+        database = AsyncDatabase(
+            {"database": {"path": ":memory:", "migrations": str(MIGRATIONS)}}
+        )
+        guild = await database.guilds.save(
+            GuildSettings(1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL)
+        )
+        admin = make_cog(Admin, db=database, post_log=post_log)
+        ctx = SimpleNamespace(
+            db=database, guild=SimpleNamespace(id=1), author=None, reply=reply
+        )
+        with pytest.raises(commands.BadArgument):
+            await Admin.auto_pardon.callback(admin, ctx, "5x")
+        unchanged = dataclasses.replace(guild)
+        ctx.author = SimpleNamespace(name="mod", discriminator="0001")
+        await Admin.auto_pardon.callback(admin, ctx, "6m")
+        stored = await database.run(database.sync.guilds._find_stored, 1)
+        database.close()
+        return guild, unchanged, stored
+
+    guild, unchanged, stored = asyncio.run(scenario())
+    assert unchanged.duration_type == DurationType.YEARS and unchanged.duration == 30
+    assert guild.duration_type == DurationType.MONTHS and guild.duration == 6
+    assert stored == guild
+
+
+def test_guild_lookups_of_readers_leave_the_cache_alone(tmp_path):
+    async def scenario():
+        database = AsyncDatabase(
+            {
+                "database": {
+                    "path": str(tmp_path / "fuzzy.db"),
+                    "migrations": str(MIGRATIONS),
+                    "read_connections": "2",
+                }
+            }
+        )
+        async with database.transaction():
+            saved = await database.guilds.save(
+                GuildSettings(
+                    1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL
+                )
+            )
+            inside = await database.guilds.find_by_id(1)
+            cached_inside = dict(database.sync.guilds.cache)
+        missing = await database.guilds.find_by_id(2)
+        found = await database.guilds.find_by_id(1)
+        database.close()
+        return saved, inside, cached_inside, missing, found, database.sync.guilds
+
+    saved, inside, cached_inside, missing, found, guilds = asyncio.run(scenario())
+    assert inside == saved and cached_inside == {}
+    assert missing is None and found is saved
+    assert list(guilds.cache) == [1] and (guilds.hits, guilds.misses) == (1, 2)
+
+
+def test_mod_actions_are_counted_per_type_and_window(db):
+    now = datetime.utcnow()
+    for days, infraction_type in (
+        (1, InfractionType.WARN),
+        (20, InfractionType.WARN),
+        (100, InfractionType.BAN),
+        (400, InfractionType.WARN),
+    ):
+        infraction = db.infractions.save(
+            Infraction(
+                None,
+                DBUser(2, "user#0001"),
+                DBUser(3, "mod#0001"),
+                db.guilds.find_by_id(1),
+                "reason",
+                now - timedelta(days=days),
+                infraction_type,
+                None,
+                None,
+                None,
+            )
+        )
+    db.pardons.save(Pardon(infraction.id - 2, DBUser(3, "mod#0001"), now, "oops"))
+
+    actions = db.infractions.find_mod_actions(3, 1)
+    assert actions["warns"] == {
+        "total": 3,
+        "pardoned": 1,
+        "active": 2,
+        "days": {7: 1, 30: 2, 365: 2},
+    }
+    assert actions["bans"]["total"] == 1 and actions["bans"]["days"][30] == 0
+    assert actions["mutes"] == {
+        "total": 0,
+        "pardoned": 0,
+        "active": 0,
+        "days": {7: 0, 30: 0, 365: 0},
+    }
+
+
+def ban(user_id, guild, infraction_on=None):
+    return Infraction(
+        None,
+        DBUser(user_id, f"user#{user_id:04}"),
+        DBUser(0, "Unknown#????"),
+        guild,
+        "",
+        infraction_on or datetime.utcnow(),
+        InfractionType.BAN,
+        None,
+        None,
+        None,
+    )
+
+
+def test_infractions_are_saved_in_one_batch(db):
+    guild = db.guilds.find_by_id(1)
+    saved = db.infractions.save_all([ban(user_id, guild) for user_id in range(1000)])
+    assert len({infraction.id for infraction in saved}) == 1000
+    assert db.infractions.find_bans_for_user(500, 1)[0].id == saved[500].id
+
+
+def test_async_transactions_commit_and_stay_isolated_from_readers(tmp_path):
+    async def scenario():
+        database = AsyncDatabase(
+            {
+                "database": {
+                    "path": str(tmp_path / "fuzzy.db"),
+                    "migrations": str(MIGRATIONS),
+                    "read_connections": "2",
+                }
+            }
+        )
+        guild = await database.guilds.save(
+            GuildSettings(1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL)
+        )
+        loop = asyncio.get_running_loop()
+
+        def read_outside(user_id):
+            return loop.run_in_executor(
+                database.readers,
+                database.sync.infractions.find_bans_for_user,
+                user_id,
+                1,
+            )
+
+        async with database.transaction():
+            await database.infractions.save(ban(2, guild))
+            inside = await database.infractions.find_bans_for_user(2, 1)
+            outside = await read_outside(2)
+        committed = await read_outside(2)
+
+        with pytest.raises(ValueError):
+            async with database.transaction():
+                await database.infractions.save(ban(3, guild))
+                raise ValueError()
+        rolled_back = await database.infractions.find_bans_for_user(3, 1)
+        database.close()
+        return inside, outside, committed, rolled_back
+
+    inside, outside, committed, rolled_back = asyncio.run(scenario())
+    assert len(inside) == 1 and outside == []
+    assert len(committed) == 1 and rolled_back == []
+
+
+def test_async_transactions_refuse_tasks_started_inside_them():
+    async def scenario():
+        database = AsyncDatabase(
+            {"database": {"path": ":memory:", "migrations": str(MIGRATIONS)}}
+        )
+        guild = await database.guilds.save(
+            GuildSettings(1, None, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL)
+        )
+        started = asyncio.Event()
+
+        async def outsider():
+            await started.wait()
+            return await database.infractions.save(ban(3, guild))
+
+        waiting = asyncio.create_task(outsider())
+        async with database.transaction():
+            started.set()
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(
+                    asyncio.gather(database.infractions.save(ban(2, guild))), 5
+                )
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(
+                    asyncio.create_task(database.guilds.find_by_id(2)), 5
+                )
+            await asyncio.sleep(0)
+            assert not waiting.done()
+        # unrelated tasks wait for the transaction instead, and so do later spawned ones
+        saved = await asyncio.wait_for(waiting, 5)
+        later = await asyncio.gather(database.infractions.find_bans_for_user(3, 1))
+        database.close()
+        return saved, later
+
+    saved, later = asyncio.run(scenario())
+    assert [infraction.id for infraction in later[0]] == [saved.id]
+
+
+def test_expiry_scheduler_runs_deadlines_in_order():
+    expired = []
+
+    async def load():
+        return {"loaded": (datetime.utcnow() + timedelta(milliseconds=30), 1)}
+
+    async def expire(key):
+        expired.append(key)
+
+    async def scenario():
+        scheduler = ExpiryScheduler(logging.getLogger("test"), load, expire)
+        scheduler.start()
+        scheduler.schedule("late", datetime.utcnow() + timedelta(milliseconds=60), 1)
+        scheduler.schedule(
+            "cancelled", datetime.utcnow() + timedelta(milliseconds=10), 1
+        )
+        scheduler.schedule("early", datetime.utcnow(), 1)
+        scheduler.cancel("cancelled")
+        await asyncio.sleep(0.1)
+        scheduler.stop()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert expired == ["early", "loaded", "late"]
+    assert len(scheduler) == 0 and scheduler.next_deadline() is None
+    assert scheduler.expired == 3 and 0 <= scheduler.max_lag < 0.1
+
+
+def test_worker_pool_orders_per_group_and_bounds_concurrency():
+    running = []
+    peak = []
+    finished = []
+
+    def job(group, number):
+        async def run():
+            running.append(group)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(group)
+            finished.append((group, number))
+
+        return run
+
+    async def scenario():
+        pool = FairWorkerPool(logging.getLogger("test"), 2)
+        for number in range(3):
+            for group in "abc":
+                pool.submit(group, job(group, number))
+        assert pool.backlog() == {"a": 3, "b": 3, "c": 3}
+        while pool.queues or pool.running:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(scenario())
+    assert max(peak) == 2
+    for group in "abc":
+        assert [n for g, n in finished if g == group] == [0, 1, 2]
+
+
+def test_worker_pool_lets_groups_take_turns():
+    started = []
+
+    def job(group):
+        async def run():
+            started.append(group)
+            await asyncio.sleep(0.001)
+
+        return run
+
+    async def scenario():
+        pool = FairWorkerPool(logging.getLogger("test"), 2, 2)
+        await asyncio.gather(
+            *[pool.submit("busy", job("busy")) for _ in range(6)],
+            pool.submit("quiet", job("quiet")),
+        )
+
+    asyncio.run(scenario())
+    # the busy group took both workers and had the next turn, then the quiet group got one
+    # instead of waiting for the whole backlog
+    assert started.index("quiet") == 3
+
+
+def test_expiry_scheduler_catches_up_in_chunks():
+    expired = []
+    reports = []
+    past = datetime.utcnow() - timedelta(hours=2)
+
+    async def load():
+        return {key: (past + timedelta(seconds=key), key % 2) for key in range(5)}
+
+    async def expire(key):
+        expired.append(key)
+
+    async def report(guild_id, done, total):
+        reports.append((guild_id, done, total))
+
+    async def scenario():
+        scheduler = ExpiryScheduler(
+            logging.getLogger("test"), load, expire, 8, report, 100.0, 2
+        )
+        started = asyncio.get_event_loop().time()
+        scheduler.start()
+        while scheduler.overdue or not expired:
+            await asyncio.sleep(0.005)
+        scheduler.stop()
+        return asyncio.get_event_loop().time() - started
+
+    elapsed = asyncio.run(scenario())
+    assert sorted(expired) == [0, 1, 2, 3, 4]
+    # the first two chunks of two take at least 0.02s each at 100 per second
+    assert elapsed >= 0.04
+    assert reports == [
+        (0, 0, 3),
+        (1, 0, 2),
+        (0, 1, 3),
+        (1, 1, 2),
+        (0, 2, 3),
+        (1, 2, 2),
+        (0, 3, 3),
+    ]
+
+
+def test_catch_up_log_edits_one_message_per_guild():
+    posted = []
+
+    async def find_by_id(guild_id):
+        return GuildSettings(
+            guild_id, 2, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL
+        )
+
+    async def resolve_channel(channel_id):
+        return SimpleNamespace(id=channel_id)
+
+    async def publish(channel, embed):
+        message = SimpleNamespace(descriptions=[embed.description])
+        posted.append(message)
+        return message
+
+    async def edit(message, embed):
+        message.descriptions.append(embed.description)
+
+    bot = SimpleNamespace(
+        db=SimpleNamespace(guilds=SimpleNamespace(find_by_id=find_by_id)),
+        resolve_channel=resolve_channel,
+        log_router=SimpleNamespace(publish=publish, edit=edit),
+    )
+
+    async def scenario():
+        catch_up = CatchUpLog(bot, "mutes")
+        for done in (0, 50, 100, 120):
+            await catch_up.report(1, done, 120)
+        await catch_up.report(1, 0, 3)
+        return catch_up
+
+    catch_up = asyncio.run(scenario())
+    assert [message.descriptions for message in posted] == [
+        [
+            "Lifting 120 mutes that expired while offline, 0 done.",
+            "Lifting 120 mutes that expired while offline, 50 done.",
+            "Lifting 120 mutes that expired while offline, 100 done.",
+            "Lifted all 120 mutes that expired while offline.",
+        ],
+        ["Lifting 3 mutes that expired while offline, 0 done."],
+    ]
+    assert list(catch_up.messages) == [1]
+
+
+def test_action_queue_prioritizes_and_serializes_routes():
+    order = []
+    running = set()
+
+    async def action(name, route):
+        assert route not in running
+        running.add(route)
+        await asyncio.sleep(0.01)
+        running.remove(route)
+        order.append(name)
+        return name
+
+    async def scenario():
+        queue = ActionQueue(logging.getLogger("test"), 1)
+        results = [
+            queue.submit(ActionPriority.DM, None, "a", action, "dm", "a"),
+            queue.submit(ActionPriority.LOG, 1, "b", action, "log", "b"),
+            queue.submit(ActionPriority.MODERATION, 1, "c", action, "ban", "c"),
+        ]
+        assert len(queue) == 3 and queue.depth(ActionPriority.LOG) == 1
+        results = await asyncio.gather(*results)
+        queue.close()
+        # more workers than routes, but the second action of route c waits for the first
+        busy_queue = ActionQueue(logging.getLogger("test"), 3)
+        await asyncio.gather(
+            busy_queue.submit(ActionPriority.LOG, 1, "c", action, "first", "c"),
+            busy_queue.submit(ActionPriority.LOG, 1, "c", action, "second", "c"),
+        )
+        busy_queue.close()
+        return queue, results
+
+    queue, results = asyncio.run(scenario())
+    assert order == ["ban", "log", "dm", "first", "second"]
+    assert results == ["dm", "log", "ban"]
+    assert queue.started[ActionPriority.DM] == 1
+    assert queue.max_wait[ActionPriority.DM] >= queue.max_wait[ActionPriority.LOG]
+
+
+def test_action_queue_lets_guilds_take_turns():
+    order = []
+
+    async def action(guild_id):
+        await asyncio.sleep(0.001)
+        order.append(guild_id)
+
+    async def scenario():
+        queue = ActionQueue(logging.getLogger("test"), 1, 1)
+        actions = [
+            queue.submit(ActionPriority.LOG, 1, ("messages", n), action, 1)
+            for n in range(4)
+        ]
+        actions.append(queue.submit(ActionPriority.LOG, 2, ("messages", 9), action, 2))
+        assert queue.backlog() == {1: 4, 2: 1}
+        await asyncio.gather(*actions)
+        queue.close()
+
+    asyncio.run(scenario())
+    assert order == [1, 2, 1, 1, 1]
+
+
+def test_action_queue_only_considers_the_heads_of_free_routes():
+    candidates = []
+    order = []
+    queue = ActionQueue(logging.getLogger("test"), 4, 2)
+
+    async def action(name):
+        candidates.append(len(queue.ready) + len(queue.parked))
+        await asyncio.sleep(0)
+        order.append(name)
+
+    async def scenario():
+        bans = [
+            queue.submit(ActionPriority.MODERATION, 1, ("ban", 1), action, "ban")
+            for _ in range(2000)
+        ]
+        role = queue.submit(ActionPriority.LOG, 2, ("member_role", 2), action, "role")
+        await asyncio.gather(role, *bans)
+        queue.close()
+
+    asyncio.run(scenario())
+    # the other guild's action doesn't queue behind the mass ban
+    assert order.index("role") < 2 and len(order) == 2001
+    # the waiting bans are never candidates, only their route's head is
+    assert max(candidates) <= 2
+    assert len(queue) == 0 and not queue.routes and not queue.running
+
+
+def test_log_buffer_packs_entries_within_embed_limits():
+    good, bad = Fuzzy.Context.Color.GOOD, Fuzzy.Context.Color.BAD
+    entries = [(f"**Warn**\nentry {i} " + "x" * 180, good) for i in range(60)]
+    entries += [("z" * 3000, bad), ("short", good)]
+    embeds = LogBuffer.pack(entries)
+
+    for embed in embeds:
+        assert len(embed.description) <= LogBuffer.DESCRIPTION_LIMIT
+        assert len(embed.fields) <= LogBuffer.FIELD_COUNT
+        assert all(len(field.value) <= LogBuffer.FIELD_LIMIT for field in embed.fields)
+        assert len(embed) <= LogBuffer.EMBED_LIMIT
+    texts = [
+        part
+        for embed in embeds
+        for part in [embed.description, *(field.value for field in embed.fields)]
+    ]
+    assert "\n".join(texts).count("entry") == 60
+    assert "".join(texts).count("z") == 3000
+    # 60 entries fit into 2 embeds, the color changes start new ones
+    assert [embed.color.value for embed in embeds] == [good, good, bad, good]
+
+
+def test_log_sinks_are_stored_and_written_as_json_lines(db, tmp_path):
+    guild = db.guilds.find_by_id(1)
+    assert guild.log_sinks == LogSinks.CHANNEL
+    db.guilds.save(
+        dataclasses.replace(guild, log_sinks=LogSinks.WEBHOOK | LogSinks.FILE)
+    )
+    db.guilds.cache.clear()
+    assert db.guilds.find_by_id(1).log_sinks == LogSinks.WEBHOOK | LogSinks.FILE
+
+    path = tmp_path / "log.jsonl"
+    sink = FileSink(str(path), 250, 1)
+    channel = SimpleNamespace(id=2, guild=SimpleNamespace(id=1))
+    embeds = [discord.Embed(description=f"entry {i}") for i in range(3)]
+    assert asyncio.run(sink.send(channel, embeds)) == []
+
+    lines = [
+        json.loads(line)
+        for file in sorted(tmp_path.iterdir())
+        for line in file.read_text().splitlines()
+    ]
+    assert sorted(line["description"] for line in lines) == [
+        "entry 0",
+        "entry 1",
+        "entry 2",
+    ]
+    assert all(line["guild"] == 1 and line["channel"] == 2 for line in lines)
+    assert (tmp_path / "log.jsonl.1").exists()
+
+
+def test_webhook_setup_failures_are_remembered_per_channel(tmp_path):
+    lookups, posted = [], []
+
+    async def webhooks():
+        lookups.append(1)
+        raise discord.Forbidden(
+            SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions"
+        )
+
+    async def send(embed):
+        posted.append(embed)
+        return embed
+
+    config = configparser.ConfigParser()
+    config.read_dict({"log": {"sink_path": str(tmp_path / "log.jsonl")}})
+    channel = SimpleNamespace(
+        id=2, guild=SimpleNamespace(id=1), webhooks=webhooks, send=send
+    )
+    embeds = [discord.Embed(description="entry")]
+
+    async def scenario():
+        bot = SimpleNamespace(
+            log=logging.getLogger("test"),
+            actions=ActionQueue(logging.getLogger("test")),
+        )
+        router = LogRouter(bot, config["log"])
+        webhook = router.sinks[LogSinks.WEBHOOK]
+        for _ in range(3):
+            await router.post(channel, embeds, LogSinks.WEBHOOK)
+        first_backoff = webhook.failures[2][2]
+        # as if the backoff ran out, it's doubled after failing again
+        webhook.failures[2] = (1, datetime.utcnow(), first_backoff)
+        await router.post(channel, embeds, LogSinks.WEBHOOK)
+        second_backoff = webhook.failures[2][2]
+        webhook.retry(1)
+        available = webhook.available(channel)
+        bot.actions.close()
+        return router, first_backoff, second_backoff, available
+
+    router, first_backoff, second_backoff, available = asyncio.run(scenario())
+    assert len(lookups) == 2 and len(posted) == 4
+    assert router.sent[LogSinks.CHANNEL] == 4 and router.failed[LogSinks.WEBHOOK] == 2
+    assert second_backoff == 2 * first_backoff and available
+
+
+def test_retrying_dispatcher_retries_temporary_errors_only():
+    async def scenario():
+        dispatcher = RetryingDispatcher(
+            logging.getLogger("test"),
+            lambda error: isinstance(error, TimeoutError),
+            workers=2,
+            retries=2,
+            backoff=0.001,
+        )
+        attempts = Counter()
+        running = []
+
+        def job(name, failures, error):
+            async def attempt():
+                attempts[name] += 1
+                running.append(dispatcher.active)
+                await asyncio.sleep(0.001)
+                if attempts[name] <= failures:
+                    raise error
+
+            return attempt
+
+        results = await asyncio.gather(
+            dispatcher.submit(job("flaky", 2, TimeoutError())),
+            dispatcher.submit(job("down", 5, TimeoutError())),
+            dispatcher.submit(job("forbidden", 1, PermissionError())),
+            dispatcher.submit(job("fine", 0, None)),
+        )
+        return dispatcher, attempts, running, results
+
+    dispatcher, attempts, running, results = asyncio.run(scenario())
+    assert results == [True, False, False, True]
+    assert attempts == {"flaky": 3, "down": 3, "forbidden": 1, "fine": 1}
+    assert max(running) <= 2
+    assert (dispatcher.succeeded, dispatcher.failed, dispatcher.retried) == (2, 2, 4)
+    assert len(dispatcher) == 0
+
+
+def test_closed_direct_messages_are_cached_and_expire(db):
+    now = datetime.utcnow().replace(microsecond=0)
+    db.closed_dms.save(10, now - timedelta(days=2))
+    db.closed_dms.save(11, now)
+    db.closed_dms.save(11, now + timedelta(seconds=5))
+    assert db.closed_dms.cached(11) == now + timedelta(seconds=5)
+
+    db.closed_dms.cache.clear()
+    db.closed_dms.preload()
+    assert db.closed_dms.find_all() == db.closed_dms.cache
+    assert db.closed_dms.cached(10) == now - timedelta(days=2)
+
+    assert db.closed_dms.delete_before(now - timedelta(days=1)) == 1
+    assert db.closed_dms.cached(10) is None
+    db.closed_dms.delete(11)
+    assert db.closed_dms.find_all() == {} and db.closed_dms.cache == {}
+
+
+def test_purge_filter_parses_and_matches():
+    purge_filter = asyncio.run(
+        PurgeFilter.convert(
+            None,
+            'from:<@!123456789012345678> from:42 contains:"Free Nitro" links after:100',
+        )
+    )
+    assert purge_filter.authors == {123456789012345678, 42}
+    assert purge_filter.after == 100 and purge_filter.before is None
+    assert purge_filter
+
+    def message(author_id, content, bot=False):
+        return SimpleNamespace(
+            author=SimpleNamespace(id=author_id, bot=bot),
+            content=content,
+            attachments=[],
+        )
+
+    assert purge_filter.matches(message(42, "free nitro at https://example.com"))
+    assert not purge_filter.matches(message(7, "free nitro at https://example.com"))
+    assert not purge_filter.matches(message(42, "free nitro, no link"))
+    assert not asyncio.run(PurgeFilter.convert(None, "before:5"))
+    for invalid in ("nonsense", "regex:(", 'contains:"open'):
+        with pytest.raises(commands.BadArgument):
+            asyncio.run(PurgeFilter.convert(None, invalid))
+
+
+def test_active_mutes_are_indexed_per_guild(db):
+    db.guilds.save(
+        GuildSettings(2, None, None, DurationType.DAYS, 1, None, LogSinks.CHANNEL)
+    )
+    moderator = DBUser(9, "mod#0001")
+    mutes = []
+    for guild_id, days in ((1, 1), (2, 1), (1, -1)):
+        infraction = db.infractions.save(
+            Infraction(
+                None,
+                DBUser(5, "user#0001"),
+                moderator,
+                db.guilds.find_by_id(guild_id),
+                "",
+                datetime.utcnow(),
+                InfractionType.MUTE,
+                None,
+                None,
+                None,
+            )
+        )
+        mute = Mute(
+            infraction, datetime.utcnow() + timedelta(days=days), infraction.user
+        )
+        mutes.append(db.mutes.save(mute))
+    # the expired mute doesn't replace the active one in guild 1
+    assert db.mutes.indexed(5, 1)[0] == mutes[0].infraction.id
+    assert db.mutes.indexed(5, 2)[0] == mutes[1].infraction.id
+    assert db.mutes.find_active_mute(5, 2).infraction.id == mutes[1].infraction.id
+    assert db.mutes.find_active_mute(5, 1).infraction.id == mutes[0].infraction.id
+
+    db.mutes.delete(mutes[2].infraction.id)
+    db.mutes.preload()
+    assert db.mutes.indexed(5, 1)[0] == mutes[0].infraction.id
+    db.mutes.delete(mutes[1].infraction.id)
+    assert db.mutes.indexed(5, 2) is None
+    assert db.mutes.find_active_mute(5, 2) is None
+
+
+def test_hierarchy_cache_ranks_roles_until_invalidated():
+    roles = [SimpleNamespace(id=role_id) for role_id in (10, 11, 12, 13)]
+    guild = SimpleNamespace(
+        id=1, roles=roles, me=SimpleNamespace(top_role=roles[2]), owner_id=99
+    )
+    cache = HierarchyCache(SimpleNamespace(add_listener=lambda *_: None))
+
+    def member(member_id, top_role):
+        return SimpleNamespace(id=member_id, guild=guild, top_role=top_role)
+
+    assert cache.of(guild).bot_rank == 2
+    assert cache.outranks(member(5, roles[2]), roles[1])
+    assert not cache.outranks(member(5, roles[1]), roles[1])
+    assert cache.outranks(member(99, roles[0]), roles[3])
+    # users who aren't members of the guild can always be moderated
+    assert cache.can_moderate(guild, [SimpleNamespace(id=5)]) == [True]
+    assert (cache.hits, cache.misses) == (4, 1)
+
+    assert cache.can_assign(guild, roles[1])
+    assert not cache.can_assign(guild, roles[2])
+    assert not cache.can_assign(guild, roles[3])
+
+    guild.roles = [roles[0], roles[3], roles[1], roles[2]]
+    assert cache.of(guild).ranks[13] == 3
+    asyncio.run(cache.on_role_changed(SimpleNamespace(guild=guild)))
+    assert cache.of(guild).ranks[13] == 1
+    assert (cache.misses, cache.invalidations) == (2, 1)
+
+
+def make_cog(cog, settings=None, **attributes):
+    """Creates a cog of a stand-in bot with the given attributes and [discord] settings."""
+    config = configparser.ConfigParser()
+    config.read_dict({"discord": settings or {}})
+    return cog(
+        SimpleNamespace(log=logging.getLogger("test"), config=config, **attributes)
+    )
+
+
+def test_ban_attribution_reads_the_audit_log_only_back_to_the_batch():
+    now = datetime.utcnow()
+    read = []
+
+    async def audit_logs(limit, **_):
+        for index in range(limit):
+            read.append(index)
+            yield SimpleNamespace(
+                created_at=now - timedelta(seconds=index),
+                target=SimpleNamespace(id=index),
+            )
+
+    guild = SimpleNamespace(audit_logs=audit_logs)
+    bans = make_cog(Bans)
+
+    entries = asyncio.run(bans.find_ban_entries(guild, [3, 5], now - timedelta(1)))
+    assert set(entries) == {3, 5} and len(read) == 6
+
+    read.clear()
+    entries = asyncio.run(
+        bans.find_ban_entries(guild, [3, 50], now - timedelta(seconds=10))
+    )
+    assert set(entries) == {3} and len(read) == 12
+
+    read.clear()
+    entries = asyncio.run(bans.find_ban_entries(guild, [5000], now - timedelta(1)))
+    assert entries == {} and len(read) == Bans.MAX_AUDIT_LOG_ENTRIES
+    assert bans.ban_events["audit_log_reads"] == 3
+
+
+def test_ban_events_of_the_ban_command_reuse_its_infractions():
+    logged = []
+
+    async def post_log(guild, msg, title, color):
+        logged.append(title)
+
+    async def audit_logs(**_):
+        return
+        yield
+
+    async def scenario():
+        database = AsyncDatabase(
+            {"database": {"path": ":memory:", "migrations": str(MIGRATIONS)}}
+        )
+        settings = await database.guilds.save(
+            GuildSettings(1, 2, None, DurationType.YEARS, 30, None, LogSinks.CHANNEL)
+        )
+        bans = make_cog(
+            Bans,
+            {"ban_event_window": "0"},
+            db=database,
+            post_log=post_log,
+            command_prefix=".",
+            Context=Fuzzy.Context,
+        )
+        # made long enough ago that it can't be found by its time
+        own = ban(5, settings, datetime.utcnow() - timedelta(hours=1))
+        # banned by ID only, the event names the user
+        own.user.name = "Unknown#????"
+        own = await database.infractions.save(own)
+        bans.own_bans[1] = {5: own}
+
+        guild = SimpleNamespace(id=1, audit_logs=audit_logs)
+        for user_id in (5, 6):
+            user = SimpleNamespace(
+                id=user_id, name="user", discriminator=f"{user_id:04}"
+            )
+            await bans.on_member_ban(guild, user)
+        await bans.ingestion[1]
+        stored = [
+            [
+                infraction.user.name
+                for infraction in await database.infractions.find_bans_for_user(
+                    user_id, 1
+                )
+            ]
+            for user_id in (5, 6)
+        ]
+        database.close()
+        return bans, own, stored
+
+    bans, own, stored = asyncio.run(scenario())
+    assert logged == [f"Ban #{own.id}", f"Ban #{own.id + 1}"]
+    assert stored == [["user#0005"], ["user#0006"]]
+    assert bans.own_bans == {} and bans.ban_events["unattributed"] == 1
+
+
+def test_attached_user_ids_are_banned_without_looking_them_up():
+    member = SimpleNamespace(id=123456789012345678)
+    argument = SimpleNamespace(id=223456789012345678)
+    attachment = SimpleNamespace(size=100)
+
+    async def read():
+        return b"223456789012345678\n123456789012345678, 323456789012345678 42"
+
+    attachment.read = read
+    ctx = SimpleNamespace(
+        message=SimpleNamespace(attachments=[attachment]),
+        guild=SimpleNamespace(get_member={member.id: member}.get),
+    )
+    bans = make_cog(Bans, get_user=lambda _: None)
+
+    targets = asyncio.run(bans.collect_targets(ctx, [argument]))
+    assert targets[:2] == [argument, member]
+    assert (
+        isinstance(targets[2], discord.Object) and targets[2].id == 323456789012345678
+    )
+    assert len(targets) == 3
+
+
+def test_hierarchy_cache_checks_members_against_the_bot():
+    state = SimpleNamespace()
+    state.store_user = lambda data: discord.User(state=state, data=data)
+    guild = SimpleNamespace(id=1, owner_id=99)
+    guild.roles = [
+        discord.Role(
+            guild=guild,
+            state=state,
+            data={"id": 10 + rank, "name": "", "position": rank},
+        )
+        for rank in range(4)
+    ]
+    guild.default_role = guild.roles[0]
+    guild.get_role = {role.id: role for role in guild.roles}.get
+
+    def member(member_id, *role_ids):
+        user = {
+            "id": member_id,
+            "username": "",
+            "discriminator": "0001",
+            "avatar": None,
+        }
+        return discord.Member(
+            data={"user": user, "roles": list(role_ids)}, guild=guild, state=state
+        )
+
+    guild.me = member(1, 11, 12)
+    cache = HierarchyCache(SimpleNamespace(add_listener=lambda *_: None))
+    targets = [member(2), member(3, 11), member(4, 12), member(5, 13), member(99)]
+    assert cache.can_moderate(guild, targets) == [True, True, False, False, False]
+    # the owner outranks every role, even without any
+    assert cache.outranks(member(99), guild.roles[3])
+    assert not cache.outranks(member(4, 12), guild.roles[2])
+
+
+def test_purges_bulk_delete_recent_messages_and_delete_older_ones_singly():
+    now = datetime.utcnow()
+    real_cutoff = discord.utils.time_snowflake(now - Purges.BULK_MAX_AGE)
+    bulk, single, replies = [], [], []
+
+    async def delete_messages(messages):
+        bulk.append([message.id for message in messages])
+
+    channel = SimpleNamespace(id=2, mention="#general", delete_messages=delete_messages)
+    guild = SimpleNamespace(id=1)
+    channel.guild = guild
+
+    def message(age, fails=False):
+        async def delete():
+            if fails:
+                raise discord.HTTPException(
+                    SimpleNamespace(status=500, reason="Server Error"), "failed"
+                )
+            single.append(snowflake)
+
+        snowflake = discord.utils.time_snowflake(now - age)
+        return SimpleNamespace(
+            id=snowflake, guild=guild, channel=channel, content="", delete=delete
+        )
+
+    # newest first, like the channel history
+    messages = [message(timedelta(minutes=minutes)) for minutes in range(1, 251)]
+    messages += [
+        message(timedelta(days=14, minutes=-20)),
+        # within the leeway for the time the purge takes
+        message(timedelta(days=14, minutes=-5)),
+        message(timedelta(days=15)),
+        message(timedelta(days=20)),
+        message(timedelta(days=30), fails=True),
+    ]
+
+    async def history(limit, **_):
+        for message in messages[:limit]:
+            yield message
+
+    channel.history = history
+
+    progress_deletions = []
+
+    async def send(**_):
+        async def edit(**_):
+            pass
+
+        async def delete_progress(delay=None):
+            progress_deletions.append(delay)
+
+        return SimpleNamespace(edit=edit, delete=delete_progress)
+
+    async def reply(text, **_):
+        replies.append(text)
+
+    async def delete():
+        pass
+
+    async def scenario():
+        purges = make_cog(Purges, actions=ActionQueue(logging.getLogger("test")))
+        ctx = SimpleNamespace(
+            bot=purges.bot,
+            guild=guild,
+            channel=channel,
+            message=SimpleNamespace(delete=delete),
+            send=send,
+            reply=reply,
+            Color=Fuzzy.Context.Color,
+        )
+        await Purges.purge.callback(purges, ctx, 1000)
+        first = Counter(purges.purged)
+        await Purges.purge.callback(purges, ctx, 120)
+        purges.bot.actions.close()
+        return first, purges.purged
+
+    first, purged = asyncio.run(scenario())
+    assert [len(chunk) for chunk in bulk] == [100, 100, 51, 100, 20]
+    assert all(snowflake > real_cutoff for chunk in bulk for snowflake in chunk)
+    assert single == [message.id for message in messages[251:254]]
+    assert first["bulk"] == 251 and first["single"] == 3 and first["failed"] == 1
+    assert first["scanned"] == 255
+    assert purged["bulk"] == 371 and purged["scanned"] == 375
+    assert progress_deletions == [5, 5]
+    assert replies == [
+        "Purged 254 messages from #general, 3 of them older than 14 days. "
+        "1 could not be deleted. Looked at 255 messages.",
+        "Purged 120 messages from #general. Looked at 120 messages.",
+    ]
+
+
+def test_expired_mutes_and_locks_are_deleted_even_if_lifting_them_fails():
+    logged = []
+
+    async def post_log(guild, msg, color):
+        logged.append(msg)
+
+    async def remove_roles(role):
+        raise discord.Forbidden(
+            SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions"
+        )
+
+    async def resolve_guild(guild_id):
+        return guild
+
+    async def resolve_member(guild, user_id):
+        return SimpleNamespace(id=user_id, remove_roles=remove_roles)
+
+    # the locked channel was deleted
+    guild = SimpleNamespace(
+        id=1, get_role=lambda role_id: object(), get_channel=lambda channel_id: None
+    )
+
+    async def scenario():
+        database = AsyncDatabase(
+            {"database": {"path": ":memory:", "migrations": str(MIGRATIONS)}}
+        )
+        settings = await database.guilds.save(
+            GuildSettings(1, 2, None, DurationType.YEARS, 30, 3, LogSinks.CHANNEL)
+        )
+        infraction = await database.infractions.save(ban(5, settings))
+        ended = datetime.utcnow() - timedelta(minutes=1)
+        await database.mutes.save(Mute(infraction, ended, infraction.user))
+        await database.locks.save(
+            Lock(7, True, DBUser(9, "mod#0001"), settings, "", ended)
+        )
+        bot = SimpleNamespace(
+            db=database,
+            actions=ActionQueue(logging.getLogger("test")),
+            resolve_guild=resolve_guild,
+            resolve_member=resolve_member,
+            post_log=post_log,
+            Context=Fuzzy.Context,
+        )
+        mutes = make_cog(Mutes, **vars(bot))
+        locks = make_cog(Locks, **vars(bot))
+        mutes.cog_unload()
+        locks.cog_unload()
+        await mutes.execute_expired_mute(infraction.id)
+        await locks.execute_expired_lock(7)
+        left = (
+            await database.mutes.find_by_id(infraction.id),
+            await database.locks.find_by_id(7),
+        )
+        bot.actions.close()
+        database.close()
+        return left
+
+    assert asyncio.run(scenario()) == (None, None)
+    assert logged == [
+        "user#0005 mute expired, but the mute role couldn't be removed: "
+        "Missing Permissions"
+    ]